@@ -1,13 +1,18 @@
 # Top level init.py for KAPy package
 
+from .aggregates import *
 from .arealstatistics import *
 from .calibration import *
+from .catalog import *
 from .config import *
 from .primVars import *
 from .derivedVars import *
 from .ensembles import *
+from .filenames import *
+from .grids import *
 from .regridding import *
 from .indicators import *
-from .workflow import getWorkflow
+from .kernels import *
+from .workflow import getWorkflow, getCachedWorkflow
 from .plots import *
 from .helpers import *
@@ -0,0 +1,155 @@
+"""
+#Setup for debugging with VS code
+import os
+print(os.getcwd())
+os.chdir("..")
+import KAPy
+os.chdir("..")
+config=KAPy.getConfig("./config/config.yaml")
+wf=KAPy.getWorkflow(config)
+indID=next(iter(wf['indicators']))
+outFile=[next(iter(wf['indicators'][indID]))]
+inFile=wf['indicators'][indID][outFile[0]]
+"""
+
+# Cache of monthly partial aggregates of the primary variables. The monthly sum, count,
+# minimum and maximum of each variable are calculated once, and stored
+# next to the variable. Indicators that use statistics that can be built from these
+# partial aggregates (e.g. means over years or periods) are then calculated from the
+# cache, for any season, without reading the original data again.
+import os
+import numpy as np
+import xarray as xr
+from . import helpers
+from . import kernels
+
+# Statistics that can be calculated from the monthly aggregates. For each we give
+# the aggregates that are required, the reduction used to combine them over time, and a
+# function to calculate the final statistic from the combined aggregates
+aggregateStatistics = {
+    "mean": {"vars": ["sum", "count"],
+             "reduce": "sum",
+             "finish": lambda r: r["sum"] / r["count"].where(r["count"] > 0)},
+    "sum": {"vars": ["sum", "count"],
+            "reduce": "sum",
+            "finish": lambda r: r["sum"].where(r["count"] > 0)},
+    "max": {"vars": ["max"],
+            "reduce": "max",
+            "finish": lambda r: r["max"]},
+    "min": {"vars": ["min"],
+            "reduce": "min",
+            "finish": lambda r: r["min"]},
+}
+
+
+def getAggregatesPath(inFile):
+    # The cache is stored next to the variable file
+    return os.path.normpath(inFile) + ".monthly.nc"
+
+
+def buildMonthlyAggregates(thisDat):
+    """
+    Build monthly aggregates
+
+    Calculates the monthly partial aggregates of a dataarray, returning them as a dataset.
+    """
+    # Sums are accumulated in double precision, so that they can be combined over long
+    # periods without loss of accuracy
+    thisDat64 = thisDat.astype("float64")
+    agg = xr.Dataset({
+        "sum": thisDat64.resample(time="MS").sum("time").fillna(0),
+        "count": thisDat.notnull().resample(time="MS").sum("time").fillna(0).astype("int32"),
+        "min": thisDat.resample(time="MS").min("time"),
+        "max": thisDat.resample(time="MS").max("time"),
+    })
+    agg.attrs = {"description": "Monthly partial aggregates calculated by KAPy"}
+    return agg
+
+
+def aggregatesEncoding(agg):
+    # The aggregates are compressed in the cache
+    return {v: {"zlib": True, "complevel": 4} for v in agg.data_vars}
+
+
+def getMonthlyAggregates(config, inFile):
+    """
+    Get monthly aggregates
+
+    Returns the monthly partial aggregates of a variable file. These are read from the
+    cache if it is up to date, or otherwise calculated from the variable file and stored
+    in the cache.
+    """
+    aggPath = getAggregatesPath(inFile)
+    if (not os.path.exists(aggPath)) or \
+       (os.path.getmtime(aggPath) < os.path.getmtime(inFile)):
+        thisDat = helpers.readFile(inFile)
+
+        def writeAggregates(tmpPath):
+            if config["processing"]["memoryBudget"] != "":
+                # Build the aggregates tile by tile, within the memory budget
+                for thisTile in helpers.budgetTiles(thisDat, config["processing"]["memoryBudget"]):
+                    agg = buildMonthlyAggregates(thisDat.isel(thisTile).load())
+                    helpers.writeTile(agg, tmpPath, thisTile, thisDat, aggregatesEncoding(agg))
+            else:
+                agg = buildMonthlyAggregates(thisDat)
+                agg.to_netcdf(tmpPath, encoding=aggregatesEncoding(agg))
+        helpers.atomicWrite(aggPath, writeAggregates)
+    with xr.open_dataset(aggPath, use_cftime=True) as ds:
+        agg = ds.load()
+    return agg
+
+
+def aggregateIndicator(config, agg, thisInd, thisSeason):
+    """
+    Calculate indicator from monthly aggregates
+
+    Calculates an indicator for a season from the monthly partial aggregates, binned in
+    time according to the indicator configuration. The result is equivalent to applying
+    the statistic to the original data.
+    """
+    thisStat = aggregateStatistics[thisInd["statistic"]]
+
+    # Filter by season. Seasons are defined in terms of months, so can be selected
+    # directly from the monthly aggregates
+    theseMonths = config["seasons"][thisSeason]["months"]
+    aggSeason = agg[thisStat["vars"]]
+    aggSeason = aggSeason.isel(time=helpers.seasonMask(aggSeason, theseMonths))
+
+    # Combine aggregates over periods
+    if thisInd["time_binning"] == "periods":
+        periodMembers = helpers.periodMembership(aggSeason[thisStat["vars"][0]],
+                                                 config["periods"])
+        if thisStat["reduce"] == "sum":
+            combined = xr.Dataset({v: xr.dot(aggSeason[v].astype("float64"),
+                                             periodMembers.astype("float64"), dim="time")
+                                   for v in thisStat["vars"]})
+        else:
+            slices = []
+            for thisPeriodID in periodMembers.periodID.values:
+                isMember = periodMembers.sel(periodID=thisPeriodID).values > 0
+                thisSlice = aggSeason.isel(time=isMember)
+                if isMember.any():
+                    res = getattr(thisSlice, thisStat["reduce"])("time")
+                else:
+                    res = xr.full_like(aggSeason.isel(time=0, drop=True), np.nan, dtype=float)
+                slices.append(res.expand_dims(periodID=[thisPeriodID]))
+            combined = xr.concat(slices, dim="periodID")
+        dout = thisStat["finish"](combined).transpose("periodID", ...)
+
+    # Combine aggregates over rolling windows of years, via annual aggregates
+    elif thisInd["time_binning"] == "rolling":
+        years = xr.DataArray(helpers.timeCodes(aggSeason)["year"], dims="time",
+                             coords={"time": aggSeason.time}, name="year")
+        annual = getattr(aggSeason.groupby(years), thisStat["reduce"])("time")
+        combined = kernels.rollingWindows(annual, int(thisInd["additionalArgs"]["window"]),
+                                          int(thisInd["additionalArgs"].get("step", 1)),
+                                          thisStat["reduce"])
+        dout = thisStat["finish"](combined)
+
+    # Combine aggregates over years or months
+    elif thisInd["time_binning"] in ["years", "months"]:
+        freq = "YE" if thisInd["time_binning"] == "years" else "ME"
+        combined = getattr(aggSeason.resample(time=freq, label="right"), thisStat["reduce"])("time")
+        dout = thisStat["finish"](combined)
+
+    return dout
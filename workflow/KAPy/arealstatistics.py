@@ -18,9 +18,11 @@ import pandas as pd
 import geopandas as gpd
 import regionmask
 import numpy as np
-import os
+import hashlib
 from cdo import Cdo
 from . import helpers
+from . import grids
+from .filenames import parseFilenames
 
 def generateArealstats(config, inFile, outFile):
     # Generate statistics over an area by applying a polygon mask and averaging
@@ -38,14 +40,18 @@ def generateArealstats(config, inFile, outFile):
         tCoord='periodID'
     else:
         raise ValueError(f'Cannot find time or periodID coordinate in "{inFile[0]}".')
+    #Seasons are carried through as an additional non-spatial dimension, if present
+    nonSpDims=['time','periodID','season','percentiles']
 
-    # If using area weighting, get the pixel size
+    # If using area weighting, get the pixel size. This is calculated once per grid,
+    # and kept in the grid store
     if config['arealstats']['useAreaWeighting']:
         cdo=Cdo()
-        pxlSize=cdo.gridarea(input=thisDat[{tCoord:0}],
-                             returnXArray='cell_area')
+        pxlSize=grids.getGridArtefact(config, thisDat, "cell_area.nc",
+                                      lambda: cdo.gridarea(input=thisDat[{d:0 for d in thisDat.dims if d in nonSpDims}],
+                                                           returnXArray='cell_area'))
     else:
-        pxlSize=thisDat[{tCoord:0}]
+        pxlSize=thisDat[{d:0 for d in thisDat.dims if d in nonSpDims}]
         pxlSize.values[:]=1
 
     # If we have a shapefile defined, then work with it
@@ -58,11 +64,18 @@ def generateArealstats(config, inFile, outFile):
                                        names=config['arealstats']['idColumn'],
                                        abbrevs=config['arealstats']['idColumn'],
                                        name='test')
-        maskRaster=maskRegions.mask_3D_frac_approx(thisDat)
+        #The mask only depends on the grid and the regions, so is also calculated once
+        #per grid and kept in the grid store, keyed on the region geometries and IDs
+        h=hashlib.sha1(config['arealstats']['idColumn'].encode())
+        h.update(shapefile[config['arealstats']['idColumn']].astype(str).str.cat(sep='|').encode())
+        for thisGeom in shapefile.geometry.to_wkb():
+            h.update(thisGeom)
+        maskRaster=grids.getGridArtefact(config, thisDat, f"regions_{h.hexdigest()}.nc",
+                                         lambda: maskRegions.mask_3D_frac_approx(thisDat))
 
         #Apply masking and weighting and calculate
         wtThis=maskRaster*pxlSize
-        statDims=set(thisDat.dims) - set(['region','periodID','time','percentiles'])
+        statDims=set(thisDat.dims) - set(['region']+nonSpDims)
         wtMean = thisDat.weighted(wtThis).mean(dim=statDims)
         wtMean.name='mean'
         wtSd = thisDat.weighted(wtThis).std(dim=statDims)
@@ -76,7 +89,7 @@ def generateArealstats(config, inFile, outFile):
     #Otherwise, just average spatially
     else:
         # Average spatially over the time dimension
-        spDims =set(thisDat.dims)-set(['time','periodID','percentiles'])
+        spDims =set(thisDat.dims)-set(nonSpDims)
         spMean = thisDat.weighted(pxlSize).mean(dim=spDims)
         spMean.name='mean'
         spSd = thisDat.weighted(pxlSize).std(dim=spDims)
@@ -102,22 +115,19 @@ outFile=["results/5.areal_statistics/Areal_statistics.csv"]
 """
 
 def combineArealstats(config, inFiles, outFile):
-    #Load individual files
+    #Split the filenames into the defined elements
+    fnTbl = parseFilenames(inFiles).set_index("path")
+
+    #Load individual files, adding the elements as the leading columns
     dat = []
     for f in inFiles:
         datIn=pd.read_csv(f)
-        datIn.insert(0,'sourcePath',f)
-        datIn.insert(0,'filename',os.path.basename(f))
+        for col, fld in [('memberID','stems'),('expt','expt'),('gridID','gridID'),
+                         ('srcID','srcID'),('indID','varID')]:
+            datIn.insert(0,col,fnTbl.loc[f,fld])
         dat += [datIn]
     datdf = pd.concat(dat)
-    
-    #Split out the defined elements
-    datdf.insert(2,'memberID',datdf['filename'].str.extract("^[^_]+_[^_]+_[^_]+_[^_]+_(.*).csv$"))
-    datdf.insert(2,'expt',datdf['filename'].str.extract("^[^_]+_[^_]+_[^_]+_([^_]+)_.*$"))
-    datdf.insert(2,'gridID',datdf['filename'].str.extract("^[^_]+_[^_]+_([^_]+)_.*$"))
-    datdf.insert(2,'srcID',datdf['filename'].str.extract("^[^_]+_([^_]+)_.*$"))
-    datdf.insert(2,'indID',datdf['filename'].str.extract("^([^_]+)_.*$"))
-
-    #Drop the filename and write out
-    datdf.drop(columns=['filename','sourcePath']).to_csv(outFile[0],index=False)
+
+    #Write out
+    datdf.to_csv(outFile[0],index=False)
 
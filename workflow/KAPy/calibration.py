@@ -15,26 +15,103 @@ import matplotlib.pyplot as plt
 """
 
 import xarray as xr
-from cdo import Cdo
+import numpy as np
+import hashlib
+import os
 from . import helpers
-
-def calibrate(config,histSimFile,refFile,outFile, thisCal):
+from . import grids
+from . import quantileMapping
+from .primVars import writeZarr
+from .catalog import gridHash
+
+#Xclim adjustment methods, giving the name of the adjustment class and the
+#arguments used when applying the adjustment
+xclimMethods={"xclim-eqm":{'class':'EmpiricalQuantileMapping',
+                           'adjustArgs':{'extrapolation':"constant",'interp':"nearest"}},
+              "xclim-dqm":{'class':'DetrendedQuantileMapping',
+                           'adjustArgs':{'extrapolation':"constant",'interp':"nearest"}},
+              "xclim-scaling":{'class':'Scaling',
+                               'adjustArgs':{'interp':"nearest"}}}
+
+def calibrate(config,histSimFile,refFile,outFile, thisCal, threads=1):
     # We choose to follow here the Xclim typology of ref / hist / sim, with the
     # assumption that the hist and sim part are contained in the same file
-    #Import files - enforce loading, to avoid dask issues
-    histSimDat=helpers.readFile(histSimFile).compute()
-    refDat=helpers.readFile(refFile).compute()
+    #Import files lazily - the data is loaded tile by tile below
+    histSimDat=helpers.readFile(histSimFile)
+    refDat=helpers.readFile(refFile)
+
+    # Regrid calibration data to the refData set using nearest neighbour 
+    # interpolation. The mapping between the grids is calculated once for each 
+    # pair of grids and cached, and is then applied as a lazy gather
+    histSimNN=grids.remapNearest(config,histSimDat,refDat)
+
+    # The trained adjustment is cached for the full field, so that it is only trained
+    # once, however the calibration is split into tiles. If it is available, each tile
+    # takes its part of it
+    cachePath=getTrainingCachePath(config,thisCal,refDat,histSimNN)
+    cached=xr.open_dataset(cachePath) if os.path.exists(cachePath) else None
+
+    # Calibration is independent for each grid cell, so the data is split into spatial
+    # tiles that are trained and adjusted in parallel, using a pool of threads. All
+    # reading and writing, including of the cache, is done by the main thread, as the
+    # netCDF library is not thread-safe
+    tiles=helpers.budgetTiles(histSimNN,config["processing"]["memoryBudget"],threads)
+    if len(tiles)==1:
+        res,trained=adjustTile(config,thisCal,histSimNN.load(),refDat.load(),
+                               None if cached is None else cached.load())
+        res.to_netcdf(outFile[0])
+        if cached is None:
+            writeTraining(trained,cachePath)
+    else:
+        # A new training is written tile by tile alongside the output, and moved into
+        # the cache once complete
+        def readTile(thisTile):
+            return (histSimNN.isel(thisTile).load(),refDat.isel(thisTile).load(),
+                    None if cached is None else cached.isel(thisTile).load())
+        def calcTile(dats,thisTile):
+            return adjustTile(config,thisCal,*dats)
+        def writeTiles(tmpPath):
+            def writeTile(thisTile,res):
+                helpers.writeTile(res[0],outFile[0],thisTile,histSimNN)
+                if tmpPath is not None:
+                    helpers.writeTile(res[1],tmpPath,thisTile,histSimNN)
+            helpers.processTiles(tiles,readTile,calcTile,writeTile,threads)
+        if cached is None:
+            os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+            helpers.atomicWrite(cachePath,writeTiles)
+        else:
+            writeTiles(None)
+    if cached is not None:
+        cached.close()
+    helpers.reportPeakMemory()
+
+
+def prepareReference(config,refFile,outFile,calPeriodStart,calPeriodEnd):
+    """
+    Prepare reference dataset
+
+    Slices a reference dataset to the calibration period and writes it out as a
+    Zarr store, chunked along the spatial dimensions with the full time axis in each
+    chunk. This is done once per reference and calibration period, and the result is
+    shared by all calibration jobs, which can then read their tiles directly.
+    """
+    refDat=helpers.readFile(refFile)
+    refDatCP=helpers.timeslice(refDat,calPeriodStart,calPeriodEnd)
+    chunkCfg={'time':-1,
+              'space':config['processing']['primaryVariableChunks']['space']}
+    writeZarr(refDatCP,outFile[0],chunkCfg)
+
+
+def adjustTile(config,thisCal,histSimNN,refDat,trained=None):
+    """
+    Calibrate a tile
+
+    Trains the bias adjustment on a (spatial) tile of the regridded simulation and
+    reference data, unless the training of the tile is given, and applies it to the
+    full simulation. Returns the result and the training.
+    """
     calCfg=config['calibration'][thisCal]
 
-    # Regrid calibration data to the refData set 
-    # First a write a single time slice of the reference data out, to use as the 
-    # grid descriptor for the reference data set, then regrid using
-    # CDO nearest neighbour interpolation
-    cdo=Cdo()
-    refGriddes=cdo.seltimestep('1/1',input=refDat)
-    histSimNNFname=cdo.remapnn(refGriddes,input=histSimDat)
-    histSimNN=helpers.readFile(histSimNNFname,format=".nc").compute()
-
     #Truncate time slice to the common calibration period (CP). Ensure synchronisation
     #between times and grids using nearest neighbour interpolation of
     #the sim data to the obs data
@@ -80,33 +157,27 @@ def calibrate(config,histSimFile,refFile,outFile, thisCal):
         from cmethods.distribution import detrended_quantile_mapping
         raise ValueError('"cmethods-detrended" method is currently not implemented')
 
-    elif calCfg['method']=="xclim-eqm":
-        #Empirical quantile mapping -----------------------------
-        from xclim.sdba import EmpiricalQuantileMapping
-        EQM = EmpiricalQuantileMapping.train(refDatCP, 
-                                                 histNN, 
-                                                 group="time."+calCfg['grouping'],
-                                                 **calCfg['additionalArgs'])
-        res = EQM.adjust(histSimNN, extrapolation="constant", interp="nearest")
-
-    elif calCfg['method']=="xclim-dqm":
-        #Detrended quantile mapping -----------------------------
-        from xclim.sdba import DetrendedQuantileMapping
-        DQM = DetrendedQuantileMapping.train(refDatCP, 
-                                                 histNN, 
-                                                 group="time."+calCfg['grouping'],
-                                                 **calCfg['additionalArgs'])
-        res = DQM.adjust(histSimNN, extrapolation="constant", interp="nearest")
-
-    elif calCfg['method']=="xclim-scaling":
-        #Xclim - Scaling--------------------------------
-        from xclim.sdba.adjustment import Scaling
-        this = Scaling.train(refDatCP, 
-                                   histNN,
-                                   group="time."+calCfg['grouping'],
-                                   **calCfg['additionalArgs'])
-        res = this.adjust(histSimNN, interp="nearest")
-
+    elif calCfg['method'] in xclimMethods.keys():
+        #Xclim methods - Empirical quantile mapping, detrended quantile mapping 
+        #and scaling
+        from xclim.sdba import adjustment
+        adjClass=getattr(adjustment, xclimMethods[calCfg['method']]['class'])
+        if trained is None:
+            adjObj = adjClass.train(refDatCP,
+                                    histNN,
+                                    group="time."+calCfg['grouping'],
+                                    **calCfg['additionalArgs'])
+            trained = adjObj.ds
+        else:
+            adjObj = adjClass.from_dataset(trained)
+        res = adjObj.adjust(histSimNN, **xclimMethods[calCfg['method']]['adjustArgs'])
+
+
+    elif calCfg['method'] in ["kapy-eqm","kapy-qdm"]:
+        #Native quantile mapping methods, using compiled kernels
+        if trained is None:
+            trained = quantileMapping.train(refDatCP, histNN, calCfg)
+        res = quantileMapping.adjust(histSimNN, trained, calCfg['method'])
 
     elif calCfg['method']=="custom":
         raise ValueError('"custom" calibration is currently not implemented')
@@ -119,6 +190,62 @@ def calibrate(config,histSimFile,refFile,outFile, thisCal):
     #Finish
     res = res.transpose(*refDatCP.dims)
     res.name=calCfg['outVariable']
-    res.to_netcdf(outFile[0])
+    return res, trained
+
+
+def getTrainingCacheDir(config):
+    # Location of the cache of trained adjustments. Defaults to a subdirectory
+    # of the calibration directory
+    if config["processing"]["trainingCache"] != "":
+        return config["processing"]["trainingCache"]
+    return os.path.join(config["dirs"]["calibration"], "trainedModels")
+
+
+def trainingKey(refDatCP, histNN, calCfg, memoryBudget=""):
+    """
+    Hash training inputs
+
+    Calculates a fingerprint of everything that determines the trained adjustment:
+    the reference and historical data over the calibration period (values, times
+    and grids), the method, the grouping and the additional arguments. The data are
+    hashed over the full field, so that the fingerprint does not depend on how the
+    calibration is split into tiles.
+    """
+    h = hashlib.sha1()
+    for thisDat in [refDatCP, histNN]:
+        # The values are read within the memory budget, in slabs along the first
+        # spatial dimension. These are consecutive pieces of the full array, so the
+        # hash does not depend on their size
+        spatialDims = [d for d in thisDat.dims if d != "time"]
+        thisDat = thisDat.transpose(*spatialDims, "time")
+        for thisSlab in helpers.budgetTiles(thisDat, memoryBudget, tileDims=spatialDims[:1]):
+            h.update(np.ascontiguousarray(thisDat.isel(thisSlab).values).tobytes())
+        theseCodes = helpers.timeCodes(thisDat)
+        for thisCode in ["year", "month", "day"]:
+            h.update(np.ascontiguousarray(theseCodes[thisCode]).tobytes())
+        h.update(str(thisDat.time.dt.calendar).encode())
+        h.update(gridHash(thisDat).encode())
+    for thisKey in ['method', 'grouping']:
+        h.update(str(calCfg[thisKey]).encode())
+    h.update(repr(sorted(calCfg['additionalArgs'].items())).encode())
+    # The format of the trained xclim dataset depends on the xclim version
+    if calCfg['method'] in xclimMethods.keys():
+        import xclim
+        h.update(xclim.__version__.encode())
+    return h.hexdigest()
+
+
+def getTrainingCachePath(config, thisCal, refDat, histSimNN):
+    # Path of the cached training dataset of a calibration, from the data over the
+    # calibration period
+    calCfg=config['calibration'][thisCal]
+    refDatCP=helpers.timeslice(refDat, calCfg['calPeriodStart'], calCfg['calPeriodEnd'])
+    histNN=helpers.timeslice(histSimNN, calCfg['calPeriodStart'], calCfg['calPeriodEnd'])
+    theKey=trainingKey(refDatCP, histNN, calCfg, config["processing"]["memoryBudget"])
+    return os.path.join(getTrainingCacheDir(config), f"{thisCal}_{theKey}.nc")
 
 
+def writeTraining(trained, cachePath):
+    # Store a training dataset in the cache
+    os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+    helpers.atomicWrite(cachePath, trained.to_netcdf)
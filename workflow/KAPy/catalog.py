@@ -0,0 +1,165 @@
+"""
+#Setup for debugging with VS Code
+import os
+print(os.getcwd())
+os.chdir("..")
+import KAPy
+os.chdir("..")
+config=KAPy.getConfig("./config/config.yaml")
+wf=KAPy.getWorkflow(config)
+inpID=next(iter(wf['primVars'].keys()))
+inFiles=wf['primVars'][inpID][next(iter(wf['primVars'][inpID]))]
+"""
+
+# Persistent catalog of input file metadata. Opening the headers of all input files
+# is expensive on large input trees, so the results are stored in a SQLite database and
+# only rescanned when the size or modification time of a file changes.
+import sqlite3
+import hashlib
+import os
+import sys
+import cftime
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Common time units used to store time bounds in the catalog
+catalogTimeUnits = "days since 1800-01-01"
+
+catalogColumns = ["path", "size", "mtime", "calendar", "nTime", "tStart", "tEnd",
+                  "tStartStr", "tEndStr", "gridHash", "variables"]
+
+
+def getCatalogPath(config):
+    # Location of the catalog database. Defaults to the variables directory
+    if config["processing"].get("inputCatalog", "") != "":
+        return config["processing"]["inputCatalog"]
+    return os.path.join(config["dirs"]["variables"], "inputCatalog.sqlite")
+
+
+def gridHash(ds):
+    """
+    Hash the horizontal grid
+
+    Calculates a stable fingerprint of the horizontal coordinates of a dataset i.e. all
+    coordinates that do not depend on time.
+    """
+    h = hashlib.sha1()
+    for thisCoord in sorted(ds.coords):
+        thisVar = ds[thisCoord]
+        if "time" in thisVar.dims or thisVar.ndim == 0:
+            continue
+        h.update(str(thisCoord).encode())
+        h.update(np.ascontiguousarray(thisVar.values).tobytes())
+    return h.hexdigest()
+
+
+def scanFile(thisPath):
+    """
+    Scan input file
+
+    Reads the header and time axis of a single input file and returns its metadata.
+    """
+    thisStat = os.stat(thisPath)
+    with xr.open_dataset(thisPath, decode_times=False) as ds:
+        timeVar = ds["time"]
+        calendar = timeVar.attrs.get("calendar", "standard")
+        if timeVar.size == 0:
+            sys.exit(f"Input file '{thisPath}' has an empty time axis.")
+        # Convert the first and last times to the common units used in the catalog
+        tVals = timeVar.values[[0, -1]]
+        theseDates = cftime.num2date(tVals, timeVar.attrs["units"], calendar)
+        tNum = cftime.date2num(theseDates, catalogTimeUnits, calendar)
+        rtn = {
+            "path": thisPath,
+            "size": thisStat.st_size,
+            "mtime": thisStat.st_mtime,
+            "calendar": calendar,
+            "nTime": int(timeVar.size),
+            "tStart": float(tNum[0]),
+            "tEnd": float(tNum[-1]),
+            "tStartStr": theseDates[0].isoformat(),
+            "tEndStr": theseDates[-1].isoformat(),
+            "gridHash": gridHash(ds),
+            "variables": ",".join(sorted(ds.data_vars)),
+        }
+    return rtn
+
+
+def getCatalog(config, paths):
+    """
+    Get input file metadata
+
+    Returns the catalog entries for the requested input files as a pandas dataframe,
+    scanning only those files that are not yet in the catalog or whose size or
+    modification time has changed since they were last scanned.
+    """
+    catPath = getCatalogPath(config)
+    os.makedirs(os.path.dirname(os.path.abspath(catPath)), exist_ok=True)
+    # Use a generous timeout, as multiple jobs may try to update the catalog at once
+    con = sqlite3.connect(catPath, timeout=120)
+    with con:
+        con.execute("CREATE TABLE IF NOT EXISTS files ("
+                    + "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, calendar TEXT, "
+                    + "nTime INTEGER, tStart REAL, tEnd REAL, tStartStr TEXT, "
+                    + "tEndStr TEXT, gridHash TEXT, variables TEXT)")
+        catTbl = pd.read_sql_query("SELECT * FROM files", con)
+        catTbl = catTbl[catTbl["path"].isin(paths)]
+
+        # Identify files that are new or changed, based on size and mtime
+        stats = [os.stat(p) for p in paths]
+        statTbl = pd.DataFrame({"path": list(paths),
+                                "curSize": [s.st_size for s in stats],
+                                "curMtime": [s.st_mtime for s in stats]})
+        statTbl = statTbl.merge(catTbl[["path", "size", "mtime"]], on="path", how="left")
+        isStale = (statTbl["size"] != statTbl["curSize"]) | \
+                  (statTbl["mtime"] != statTbl["curMtime"])
+
+        # Rescan and store
+        newRecords = [scanFile(p) for p in statTbl.loc[isStale, "path"]]
+        if len(newRecords) > 0:
+            con.executemany("INSERT OR REPLACE INTO files VALUES "
+                            + f"({','.join(['?'] * len(catalogColumns))})",
+                            [tuple(r[c] for c in catalogColumns) for r in newRecords])
+            newTbl = pd.DataFrame(newRecords, columns=catalogColumns)
+            catTbl = pd.concat([catTbl[~catTbl["path"].isin(newTbl["path"])], newTbl])
+    con.close()
+
+    return catTbl.set_index("path").loc[list(paths)].reset_index()
+
+
+def orderFiles(config, inFiles, inpID):
+    """
+    Order input files in time
+
+    Uses the catalog to sort the input files by their time bounds, and checks
+    that the calendars are consistent and that the files do not overlap in time.
+    Gaps in the time axis are reported but do not stop processing.
+    """
+    catTbl = getCatalog(config, inFiles).sort_values("tStart").reset_index(drop=True)
+
+    # Check calendars
+    if catTbl["calendar"].nunique() > 1:
+        sys.exit(f"Multiple calendars found in input files for '{inpID}': "
+                 + f"{list(catTbl['calendar'].unique())}.")
+
+    # Check for overlaps (which produce duplicate timesteps) and gaps between files
+    # The time step is estimated from the file with the most timesteps or, where every
+    # file holds a single timestep, from the smallest spacing between the files
+    if len(catTbl) > 1:
+        longest = catTbl.loc[catTbl["nTime"].idxmax()]
+        if longest["nTime"] > 1:
+            tStep = (longest["tEnd"] - longest["tStart"]) / (longest["nTime"] - 1)
+        else:
+            tStep = catTbl["tStart"].diff().min()
+        prevEnd = catTbl["tEnd"].shift(1)
+        overlaps = catTbl["tStart"] <= prevEnd
+        if overlaps.any():
+            badFiles = catTbl.loc[overlaps | overlaps.shift(-1, fill_value=False), "path"]
+            sys.exit(f"Overlapping time axes found in input files for '{inpID}': "
+                     + f"{list(badFiles)}.")
+        gaps = (catTbl["tStart"] - prevEnd) > 1.5 * tStep
+        for thisPath in catTbl.loc[gaps, "path"]:
+            print(f"Warning: gap in time axis detected for '{inpID}' before '{thisPath}'.")
+
+    return list(catTbl["path"])
@@ -11,6 +11,7 @@ from snakemake.utils import validate
 import os
 import sys
 import ast
+from . import kernels
 
 
 def readConfig(configfile):
@@ -52,6 +53,30 @@ def validateConfig(config):
     # Validate configuration file
     validate(config, os.path.join(schemaDir, "config.schema.json"))
 
+    # Resolve the storage format of the primary variables. The legacy
+    # picklePrimaryVariables flag is respected if the format is not given explicitly
+    procCfg = config["processing"]
+    if "primaryVariableFormat" not in procCfg:
+        if procCfg.get("picklePrimaryVariables", False):
+            procCfg["primaryVariableFormat"] = "pickle"
+        else:
+            procCfg["primaryVariableFormat"] = "netcdf"
+    procCfg.setdefault("batchIndicators", False)
+    procCfg.setdefault("aggregationCache", False)
+    procCfg.setdefault("memoryBudget", "")
+    procCfg.setdefault("trainingCache", "")
+    procCfg.setdefault("calibrationThreads", 1)
+    procCfg.setdefault("gridCache", "")
+    procCfg.setdefault("ensembleEngine", "streaming")
+    procCfg.setdefault("ensembleThreads", 1)
+    if config["outputGrid"]["regriddingEngine"] == "sparse":
+        config["outputGrid"].setdefault("remapMethod", "bilinear")
+    procCfg["primaryVariableChunks"] = {
+        "time": -1,
+        "space": 50,
+        **procCfg.get("primaryVariableChunks", {}),
+    }
+
     # Now check that the other configuration tables exist
     for thisKey, thisPath in config["configurationTables"].items():
         if not os.path.exists(thisPath):
@@ -62,7 +87,7 @@ def validateConfig(config):
     # Validate each table in turn. The validation approach used
     # is defined in the following table
     tabularCfg = {
-        "indicators": {"listCols": [], "dictCols": [], "schema": "indicators"},
+        "indicators": {"listCols": [], "dictCols": ["additionalArgs"], "schema": "indicators"},
         "inputs": {"listCols": ['ensMemberFields'], "dictCols": [], "schema": "inputs"},
         "periods": {"listCols": [], "dictCols": [], "schema": "periods"},
         "seasons": {"listCols": ["months"], "dictCols": [], "schema": "seasons"},
@@ -94,10 +119,14 @@ def validateConfig(config):
         valThis = thisTbl.drop(columns=theseVals["listCols"])
         # Validate against the appropriate schema.
         validate(valThis, os.path.join(schemaDir, f"{theseVals['schema']}.schema.json"))
-        # Dict columns also need to be parsed
+        # Dict columns also need to be parsed. Optional dict columns that are not
+        # present (or are left empty) are treated as empty dicts
         for col in theseVals["dictCols"]:
+            if col not in thisTbl.columns:
+                thisTbl[col] = "{}"
             try:
-                thisTbl[col] = [ast.literal_eval(x) for x in thisTbl[col]]
+                thisTbl[col] = [{} if x.strip() == "" else ast.literal_eval(x)
+                                for x in thisTbl[col]]
             except (SyntaxError, ValueError) as e:
                 print(
                     f"Error occurred in parsing column '{col}' in '{thisCfgFile}' : {e}"
@@ -127,13 +156,41 @@ def validateConfig(config):
         # Write the integers back to finish
         config["seasons"][thisKey]["months"] = theseMnths
 
-    # Season selected in the indicator table must be valid
-    # Currently allow only one season per indicator. This needs to be fixed in the future
-    indTbl = pd.DataFrame.from_dict(config["indicators"], orient="index")
-    validSeasons = list(config["seasons"].keys()) + ["all"]
-    for seasonRequest in indTbl["season"]:
-        if not (all([this in validSeasons for this in [seasonRequest]])):
-            sys.exit(f"Unknown season specified in: {seasonRequest}")
+    # The "all" season is always available, selecting all months
+    if "all" not in config["seasons"]:
+        config["seasons"]["all"] = {"id": "all", "name": "All months", "months": list(range(1, 13))}
+
+    # Seasons selected in the indicator table must be valid. Multiple seasons can be
+    # requested for an indicator as a comma-separated list, so parse this first
+    validSeasons = list(config["seasons"].keys())
+    for thisIndID, thisInd in config["indicators"].items():
+        seasonRequest = [this.strip() for this in thisInd["season"].split(",")]
+        if not (all([this in validSeasons for this in seasonRequest])):
+            sys.exit(f"Unknown season specified in: {thisInd['season']}")
+        if len(set(seasonRequest)) != len(seasonRequest):
+            sys.exit(f"Duplicate season specified in: {thisInd['season']}")
+        config["indicators"][thisIndID]["season"] = seasonRequest
+
+    # Statistics that need parameters (e.g. thresholds) must have them supplied
+    # via additionalArgs
+    for thisIndID, thisInd in config["indicators"].items():
+        thisKernel = kernels.statisticKernels[thisInd["statistic"]]
+        missingArgs = [a for a in thisKernel["args"] if a not in thisInd["additionalArgs"]]
+        if len(missingArgs) > 0:
+            sys.exit(f"Indicator '{thisIndID}' uses the statistic '{thisInd['statistic']}', "
+                     + f"which requires the additionalArgs {missingArgs}.")
+        # Rolling windows need a window length, and can only be used with statistics
+        # that can be combined from annual values
+        if thisInd["time_binning"] == "rolling":
+            if "window" not in thisInd["additionalArgs"]:
+                sys.exit(f"Indicator '{thisIndID}' uses rolling time binning, which requires "
+                         + "the window length (in years) to be set in additionalArgs.")
+            if int(thisInd["additionalArgs"]["window"]) < 1 or \
+               int(thisInd["additionalArgs"].get("step", 1)) < 1:
+                sys.exit(f"Rolling window length and step must be positive in indicator '{thisIndID}'.")
+            if thisKernel["linear"] is None and thisInd["statistic"] not in ["max", "min"]:
+                sys.exit(f"Indicator '{thisIndID}' uses the statistic '{thisInd['statistic']}', "
+                         + "which cannot be used with rolling time binning.")
 
     return config
 
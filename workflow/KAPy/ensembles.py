@@ -1,29 +1,63 @@
 """
-#Setup for debugging with VS code 
+#Setup for debugging with VS code
 import os
 os.chdir("..")
 import KAPy
 os.chdir("..")
-config=KAPy.getConfig("./config/config.yaml")  
+config=KAPy.getConfig("./config/config.yaml")
 wf=KAPy.getWorkflow(config)
 outFile=[next(iter(wf['ensstats'].keys()))]
 inFiles=wf['ensstats'][outFile[0]]
 """
 
+import os
+import shutil
+import hashlib
 import xarray as xr
+import numpy as np
+import dask
+import zarr
+import functools
+from numba import njit
 import xclim.ensembles as xcEns
+from . import helpers
+from . import grids
+
+# Sufficient statistics kept in the state of the incremental engine, from which the
+# ensemble mean, standard deviation, minimum and maximum are updated: the count, the
+# mean and the sum of squared deviations from the mean (m2)
+stateStatistics = ["count", "mean", "m2", "min", "max"]
+
+# Approximate number of elements in each chunk of the state
+stateChunkElems = 2**21
+
+# The member stack is stored without compression, which gains little on floating point
+# fields, and would otherwise dominate the time taken to read it. The name of the
+# encoding differs between zarr versions
+stackEncoding = {"compressors" if int(zarr.__version__.split(".")[0]) >= 3
+                 else "compressor": None}
 
 
-def generateEnsstats(config, inFiles, outFile):
+def generateEnsstats(config, inFiles, outFile, threads=1):
+    # Calculate the ensemble statistics with the configured engine
+    if config["processing"]["ensembleEngine"] == "xclim":
+        xclimEnsstats(config, inFiles, outFile)
+    elif config["processing"]["ensembleEngine"] == "incremental":
+        incrementalEnsstats(config, inFiles, outFile, threads)
+    else:
+        streamEnsstats(config, inFiles, outFile, threads)
+
+
+def xclimEnsstats(config, inFiles, outFile):
     # Setup the ensemble
     # Given that all input files have been regridded onto a common grid,
     # they can then be concatenated into a single object. There are
     # two approachs. Previously we have used the create_ensemble from xclim.ensembles
     # However, this is quite fancy, and does a lot of logic about calendars that
     # create further problems. It also doesn't seem to handle cftime calendars at all well
-    # Instead, we do it by directly opening the files with open_mfdataset. 
-    thisEns = xr.open_mfdataset(inFiles, 
-                                concat_dim="realization", 
+    # Instead, we do it by directly opening the files with open_mfdataset.
+    thisEns = xr.open_mfdataset(inFiles,
+                                concat_dim="realization",
                                 combine="nested",
                                 coords="all",
                                 use_cftime=True)
@@ -35,3 +69,416 @@ def generateEnsstats(config, inFiles, outFile):
     ensOut = xr.merge([ens_mean_std, ens_percs])
     # Write results
     ensOut.to_netcdf(outFile[0])
+
+
+def streamEnsstats(config, inFiles, outFile, threads=1):
+    """
+    Streaming ensemble statistics
+
+    Calculates the ensemble mean, standard deviation, minimum, maximum and percentiles
+    tile by tile, without building the full ensemble. Each tile of all members
+    is read once, all statistics are calculated from it in a single pass, and the
+    results are written directly to the output file. Tiles are processed in parallel
+    by a pool of threads. The output is the same as with the xclim engine.
+    """
+    memberDs, members, unionIdx, isAligned, template = openEnsemble(inFiles)
+    percentiles = [x for x in config["ensembles"].values()]
+    attrs = ensembleAttrs(memberDs, template, len(members))
+
+    # Each tile is read from all members, and the statistics calculated from it
+    def readTile(thisTile):
+        return readMembers(members, isAligned, unionIdx, template, thisTile)
+
+    def calcTile(block, thisTile):
+        return ensembleTile(block, template.isel(thisTile), percentiles, attrs)
+    # The statistics are independent for each element, so the tiles are contiguous
+    # blocks of the member files, which makes reading them efficient, and each tile
+    # holds all members
+    tiles = helpers.budgetTiles(template, config["processing"]["memoryBudget"], threads,
+                                tileDims=template.dims, nLayers=len(members))
+    helpers.processTiles(tiles, readTile, calcTile, outputWriter(tiles, outFile, template), threads)
+    for ds in memberDs:
+        ds.close()
+    helpers.reportPeakMemory()
+
+
+def openEnsemble(inFiles):
+    """
+    Open ensemble members
+
+    Opens the indicator of each member lazily, and returns the members, the union of
+    their non-spatial indexes, whether each member is already aligned on this union,
+    and a template describing the layout of the ensemble statistics.
+    """
+    # Members are aligned on the union of their time axes (or periods), with missing
+    # values where a member does not cover a timestep, as is done by open_mfdataset in
+    # the xclim engine. Reindexing would load the whole member, so it is applied to each
+    # tile as it is read instead
+    memberDs = [xr.open_dataset(f, use_cftime=True) for f in inFiles]
+    members = [ds["indicator"] for ds in memberDs]
+    unionIdx = {d: functools.reduce(lambda a, b: a.union(b), [m.indexes[d] for m in members])
+                for d in members[0].indexes if d in grids.nonSpatialDims}
+    isAligned = [all(m.indexes[d].equals(unionIdx[d]) for d in unionIdx) for m in members]
+    # The template describes the layout of the output. Only dimension coordinates are
+    # carried through, as in the xclim engine
+    template = members[0].chunk().reindex(unionIdx)
+    template = template.drop_vars([c for c in template.coords if c not in template.dims])
+    return memberDs, members, unionIdx, isAligned, template
+
+
+def ensembleAttrs(memberDs, template, nMembers):
+    # Attributes of the ensemble statistics, following the xclim engine
+    history = f"Computation of statistics on {nMembers} ensemble members."
+    return {"dataset": {**memberDs[0].attrs,
+                        "history": "\n".join(filter(None, [memberDs[0].attrs.get("history", ""),
+                                                           history]))},
+            "indicator": template.attrs}
+
+
+def readMembers(members, isAligned, unionIdx, template, thisTile, block=None):
+    # Read a tile of each member into a (members x tile) block, aligning the members
+    # on the union of their non-spatial indexes
+    if block is None:
+        tileShape = template.isel(thisTile).shape
+        block = np.empty((len(members),) + tileShape,
+                         dtype=np.result_type(template.dtype, np.float32))
+    tileLabels = {d: template.indexes[d][thisTile.get(d, slice(None))] for d in unionIdx}
+    for i, m in enumerate(members):
+        if isAligned[i]:
+            thisBlock = m.isel(thisTile)
+        else:
+            thisBlock = m.isel({d: s for d, s in thisTile.items() if d not in unionIdx})
+            thisBlock = thisBlock.reindex(tileLabels)
+        block[i] = thisBlock.transpose(*template.dims).values
+    return block
+
+
+def outputWriter(tiles, outFile, template):
+    # Writes the statistics of a tile to the output file. A single tile is the whole
+    # output, and is written directly
+    def writeOutput(thisTile, ensOut):
+        if len(tiles) == 1:
+            ensOut.to_netcdf(outFile[0])
+        else:
+            helpers.writeTile(ensOut, outFile[0], thisTile, template)
+    return writeOutput
+
+
+def getEnsembleStatePath(outFile):
+    # The state of the incremental engine is stored next to the ensemble statistics
+    return os.path.normpath(outFile) + ".members.zarr"
+
+
+def memberSignature(inFile):
+    # Members are identified by their path, and are considered to be replaced when
+    # their size or modification time changes, as in the input catalog
+    st = os.stat(inFile)
+    return [inFile, st.st_size, st.st_mtime]
+
+
+def ensembleLayout(template):
+    # Fingerprint of the layout of the ensemble statistics: the dimensions, their
+    # indexes and the data type. The state can only be updated if this is unchanged
+    h = hashlib.sha1(str((template.dims, str(template.dtype))).encode())
+    for d in template.dims:
+        h.update(str(list(template.indexes[d])).encode())
+    return h.hexdigest()
+
+
+def readEnsembleState(statePath, inFiles):
+    # Members held in the state, in the order of the member stack, and the layout of
+    # the state. The state is discarded if it is missing, was not completed, holds
+    # other statistics, or members have been removed from the ensemble
+    if not os.path.exists(statePath):
+        return [], None
+    with xr.open_zarr(statePath, use_cftime=True) as stateDs:
+        stored = stateDs.attrs.get("members", [])
+        isValid = stateDs.attrs.get("complete", False) and \
+            all(v in stateDs for v in stateStatistics) and \
+            all(s[0] in inFiles for s in stored) and \
+            stateDs.sizes.get("realization", 0) == len(stored)
+        layout = stateDs.attrs.get("layout")
+    if not isValid:
+        return [], None
+    return stored, layout
+
+
+def setStateAttrs(statePath, theseAttrs):
+    # Update the attributes of the state, keeping the consolidated metadata in step
+    zarr.open_group(statePath, mode="a").attrs.update(theseAttrs)
+    zarr.consolidate_metadata(statePath)
+
+
+def incrementalEnsstats(config, inFiles, outFile, threads=1):
+    """
+    Incremental ensemble statistics
+
+    Calculates the ensemble statistics from a state that is kept next to the output
+    file, and updated when members are added to or replaced in the ensemble. The state
+    holds the sufficient statistics of the members (the count, mean, sum of squared
+    deviations from the mean, minimum and maximum) and a stack of the members aligned
+    on the layout of the ensemble, with one chunk per member, from which the
+    percentiles are calculated. Only the new and replaced members are read from their
+    files. The state is rebuilt from all members when members are removed or the
+    layout of the ensemble changes e.g. a new member extends the time axis, or a
+    replacing member shortens it. The output is the same as with the streaming engine,
+    except for rounding in the standard deviation.
+    """
+    percentiles = [x for x in config["ensembles"].values()]
+    statePath = getEnsembleStatePath(outFile[0])
+    signatures = [memberSignature(f) for f in inFiles]
+
+    # Compare the members with those held in the state. Replaced members keep their
+    # place in the stack, and new members are appended to it. All members are opened,
+    # which only reads their metadata, to find the layout of the ensemble, but only
+    # the changed members are read
+    stored, layout = readEnsembleState(statePath, inFiles)
+    storedRows = {s[0]: i for i, s in enumerate(stored)}
+    changed = [i for i, s in enumerate(signatures)
+               if s[0] not in storedRows or stored[storedRows[s[0]]] != s]
+    memberDs, members, unionIdx, isAligned, template = openEnsemble(inFiles)
+    if layout is None or ensembleLayout(template) != layout:
+        # Rebuild the state from all members
+        shutil.rmtree(statePath, ignore_errors=True)
+        stored, storedRows = [], {}
+        changed = list(range(len(inFiles)))
+    replaced = [i for i in changed if inFiles[i] in storedRows]
+    added = [i for i in changed if inFiles[i] not in storedRows]
+    replacedRows = [storedRows[inFiles[i]] for i in replaced]
+    nMembers = len(stored) + len(added)
+    attrs = ensembleAttrs(memberDs, template, nMembers)
+    stackDtype = np.result_type(template.dtype, np.float32)
+    tiles = helpers.budgetTiles(template, config["processing"]["memoryBudget"], threads,
+                                tileDims=template.dims, nLayers=nMembers)
+    writeOutput = outputWriter(tiles, outFile, template)
+
+    # A new state is created empty, and filled tile by tile. The state is chunked to
+    # match the tiles, so that reading a tile only touches the chunks that it needs, up
+    # to a maximum chunk size, and each member of the stack is in separate chunks
+    if len(stored) == 0:
+        chunks = [len(range(template.sizes[d])[tiles[0].get(d, slice(None))])
+                  for d in template.dims]
+        chunks[0] = max(1, min(chunks[0], stateChunkElems // int(np.prod(chunks[1:]))))
+        newState = xr.Dataset({v: (template.dims,
+                                   dask.array.zeros(template.shape, chunks=chunks,
+                                                    dtype=np.int32 if v == "count" else
+                                                    np.float64 if v in ["mean", "m2"] else
+                                                    stackDtype))
+                               for v in stateStatistics},
+                              coords=template.coords)
+        newState["stack"] = (("realization",) + template.dims,
+                             dask.array.zeros((nMembers,) + template.shape,
+                                              chunks=[1] + chunks, dtype=stackDtype))
+        newState.to_zarr(statePath, mode="w", compute=False,
+                         encoding={"stack": stackEncoding})
+
+    # The state is marked as incomplete while it is updated, so that it is rebuilt if
+    # the update is interrupted. New members are appended to the end of the stack. The
+    # state is accessed directly through zarr, as tiles can be small and numerous
+    if len(changed) > 0:
+        setStateAttrs(statePath, {"complete": False})
+    stateGroup = zarr.open_group(statePath, mode="a")
+    stateArrays = {v: stateGroup[v] for v in stateStatistics + ["stack"]}
+    if len(added) > 0:
+        stateArrays["stack"].resize((nMembers,) + template.shape)
+
+    def tileIndex(thisTile):
+        return tuple(thisTile.get(d, slice(None)) for d in template.dims)
+
+    # Each tile is read from the state and from the changed members only. The stack and
+    # the new members are read into a single block, while the replacing members are
+    # kept apart until the contributions of the members they replace are removed
+    def readTile(thisTile):
+        tileShape = template.isel(thisTile).shape
+        block = np.empty((nMembers,) + tileShape, dtype=stackDtype)
+        if len(stored) > 0:
+            block[:len(stored)] = stateArrays["stack"][(slice(0, len(stored)),)
+                                                       + tileIndex(thisTile)]
+            stats = {v: stateArrays[v][tileIndex(thisTile)] for v in stateStatistics}
+        else:
+            stats = {v: np.zeros(tileShape, dtype=stateArrays[v].dtype)
+                     for v in ["count", "mean", "m2"]}
+            stats.update({v: np.full(tileShape, np.nan, dtype=stackDtype) for v in ["min", "max"]})
+        replacing = readMembers([members[i] for i in replaced], [isAligned[i] for i in replaced],
+                                unionIdx, template, thisTile)
+        readMembers([members[i] for i in added], [isAligned[i] for i in added],
+                    unionIdx, template, thisTile, block[len(stored):])
+        return block, stats, replacing
+
+    def calcTile(blocks, thisTile):
+        block, stats, replacing = blocks
+        # Remove the contributions of the replaced members from the moments, and add
+        # those of the new and replacing members
+        for thisBlock, sign in [(block[replacedRows], -1), (replacing, 1),
+                                (block[len(stored):], 1)]:
+            accumulateMoments(thisBlock.reshape(thisBlock.shape[0], stats["count"].size), sign,
+                              stats["count"].reshape(-1), stats["mean"].reshape(-1),
+                              stats["m2"].reshape(-1))
+        block[replacedRows] = replacing
+        # The minimum and maximum are updated with the new members, or taken from the
+        # ensemble if members have been replaced
+        n = stats["count"].reshape(-1)
+        mn, mx, pct = orderStatistics(block.reshape(nMembers, -1), n,
+                                      np.array(percentiles, dtype=float))
+        if len(replaced) > 0:
+            stats["min"] = mn.reshape(stats["min"].shape).astype(stackDtype)
+            stats["max"] = mx.reshape(stats["max"].shape).astype(stackDtype)
+        elif len(added) > 0:
+            stats["min"] = np.fmin(stats["min"], np.fmin.reduce(block[len(stored):], axis=0))
+            stats["max"] = np.fmax(stats["max"], np.fmax.reduce(block[len(stored):], axis=0))
+        # Mean and standard deviation from the moments, in double precision
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(n > 0, stats["mean"].reshape(-1), np.nan)
+            std = np.sqrt(np.maximum(stats["m2"].reshape(-1), 0) / n)
+        ensOut = formatStatistics(mean, std, stats["min"].reshape(-1), stats["max"].reshape(-1),
+                                  pct, template.isel(thisTile), percentiles, attrs)
+        return ensOut, stats, block
+
+    # Outputs are written as they complete, along with the updated statistics and the
+    # changed members of the stack
+    def writeTile(thisTile, res):
+        ensOut, stats, block = res
+        writeOutput(thisTile, ensOut)
+        if len(changed) > 0:
+            for v in stateStatistics:
+                stateArrays[v][tileIndex(thisTile)] = stats[v]
+            for thisRow in replacedRows:
+                stateArrays["stack"][(thisRow,) + tileIndex(thisTile)] = block[thisRow]
+            stateArrays["stack"][(slice(len(stored), nMembers),) + tileIndex(thisTile)] = \
+                block[len(stored):]
+    helpers.processTiles(tiles, readTile, calcTile, writeTile, threads)
+
+    # Record the members of the state
+    if len(changed) > 0:
+        for i in replaced:
+            stored[storedRows[inFiles[i]]] = signatures[i]
+        setStateAttrs(statePath, {"members": stored + [signatures[i] for i in added],
+                                  "layout": ensembleLayout(template), "complete": True})
+    for ds in memberDs:
+        ds.close()
+    helpers.reportPeakMemory()
+
+
+def ensembleTile(block, template, percentiles, attrs):
+    """
+    Ensemble statistics of a tile
+
+    Calculates the ensemble statistics of a (members x tile) block, and returns them as
+    a dataset laid out following the template, in the format of the xclim engine.
+    """
+    mean, std, mn, mx, pct = ensembleStatistics(block.reshape(block.shape[0], -1),
+                                                np.array(percentiles, dtype=float))
+    return formatStatistics(mean, std, mn, mx, pct, template, percentiles, attrs)
+
+
+def formatStatistics(mean, std, mn, mx, pct, template, percentiles, attrs):
+    # Lay out the statistics of a tile following the template, in the format of the
+    # xclim engine
+    outDtype = template.dtype if np.issubdtype(template.dtype, np.floating) else np.float64
+    ensOut = xr.Dataset({f"indicator_{stat}": template.copy(data=vals.reshape(template.shape)
+                                                             .astype(outDtype))
+                         for stat, vals in [("mean", mean), ("stdev", std),
+                                            ("max", mx), ("min", mn)]})
+    # Percentiles are the last dimension, as in xclim
+    ensOut["indicator"] = xr.DataArray(
+        np.moveaxis(pct, 0, -1).reshape(template.shape + (len(percentiles),)).astype(outDtype),
+        dims=template.dims + ("percentiles",),
+        coords={**template.coords, "percentiles": percentiles})
+    for thisVar in ensOut.data_vars:
+        ensOut[thisVar].attrs = attrs["indicator"]
+    ensOut.attrs = attrs["dataset"]
+    return ensOut
+
+
+@njit(nogil=True, cache=True)
+def memberMoments(x):
+    """
+    Ensemble moments
+
+    Calculates the number of valid members, the mean and the standard deviation across
+    the members (rows) of x for each column, skipping missing values. The members are
+    looped over in the outer loop, so that memory is accessed contiguously, and the
+    standard deviation is accumulated in a second pass about the mean, in double
+    precision, as in xarray.
+    """
+    nCols = x.shape[1]
+    n = np.zeros(nCols, dtype=np.int64)
+    mean = np.zeros(nCols)
+    for m in range(x.shape[0]):
+        for c in range(nCols):
+            if not np.isnan(x[m, c]):
+                n[c] += 1
+                mean[c] += x[m, c]
+    for c in range(nCols):
+        mean[c] = mean[c] / n[c] if n[c] > 0 else np.nan
+    var = np.zeros(nCols)
+    for m in range(x.shape[0]):
+        for c in range(nCols):
+            if not np.isnan(x[m, c]):
+                var[c] += (x[m, c] - mean[c])**2
+    std = np.full(nCols, np.nan)
+    for c in range(nCols):
+        if n[c] > 0:
+            std[c] = np.sqrt(var[c] / n[c])
+    return n, mean, std
+
+
+@njit(nogil=True, cache=True)
+def accumulateMoments(x, sign, count, mean, m2):
+    """
+    Accumulate ensemble moments
+
+    Adds (sign 1) or removes (sign -1) the contributions of the members (rows) of x to
+    the count, mean and sum of squared deviations from the mean (m2) of each column, in
+    place, skipping missing values. The moments are updated one member at a time with
+    Welford's method, or its inverse, in double precision. Unlike a sum of squares, this
+    does not lose precision when the spread is small compared with the mean.
+    """
+    for m in range(x.shape[0]):
+        for c in range(x.shape[1]):
+            if not np.isnan(x[m, c]):
+                thisVal = np.float64(x[m, c])
+                count[c] += sign
+                if count[c] == 0:
+                    mean[c] = 0.0
+                    m2[c] = 0.0
+                    continue
+                delta = thisVal - mean[c]
+                mean[c] += sign * delta / count[c]
+                m2[c] += sign * delta * (thisVal - mean[c])
+
+
+def ensembleStatistics(x, percentiles):
+    """
+    Fused ensemble statistics
+
+    Calculates the mean, standard deviation, minimum, maximum and percentiles across the
+    members (rows) of x for each column, skipping missing values.
+    """
+    n, mean, std = memberMoments(x)
+    mn, mx, pct = orderStatistics(x, n, percentiles)
+    return mean, std, mn, mx, pct
+
+
+def orderStatistics(x, n, percentiles):
+    """
+    Ensemble order statistics
+
+    Calculates the minimum, maximum and percentiles across the members (rows) of x for
+    each column, given the number of valid members n. The members of each column are
+    sorted once, with missing values sorted to the end, so that the minimum, maximum
+    and percentiles can be read directly from the first n valid values. Percentiles are
+    interpolated linearly between the order statistics, as in numpy and xclim.
+    """
+    srt = np.sort(x, axis=0)
+    cols = np.arange(x.shape[1])
+    hasData = n > 0
+    last = np.maximum(n - 1, 0)
+    mn = np.where(hasData, srt[0], np.nan)
+    mx = np.where(hasData, srt[last, cols], np.nan)
+    pos = percentiles[:, None] / 100 * last
+    lo = np.floor(pos).astype(int)
+    hi = np.minimum(lo + 1, last)
+    pct = srt[lo, cols] + (srt[hi, cols].astype(np.float64) - srt[lo, cols]) * (pos - lo)
+    pct[:, ~hasData] = np.nan
+    return mn, mx, pct
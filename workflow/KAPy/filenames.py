@@ -0,0 +1,57 @@
+# Filename schema used throughout KAPy
+#
+# All files generated by KAPy follow the convention
+#    <varID>_<srcID>_<gridID>_<expt>_<stems><ext>
+# where the variable ID is replaced by the indicator ID once indicators have been
+# calculated, the grid ID is replaced by the output grid name after regridding, and
+# the stems become "ensstats" for ensemble statistics. This module provides the
+# single definition of that convention, parsing and formatting filenames in bulk.
+
+import re
+import os
+import pandas as pd
+
+filenameFields = ["varID", "srcID", "gridID", "expt", "stems"]
+
+filenamePattern = re.compile(
+    r"^(?P<varID>[^_]+)_(?P<srcID>[^_]+)_(?P<gridID>[^_]+)_(?P<expt>[^_]+)_"
+    + r"(?P<stems>.+?)(?P<ext>\.nc(?:\.pkl|\.zarr)?|\.csv)$"
+)
+
+
+def parseFilenames(paths):
+    """
+    Parse filenames
+
+    Splits a list of paths following the KAPy filename convention into its fields.
+    Returns a dataframe with the path, filename, one categorical column per field,
+    and the file extension. Paths that do not follow the convention give missing values.
+    """
+    thisTbl = pd.DataFrame({"path": list(paths)}, dtype="object")
+    thisTbl["fname"] = thisTbl["path"].map(os.path.basename)
+    fields = thisTbl["fname"].str.extract(filenamePattern)
+    # Most of the fields take only a few distinct values, so categoricals are both
+    # more compact and faster to compare and group
+    fields[filenameFields] = fields[filenameFields].astype("category")
+    return pd.concat([thisTbl, fields], axis=1)
+
+
+def formatFilenames(tbl, **fields):
+    """
+    Format filenames
+
+    Builds filenames following the KAPy filename convention from a dataframe of
+    fields (e.g. as returned by parseFilenames). Individual fields can be overridden
+    by keyword arguments, with either scalars or columns as values.
+    """
+    theseFields = {f: fields.get(f, tbl[f] if f in tbl else None)
+                   for f in filenameFields + ["ext"]}
+    if theseFields["ext"] is None:
+        theseFields["ext"] = ".nc"
+    # Convert to strings, so that categoricals and scalars can be concatenated
+    theseFields = {k: v.astype(str) if isinstance(v, pd.Series) else str(v)
+                   for k, v in theseFields.items()}
+    fname = theseFields["varID"]
+    for f in filenameFields[1:]:
+        fname = fname + "_" + theseFields[f]
+    return fname + theseFields["ext"]
@@ -0,0 +1,446 @@
+"""
+#Setup for debugging with VS Code
+import os
+print(os.getcwd())
+os.chdir("..")
+import KAPy
+os.chdir("..")
+config=KAPy.getConfig("./config/config.yaml")
+srcDat=KAPy.readFile(histSimFile)
+tgtDat=KAPy.readFile(refFile)
+"""
+
+# Registry of grids and grid-derived quantities. Each horizontal grid is identified by a
+# fingerprint of its coordinates, and has a store on disk holding the quantities derived
+# from it (cell areas, region masks, and the regridding weights and nearest-neighbour
+# indices onto other grids). These are calculated once per grid, or pair of grids, and
+# then reused by every file on the same grids.
+import os
+import sys
+import numpy as np
+import xarray as xr
+import scipy.sparse
+from scipy.spatial import cKDTree
+from . import helpers
+from .catalog import gridHash
+
+# Dimensions that are not part of the horizontal grid
+nonSpatialDims = ["time", "periodID", "season", "percentiles"]
+
+# Names used to identify longitude and latitude coordinates, in addition to their
+# standard_name attribute
+lonNames = ["lon", "longitude", "long", "nav_lon"]
+latNames = ["lat", "latitude", "nav_lat"]
+
+# Grid artefacts, cached in memory by path, so that a process handling many files only
+# reads them once
+artefactMemo = {}
+
+
+def getGridCachePath(config):
+    # Location of the cache of grid-derived quantities. Defaults to the variables directory
+    if config["processing"]["gridCache"] != "":
+        return config["processing"]["gridCache"]
+    return os.path.join(config["dirs"]["variables"], "gridCache")
+
+
+def spatialDims(this):
+    # The horizontal dimensions of a dataset are all those that are not time, period etc
+    return [d for d in this.dims if d not in nonSpatialDims]
+
+
+def gridCoords(this):
+    # The coordinates of a dataset that describe its horizontal grid
+    return {c: this[c] for c in this.coords
+            if this[c].ndim > 0 and not any(d in nonSpatialDims for d in this[c].dims)}
+
+
+def gridFingerprint(this):
+    # Fingerprint of the horizontal grid of a dataset. Coordinates along the non-spatial
+    # dimensions are ignored, so that e.g. period and time-based files on the same grid
+    # share the same fingerprint. Floating point coordinates are hashed in double
+    # precision, so that the same grid stored in single or double precision matches
+    theseCoords = {c: v.astype(np.float64) if np.issubdtype(v.dtype, np.floating) else v
+                   for c, v in gridCoords(this).items()}
+    return gridHash(xr.Dataset(coords=theseCoords))
+
+
+def gridStore(config, this):
+    """
+    Get grid store
+
+    Registers the horizontal grid of a dataset, and returns the directory in which the
+    quantities derived from it are stored. The directory is named by the fingerprint of
+    the grid, and holds a copy of the grid coordinates (`grid.nc`) for reference.
+    """
+    storeDir = os.path.join(getGridCachePath(config), gridFingerprint(this))
+    gridPath = os.path.join(storeDir, "grid.nc")
+    if not os.path.exists(gridPath):
+        os.makedirs(storeDir, exist_ok=True)
+        helpers.atomicWrite(gridPath, xr.Dataset(coords=gridCoords(this)).to_netcdf)
+    return storeDir
+
+
+def getGridArtefact(config, this, name, builder):
+    """
+    Get grid artefact
+
+    Returns a quantity derived from the grid of a dataset from the grid store, calling
+    builder() to calculate it if it is not there yet. The storage format follows the
+    extension of the name: `.npy` for arrays, `.npz` for sparse matrices and `.nc` for
+    dataarrays.
+    """
+    artefactPath = os.path.join(gridStore(config, this), name)
+    if artefactPath in artefactMemo:
+        return artefactMemo[artefactPath]
+    ext = os.path.splitext(name)[1]
+    if not os.path.exists(artefactPath):
+        artefact = builder()
+        if ext == ".npy":
+            helpers.atomicWrite(artefactPath, lambda tmpPath: np.save(tmpPath, artefact))
+        elif ext == ".npz":
+            helpers.atomicWrite(artefactPath, lambda tmpPath: scipy.sparse.save_npz(tmpPath, artefact))
+        elif ext == ".nc":
+            helpers.atomicWrite(artefactPath, artefact.to_netcdf)
+        else:
+            sys.exit(f"Unsupported grid artefact format '{ext}'.")
+
+    # Read back from the store
+    if ext == ".npy":
+        artefactMemo[artefactPath] = np.load(artefactPath)
+    elif ext == ".npz":
+        artefactMemo[artefactPath] = scipy.sparse.load_npz(artefactPath).tocsr()
+    else:
+        with xr.open_dataarray(artefactPath) as da:
+            artefactMemo[artefactPath] = da.load()
+
+    # Dataarrays are given the grid coordinates of this dataset, which can differ in
+    # precision from those of the dataset that the artefact was built from
+    if ext == ".nc":
+        artefact = artefactMemo[artefactPath]
+        return artefact.assign_coords({c: v for c, v in gridCoords(this).items()
+                                       if c in artefact.coords})
+    return artefactMemo[artefactPath]
+
+
+def sameGrid(srcDat, tgtDat):
+    # Two datasets are on the same grid if their fingerprints match
+    return gridFingerprint(srcDat) == gridFingerprint(tgtDat)
+
+
+def getLonLat(this):
+    """
+    Get longitude and latitude coordinates
+
+    Identifies the longitude and latitude coordinates of a dataset or data array, by
+    their name or their standard_name attribute. These can be either 1D coordinates,
+    or 2D auxiliary coordinates as used on curvilinear and rotated-pole grids.
+    """
+    rtn = []
+    for names, standardName in [(lonNames, "longitude"), (latNames, "latitude")]:
+        matches = [c for c in this.coords
+                   if c in names or this[c].attrs.get("standard_name", "") == standardName]
+        if len(matches) == 0:
+            sys.exit(f"Cannot identify the {standardName} coordinate of the grid. "
+                     + f"Available coordinates are {list(this.coords)}.")
+        rtn.append(this[matches[0]])
+    return tuple(rtn)
+
+
+def lonLat(this):
+    """
+    Get longitude and latitude
+
+    Returns the longitude and latitude of each grid cell of a dataset as 2D arrays,
+    ordered following the spatial dimensions. Both curvilinear (2D) and rectilinear
+    (1D) coordinates are supported.
+    """
+    theseDims = spatialDims(this)
+    lon, lat = getLonLat(this)
+    # Broadcasting against each other expands rectilinear coordinates to 2D
+    lon, lat = xr.broadcast(lon, lat)
+    return (lon.transpose(*theseDims).values, lat.transpose(*theseDims).values)
+
+
+def toCartesian(lon, lat):
+    # Convert longitude and latitude in degrees to points on the unit sphere. Distances
+    # are then free of problems with the dateline and the poles
+    lonRad = np.deg2rad(np.ravel(lon))
+    latRad = np.deg2rad(np.ravel(lat))
+    return np.column_stack([np.cos(latRad) * np.cos(lonRad),
+                            np.cos(latRad) * np.sin(lonRad),
+                            np.sin(latRad)])
+
+
+def nearestNeighbourIndex(config, srcDat, tgtDat):
+    """
+    Get nearest neighbour index
+
+    Returns, for each cell of the target grid (flattened), the index of the nearest
+    cell of the source grid (flattened). The index is calculated with a KD-tree over the
+    cell centres, and is stored with the source grid for each target grid.
+    """
+    def buildIndex():
+        tree = cKDTree(toCartesian(*lonLat(srcDat)))
+        _, nnIdx = tree.query(toCartesian(*lonLat(tgtDat)))
+        return nnIdx.astype(np.int64)
+    return getGridArtefact(config, srcDat, f"nn_{gridFingerprint(tgtDat)}.npy", buildIndex)
+
+
+def remapNearest(config, srcDat, tgtDat):
+    """
+    Nearest neighbour remapping
+
+    Remaps a dataarray onto the grid of tgtDat, taking the value of the nearest source
+    grid cell. The remapping is applied as a single vectorised gather.
+    """
+    nnIdx = nearestNeighbourIndex(config, srcDat, tgtDat)
+    srcDims = spatialDims(srcDat)
+    tgtDims = spatialDims(tgtDat)
+    tgtShape = [tgtDat.sizes[d] for d in tgtDims]
+
+    # Convert the flat index into an index along each of the source dimensions, laid
+    # out on the target grid. Indexing with these gathers all target cells at once.
+    # The source grid coordinates are dropped first, as they are replaced by those
+    # of the target. The gather is lazy, so that the source can be read tile by tile
+    srcIdx = np.unravel_index(nnIdx, [srcDat.sizes[d] for d in srcDims])
+    indexers = {d: xr.DataArray(i.reshape(tgtShape), dims=tgtDims)
+                for d, i in zip(srcDims, srcIdx)}
+    srcNoGrid = srcDat.drop_vars([c for c in srcDat.coords if "time" not in srcDat[c].dims])
+    dout = srcNoGrid.isel(indexers).transpose("time", *tgtDims)
+
+    # Add the grid of the target
+    dout = dout.assign_coords({c: tgtDat[c] for c in tgtDat.coords
+                               if "time" not in tgtDat[c].dims})
+    return dout
+
+
+def parseGriddes(griddes):
+    # Parse the key = value pairs of a CDO grid descriptor file. Values such as xvals can
+    # continue over several lines
+    entries = {}
+    thisKey = None
+    with open(griddes) as f:
+        for thisLine in f:
+            thisLine = thisLine.split("#")[0].strip()
+            if thisLine == "":
+                continue
+            if "=" in thisLine:
+                thisKey, thisLine = [x.strip() for x in thisLine.split("=", 1)]
+                entries[thisKey] = []
+            entries[thisKey] += thisLine.split()
+    return entries
+
+
+def outputGrid(config):
+    # The output grid as a dataset, where it can be constructed from the grid descriptor
+    # i.e. for regular longitude-latitude grids. Otherwise None
+    griddes = config["outputGrid"]["cdoGriddes"]
+    if os.path.isfile(griddes) and parseGriddes(griddes).get("gridtype", [""])[0] == "lonlat":
+        return readGriddes(griddes)
+    return None
+
+
+def readGriddes(griddes):
+    """
+    Read grid descriptor
+
+    Builds the target grid described by a CDO grid descriptor file, as a dataset with
+    longitude and latitude coordinates. Only regular longitude-latitude grids
+    (`gridtype = lonlat`) are supported, given either as `xfirst` / `xinc` or as
+    explicit `xvals` (and likewise for y).
+    """
+    if not os.path.isfile(griddes):
+        sys.exit(f"Cannot find grid descriptor file '{griddes}'. The sparse regridding "
+                 + "engine requires a grid descriptor file, rather than a predefined grid.")
+    entries = parseGriddes(griddes)
+    if entries.get("gridtype", [""])[0] != "lonlat":
+        sys.exit(f"Unsupported grid type in '{griddes}'. The sparse regridding engine "
+                 + "supports only regular longitude-latitude grids (gridtype = lonlat).")
+
+    def axisValues(axis):
+        if f"{axis}vals" in entries:
+            return np.array(entries[f"{axis}vals"], dtype=float)
+        n = int(entries[f"{axis}size"][0])
+        first = float(entries.get(f"{axis}first", ["0"])[0])
+        inc = float(entries.get(f"{axis}inc", ["1"])[0])
+        return first + inc * np.arange(n)
+
+    # Build grid, following the naming in the grid descriptor
+    xname = entries.get("xname", ["lon"])[0]
+    yname = entries.get("yname", ["lat"])[0]
+    tgtGrid = xr.Dataset(coords={
+        yname: (yname, axisValues("y"),
+                {"standard_name": "latitude", "units": "degrees_north"}),
+        xname: (xname, axisValues("x"),
+                {"standard_name": "longitude", "units": "degrees_east"})})
+    return tgtGrid
+
+
+def rectilinearAxes(this):
+    # The longitude and latitude axes of a rectilinear grid, as (dimension, values)
+    # pairs, or None if the grid is not rectilinear
+    lon, lat = getLonLat(this)
+    if lon.ndim != 1 or lat.ndim != 1 or lon.dims == lat.dims:
+        return None
+    return (lon.dims[0], lon.values.astype(float)), (lat.dims[0], lat.values.astype(float))
+
+
+def cellEdges(centres):
+    # Edges of the cells of a rectilinear axis, half way between the cell centres and
+    # extrapolated by half a cell at the ends
+    mids = (centres[1:] + centres[:-1]) / 2
+    if len(centres) == 1:
+        return np.array([centres[0] - 0.5, centres[0] + 0.5])
+    return np.concatenate([[2 * centres[0] - mids[0]], mids, [2 * centres[-1] - mids[-1]]])
+
+
+def overlapMatrix(tgtEdges, srcEdges, periodic):
+    # Length of the overlap of each target interval (rows) with each source interval
+    # (columns). Periodic axes (longitude) are compared modulo 360
+    tgtLo = np.minimum(tgtEdges[:-1], tgtEdges[1:])[:, None]
+    tgtHi = np.maximum(tgtEdges[:-1], tgtEdges[1:])[:, None]
+    srcLo = np.minimum(srcEdges[:-1], srcEdges[1:])[None, :]
+    srcHi = np.maximum(srcEdges[:-1], srcEdges[1:])[None, :]
+    overlap = np.zeros((tgtLo.shape[0], srcLo.shape[1]))
+    for shift in ([-360, 0, 360] if periodic else [0]):
+        overlap += np.clip(np.minimum(tgtHi, srcHi + shift) - np.maximum(tgtLo, srcLo + shift),
+                           0, None)
+    return overlap
+
+
+def conservativeWeights(srcDat, tgtDat):
+    """
+    Conservative regridding weights
+
+    First-order conservative weights between two rectilinear longitude-latitude grids,
+    as a sparse matrix with one row per target cell and one column per source cell.
+    Each weight is the fraction of the target cell covered by the source cell. Areas on
+    the sphere factorise into the overlap in longitude and the overlap in the sine of
+    latitude, so the weights are the product of two one-dimensional overlaps.
+    """
+    srcAxes = rectilinearAxes(srcDat)
+    tgtAxes = rectilinearAxes(tgtDat)
+    if srcAxes is None or tgtAxes is None:
+        sys.exit("Conservative regridding with the sparse engine requires rectilinear "
+                 + "longitude-latitude grids. Use bilinear regridding instead.")
+    (srcLonDim, srcLon), (srcLatDim, srcLat) = srcAxes
+    (tgtLonDim, tgtLon), (tgtLatDim, tgtLat) = tgtAxes
+
+    # One dimensional overlaps, normalised by the size of the target cells
+    def sinEdges(lat):
+        return np.sin(np.deg2rad(np.clip(cellEdges(lat), -90, 90)))
+    lonOverlap = overlapMatrix(cellEdges(tgtLon), cellEdges(srcLon), True)
+    lonOverlap /= np.abs(np.diff(cellEdges(tgtLon)))[:, None]
+    latOverlap = overlapMatrix(sinEdges(tgtLat), sinEdges(srcLat), False)
+    latOverlap /= np.abs(np.diff(sinEdges(tgtLat)))[:, None]
+
+    # Combine the overlaps following the order of the dimensions of the grids. The
+    # Kronecker product gives the weights with the latitude dimension varying slowest.
+    # Grids stored as (lon, lat) are reordered by taking, for each of their cells in
+    # turn, the matching (lat, lon) row or column
+    weights = scipy.sparse.kron(scipy.sparse.csr_matrix(latOverlap),
+                                scipy.sparse.csr_matrix(lonOverlap), format="csr")
+    if spatialDims(srcDat) != [srcLatDim, srcLonDim]:
+        perm = np.arange(len(srcLat) * len(srcLon)).reshape(len(srcLat), len(srcLon)).T.ravel()
+        weights = weights[:, perm]
+    if spatialDims(tgtDat) != [tgtLatDim, tgtLonDim]:
+        perm = np.arange(len(tgtLat) * len(tgtLon)).reshape(len(tgtLat), len(tgtLon)).T.ravel()
+        weights = weights[perm, :]
+    return weights
+
+
+def bilinearWeights(srcDat, tgtDat):
+    """
+    Bilinear regridding weights
+
+    Bilinear interpolation weights from a (possibly curvilinear) source grid to a target
+    grid, as a sparse matrix with one row per target cell and one column per source
+    cell. Each target point is located in a quadrilateral of four neighbouring source
+    cell centres, and its weights found by inverting the bilinear mapping of the
+    quadrilateral in longitude-latitude space. Target points outside of the source grid
+    are given no weights.
+    """
+    srcLon, srcLat = lonLat(srcDat)
+    tgtLon, tgtLat = [np.ravel(x) for x in lonLat(tgtDat)]
+    srcShape = srcLon.shape
+    if len(srcShape) != 2:
+        sys.exit("Bilinear regridding with the sparse engine requires a two dimensional "
+                 + "source grid.")
+    srcXYZ = toCartesian(srcLon, srcLat).reshape(srcShape + (3,))
+
+    # Build the quadrilaterals between neighbouring cell centres. Axes that wrap around
+    # the globe, where the first and last cells are neighbours, get an extra quadrilateral
+    quadIdx = []
+    for axis in [0, 1]:
+        stepDist = np.linalg.norm(np.diff(srcXYZ, axis=axis), axis=-1)
+        wrapDist = np.linalg.norm(np.take(srcXYZ, 0, axis=axis)
+                                  - np.take(srcXYZ, -1, axis=axis), axis=-1)
+        isCyclic = srcShape[axis] > 2 and np.all(wrapDist <= 1.5 * np.median(stepDist))
+        quadIdx.append(np.arange(srcShape[axis] - (0 if isCyclic else 1)))
+    j0, i0 = [x.ravel() for x in np.meshgrid(*quadIdx, indexing="ij")]
+    j1 = (j0 + 1) % srcShape[0]
+    i1 = (i0 + 1) % srcShape[1]
+    corners = np.stack([np.ravel_multi_index((j0, i0), srcShape),
+                        np.ravel_multi_index((j0, i1), srcShape),
+                        np.ravel_multi_index((j1, i1), srcShape),
+                        np.ravel_multi_index((j1, i0), srcShape)], axis=1)
+
+    # Candidate quadrilaterals for each target point are the ones with the nearest centres
+    nCandidates = min(8, corners.shape[0])
+    quadCentres = srcXYZ.reshape(-1, 3)[corners].mean(axis=1)
+    _, candidates = cKDTree(quadCentres).query(toCartesian(tgtLon, tgtLat), k=nCandidates)
+    candidates = candidates.reshape(len(tgtLon), nCandidates)
+
+    # Invert the bilinear mapping of each candidate with Newton iterations. Longitudes are
+    # taken relative to the target point, to avoid problems at the dateline
+    lonC = srcLon.ravel()[corners[candidates]] - tgtLon[:, None, None]
+    lonC = (lonC + 180) % 360 - 180
+    latC = srcLat.ravel()[corners[candidates]] - tgtLat[:, None, None]
+    s = np.full(candidates.shape, 0.5)
+    t = np.full(candidates.shape, 0.5)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for _ in range(20):
+            w = np.stack([(1 - s) * (1 - t), s * (1 - t), s * t, (1 - s) * t], axis=-1)
+            dws = np.stack([-(1 - t), 1 - t, t, -t], axis=-1)
+            dwt = np.stack([-(1 - s), -s, s, 1 - s], axis=-1)
+            fx, fy = (w * lonC).sum(-1), (w * latC).sum(-1)
+            jxs, jxt = (dws * lonC).sum(-1), (dwt * lonC).sum(-1)
+            jys, jyt = (dws * latC).sum(-1), (dwt * latC).sum(-1)
+            det = jxs * jyt - jxt * jys
+            s = s - (fx * jyt - fy * jxt) / det
+            t = t - (fy * jxs - fx * jys) / det
+    eps = 1e-6
+    inside = (s >= -eps) & (s <= 1 + eps) & (t >= -eps) & (t <= 1 + eps)
+
+    # Use the first (nearest) candidate that contains the target point
+    found = inside.any(axis=1)
+    first = np.argmax(inside, axis=1)
+    tgtIdx = np.flatnonzero(found)
+    sF = np.clip(s[tgtIdx, first[tgtIdx]], 0, 1)
+    tF = np.clip(t[tgtIdx, first[tgtIdx]], 0, 1)
+    w = np.stack([(1 - sF) * (1 - tF), sF * (1 - tF), sF * tF, (1 - sF) * tF], axis=1)
+    cols = corners[candidates[tgtIdx, first[tgtIdx]]]
+    weights = scipy.sparse.csr_matrix((w.ravel(), (np.repeat(tgtIdx, 4), cols.ravel())),
+                                      shape=(len(tgtLon), srcLon.size))
+    # Corners with zero weight should not be able to mask the result
+    weights.eliminate_zeros()
+    return weights
+
+
+def getRegriddingWeights(config, srcDat, tgtDat, method):
+    """
+    Get regridding weights
+
+    Returns the sparse matrix of regridding weights from the grid of srcDat to the grid
+    of tgtDat. The weights are calculated once for each pair of grids and method, and
+    stored with the source grid.
+    """
+    if method == "bilinear":
+        builder = bilinearWeights
+    elif method == "conservative":
+        builder = conservativeWeights
+    else:
+        sys.exit(f'Unsupported regridding method "{method}".')
+    return getGridArtefact(config, srcDat, f"{method}_{gridFingerprint(tgtDat)}.npz",
+                           lambda: builder(srcDat, tgtDat))
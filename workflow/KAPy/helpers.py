@@ -6,29 +6,215 @@ thisPath='outputs/1.primVars/pr_KA-ba_rcp26_EUR-11_CCCma-CanESM2r1i1p1_CLMcom-CC
 """
 
 import pickle
+import weakref
+import resource
+import itertools
+import sys
+import dask
+import netCDF4
 import xarray as xr
+import numpy as np
+import pandas as pd
+import cftime
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Integer time codes, cached per time index. Entries are dropped automatically when
+# the index is garbage collected
+timeCodeCache = {}
+
+# Ratio of the working memory needed to process a tile to the size of the tile itself.
+# Allows for the intermediate copies made during season selection, preparation and
+# reduction of the data
+workingSetFactor = 4
 
 
 def readFile(thisPath,format=None):
     # Reads a dataset from disk, determining dynmaically whether it is
-    # pickled or NetCDF based on the file extension
+    # pickled, NetCDF or a Zarr store based on the file extension
     if format==None:
-        format = os.path.splitext(os.path.basename(thisPath))[1]
+        format = os.path.splitext(os.path.basename(os.path.normpath(thisPath)))[1]
     if format == ".nc":
         thisDat = xr.open_dataarray(thisPath,
                                     use_cftime=True)
     elif format == ".pkl":  # Read pickle
         with open(thisPath, "rb") as f:
             thisDat = pickle.load(f)
+    elif format == ".zarr":  # Read Zarr store lazily, using the chunking on disk
+        thisDat = xr.open_dataarray(thisPath,
+                                    engine="zarr",
+                                    chunks={},
+                                    use_cftime=True)
     else:
         raise IOError(f"Unknown file format, '{format}' inferred from: '{thisPath}'.")
     return thisDat
 
 
+def budgetTiles(this,memoryBudget,threads=1,tileDims=None,nLayers=1):
+    # Splits the data into tiles that can each be processed within the memory budget,
+    # which is shared between the tiles that are processed at once by a pool of threads.
+    # Most statistics reduce along time only, so by default the full time axis is kept
+    # in each tile and the data is tiled in space instead. Other dimensions can be tiled
+    # by giving tileDims, and each tile can hold several layers of the data (e.g. the
+    # members of an ensemble). Intermediates are typically double precision, so this is
+    # assumed in the sizing. If no memory budget is set, there is one tile per thread,
+    # split along the first tiled dimension. Returns a list of dicts of slices
+    if tileDims is None:
+        tileDims = [d for d in this.dims if d != "time"]
+    if memoryBudget == "":
+        splitDim = tileDims[0]
+        splits = np.array_split(np.arange(this.sizes[splitDim]),
+                                min(threads, this.sizes[splitDim]))
+        return [{splitDim: slice(int(s[0]), int(s[-1]) + 1)} for s in splits]
+    budget = dask.utils.parse_bytes(memoryBudget) / threads / workingSetFactor
+    bytesPerCell = max(1, int(np.prod([this.sizes[d] for d in this.dims if d not in tileDims]))) \
+        * nLayers * max(this.dtype.itemsize, 8)
+    cellsPerTile = max(1, int(budget // bytesPerCell))
+    if budget < bytesPerCell:
+        print(f"Warning: the data of a single grid cell ({bytesPerCell} bytes) "
+              + f"exceeds the memory budget of {memoryBudget}.")
+    # Fill the tile from the last (fastest varying) dimension backwards
+    tileSizes = {}
+    for thisDim in reversed(tileDims):
+        tileSizes[thisDim] = min(this.sizes[thisDim], cellsPerTile)
+        cellsPerTile = max(1, cellsPerTile // this.sizes[thisDim])
+    tileStarts = [range(0, this.sizes[d], tileSizes[d]) for d in tileDims]
+    return [{d: slice(s, s + tileSizes[d]) for d, s in zip(tileDims, theseStarts)}
+            for theseStarts in itertools.product(*tileStarts)]
+
+
+def processTiles(tiles,readTile,calcTile,writeTile,threads):
+    # Processes tiles in a pool of threads. Tiles are read and written in order by the
+    # main thread, as the netCDF library is not thread-safe, while calcTile runs in the
+    # pool. Only a limited number of tiles is in flight at once, to bound memory usage
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = deque()
+        for thisTile in tiles:
+            pending.append((thisTile, pool.submit(calcTile, readTile(thisTile), thisTile)))
+            if len(pending) >= threads:
+                doneTile, doneRes = pending.popleft()
+                writeTile(doneTile, doneRes.result())
+        while pending:
+            doneTile, doneRes = pending.popleft()
+            writeTile(doneTile, doneRes.result())
+
+
+def atomicWrite(outPath, writer):
+    # Write a file atomically, as several jobs may build the same cached file at once.
+    # writer(tmpPath) writes the contents to a temporary file, which keeps the extension
+    # of outPath, and this is then moved into place. Readers therefore see either no
+    # file or the complete file, never a partially written one
+    tmpPath = f"{outPath}.{os.getpid()}.tmp{os.path.splitext(outPath)[1]}"
+    try:
+        writer(tmpPath)
+        os.replace(tmpPath, outPath)
+    finally:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+
+
+def writeTile(this,outPath,thisTile,fullDat,encoding=None):
+    # Writes the results from a tile into the corresponding region of an output file.
+    # The file is created from the first tile, padded lazily to the full spatial extent
+    # of fullDat so that the full output is never held in memory, and with the given
+    # encoding, which the following tiles then follow. Compressed variables are
+    # chunked by tile, so that each tile is compressed once rather than rewritten into
+    # chunks that span several tiles
+    isFirst = all(thisSlice.start == 0 for thisSlice in thisTile.values())
+    if isFirst:
+        encoding = {v: dict(thisEnc) for v, thisEnc in (encoding or {}).items()}
+        for thisVar, thisEnc in encoding.items():
+            if thisEnc.get("zlib") and "chunksizes" not in thisEnc:
+                thisEnc["chunksizes"] = tuple(this[thisVar].sizes[d] for d in this[thisVar].dims)
+        padWidths = {d: (0, fullDat.sizes[d] - this.sizes[d]) for d in thisTile}
+        padded = this.chunk().pad(padWidths)
+        # Padding promotes integers to floats, so revert these
+        if isinstance(this, xr.Dataset):
+            for thisVar in this.data_vars:
+                if this[thisVar].dtype.kind in "iu":
+                    padded[thisVar] = padded[thisVar].fillna(0).astype(this[thisVar].dtype)
+        # Restore the coordinates along the tiled dimensions, which are padded with
+        # missing values
+        padded = padded.assign_coords({c: fullDat[c] for c in fullDat.coords
+                                       if set(fullDat[c].dims) & set(thisTile)
+                                       and set(fullDat[c].dims) <= set(padded.dims)})
+        padded.to_netcdf(outPath, encoding=encoding)
+    else:
+        thisDs = this.to_dataset() if isinstance(this, xr.DataArray) else this
+        with netCDF4.Dataset(outPath, "a") as nc:
+            for thisVar in thisDs.data_vars:
+                ncVar = nc.variables[thisVar]
+                region = tuple(thisTile.get(d, slice(None)) for d in ncVar.dimensions)
+                ncVar[region] = thisDs[thisVar].transpose(*ncVar.dimensions).values
+
+
+def reportPeakMemory():
+    # Report the peak resident set size of the process. Note that ru_maxrss is
+    # given in kilobytes on Linux, but bytes on macOS
+    peakRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peakMB = peakRSS / 1024**2 if sys.platform == "darwin" else peakRSS / 1024
+    print(f"Peak memory usage (RSS): {peakMB:.0f} MB")
+
+
+def timeCodes(this):
+    # Returns the year, month and day of each timestep as integer arrays. Extracting
+    # these from cftime objects is slow, so it is done once and cached for each time index
+    thisIdx = this.indexes["time"]
+    key = id(thisIdx)
+    if key not in timeCodeCache:
+        timeCodeCache[key] = {"year": np.asarray(thisIdx.year, dtype=int),
+                              "month": np.asarray(thisIdx.month, dtype=int),
+                              "day": np.asarray(thisIdx.day, dtype=int)}
+        weakref.finalize(thisIdx, timeCodeCache.pop, key, None)
+    return timeCodeCache[key]
+
+
+def seasonMask(this,months):
+    # Boolean mask of the timesteps falling within the months of a season
+    return np.isin(timeCodes(this)["month"], months)
+
+
+def midMonthTimes(years,months):
+    # Construct the middle of the month (the 15th) as cftime Gregorian datetimes.
+    # The dates are calculated as integer day counts and converted in one call
+    thisMonths = (np.asarray(years) - 1970) * 12 + (np.asarray(months) - 1)
+    dayCounts = thisMonths.astype("datetime64[M]").astype("datetime64[D]").astype(int) + 14
+    return cftime.num2date(dayCounts, "days since 1970-01-01", calendar="standard",
+                           only_use_cftime_datetimes=True)
+
+
 def timeslice(this,startYr,endYr):
     # Slice dataset
-    timemin = this.time.dt.year >= int(startYr)
-    timemax = this.time.dt.year <= int(endYr)
-    sliced = this.sel(time=timemin & timemax)
+    years = timeCodes(this)["year"]
+    sliced = this.isel(time=(years >= int(startYr)) & (years <= int(endYr)))
     return sliced
+
+
+def periodMembership(this,periods,seasons=None):
+    # Build a (time x periodID) matrix, indicating whether each timestep falls
+    # within each of the periods. Periods can overlap. If a dict of season months is
+    # given, the season masks are folded in as well, giving a (time x season x periodID)
+    # matrix
+    years = timeCodes(this)["year"]
+    periodIDs = [p["id"] for p in periods.values()]
+    members = np.stack([(years >= int(p["start"])) & (years <= int(p["end"]))
+                        for p in periods.values()], axis=1)
+    dims = ["time","periodID"]
+    coords = {"time":this.time,"periodID":periodIDs}
+    if seasons is not None:
+        inSeason = np.stack([seasonMask(this, m) for m in seasons.values()], axis=1)
+        members = inSeason[:, :, np.newaxis] & members[:, np.newaxis, :]
+        dims = ["time","season","periodID"]
+        coords["season"] = list(seasons.keys())
+    return xr.DataArray(members.astype(this.dtype if this.dtype.kind == "f" else "float64"),
+                        dims=dims,
+                        coords=coords)
+
+
+def combineSeasons(douts,seasons):
+    # Combine indicators calculated for each season along a season dimension. A
+    # single season is returned as is, without a season dimension
+    if len(seasons) == 1:
+        return douts[0]
+    return xr.concat(douts, dim=pd.Index(seasons, name="season"))
@@ -16,90 +16,231 @@ import matplotlib.pyplot as plt
 
 """
 
-import xarray as xr
-import numpy as np
-import pandas as pd
 import sys
-import cftime
+import dask
+import xarray as xr
 from . import helpers 
+from . import kernels
+from . import aggregates
 
 def calculateIndicators(config, inFile, outFile, indID):
 
+    # Use the cache of monthly aggregates, if requested and possible
+    if config["processing"]["aggregationCache"] and \
+       config["indicators"][indID]["statistic"] in aggregates.aggregateStatistics:
+        monthlyAggregates = aggregates.getMonthlyAggregates(config, inFile[0])
+        dout = computeIndicator(config, None, indID, monthlyAggregates=monthlyAggregates)
+        dout.to_netcdf(outFile[0])
+    # If a memory budget is set, stream the data through in tiles
+    elif config["processing"]["memoryBudget"] != "":
+        streamIndicators(config, inFile[0], outFile, [indID])
+    else:
+        # Read the dataset object back from disk, depending on the configuration
+        thisDat = helpers.readFile(inFile[0])
+
+        # Calculate and write out
+        dout = computeIndicator(config, thisDat, indID)
+        dout.to_netcdf(outFile[0])
+    helpers.reportPeakMemory()
+
+
+def calculateIndicatorSet(config, inFile, outFile, indIDs):
+    """
+    Calculate a set of indicators from one file
+
+    Calculates all of the indicators in indIDs from a single input file, which
+    is read once. Season selections are shared between indicators, and all outputs
+    are evaluated together as a single dask graph. outFile should give the output
+    files in the same order as indIDs.
+    """
+    # Use the cache of monthly aggregates, if requested. The original data then
+    # only needs to be read if there are indicators that cannot be calculated from it
+    monthlyAggregates = None
+    needsData = indIDs
+    if config["processing"]["aggregationCache"]:
+        monthlyAggregates = aggregates.getMonthlyAggregates(config, inFile[0])
+        needsData = [i for i in indIDs
+                     if config["indicators"][i]["statistic"] not in aggregates.aggregateStatistics]
+    outFiles = dict(zip(indIDs, outFile))
+
+    # If a memory budget is set, the indicators requiring the data are streamed
+    # through in tiles. The remainder are calculated from the aggregates below
+    thisDat = None
+    lazyIDs = indIDs
+    if config["processing"]["memoryBudget"] != "" and len(needsData) > 0:
+        streamIndicators(config, inFile[0], [outFiles[i] for i in needsData], needsData)
+        lazyIDs = [i for i in indIDs if i not in needsData]
+    # Read the dataset object back from disk. If it is not backed by dask, we load
+    # it into memory so that it is only read once
+    elif len(needsData) > 0:
+        thisDat = helpers.readFile(inFile[0])
+        if thisDat.chunks is None:
+            thisDat = thisDat.load()
+
+    # Setup the indicators lazily, and then write them all in one hit
+    seasonCache = {}
+    writes = [computeIndicator(config, thisDat, indID, seasonCache,
+                               monthlyAggregates).to_netcdf(outFiles[indID], compute=False)
+              for indID in lazyIDs]
+    dask.compute(*writes)
+    helpers.reportPeakMemory()
+
+
+def streamIndicators(config, inFile, outFile, indIDs):
+    """
+    Calculate indicators within a memory budget
+
+    Calculates a set of indicators out-of-core, splitting the input data into spatial
+    tiles sized to fit within the memory budget. Each tile is read, processed and
+    written to the output files before moving on to the next, so that only one tile
+    is held in memory at a time.
+    """
+    thisDat = helpers.readFile(inFile)
+    for thisTile in helpers.budgetTiles(thisDat, config["processing"]["memoryBudget"]):
+        datTile = thisDat.isel(thisTile).load()
+        seasonCache = {}
+        for indID, f in zip(indIDs, outFile):
+            dout = computeIndicator(config, datTile, indID, seasonCache).load()
+            helpers.writeTile(dout, f, thisTile, thisDat)
+
+
+def computeIndicator(config, thisDat, indID, seasonCache=None, monthlyAggregates=None):
+    """
+    Compute indicator
+
+    Computes the indicator indID from a dataarray, returning the result. Where
+    possible, the result is lazy. Season selections can be shared between indicators
+    by passing a dict as seasonCache. If the monthly aggregates of the data are
+    supplied, indicators that can be calculated from them are.
+    """
     # Retrieve indicator information
     thisInd = config["indicators"][indID]
+    if thisInd["statistic"] not in kernels.statisticKernels:
+        sys.exit('Unknown indicator statistic, "' + thisInd["statistic"] + '"')
+    if thisInd["time_binning"] not in ["periods", "years", "months", "rolling"]:
+        sys.exit("Unknown time_binning method, '" + thisInd["time_binning"] + "'")
 
-    # Read the dataset object back from disk, depending on the configuration
-    thisDat = helpers.readFile(inFile[0])
-
-    # Filter by season first (should always work)
-    theseMonths = config["seasons"][thisInd["season"]]["months"]
-    datSeason = thisDat.sel(time=np.isin(thisDat.time.dt.month, theseMonths))
+    # Calculate from the monthly aggregates where possible. This avoids touching
+    # the original data entirely
+    if monthlyAggregates is not None and \
+       thisInd["statistic"] in aggregates.aggregateStatistics:
+        dout = helpers.combineSeasons([aggregates.aggregateIndicator(config, monthlyAggregates,
+                                                                     thisInd, thisSeason)
+                                       for thisSeason in thisInd["season"]],
+                                      thisInd["season"])
+    else:
+        dout = binIndicator(config, thisDat, thisInd, seasonCache)
 
-    # Time binning over periods
+    # Tidy output
+    if "season" in dout.dims:
+        dout = dout.transpose("season", ...)
+        dout.season.attrs["name"] = "season"
+        dout.season.attrs["description"] = (
+            f"For season definitions see {config['configurationTables']['seasons']}"
+        )
     if thisInd["time_binning"] == "periods":
-        slices = []
-        for thisPeriod in config["periods"].values():
-            # Slice dataset
-            datPeriodSeason=helpers.timeslice(datSeason,thisPeriod["start"],thisPeriod["end"])
-            timebounds = pd.to_datetime(
-                [f"{thisPeriod['start']}-01-01", f"{thisPeriod['end']}-12-31"]
-            )
-            timestamp = timebounds.mean()
-            # If there is nothing left, we want a result all the same so that we
-            # can put it in the outputs. We copy the structure and populate
-            # it with NaNs
-            if datPeriodSeason.time.size == 0:
-                res = datSeason.isel(time=0)
-                res.data[:] = np.nan
-            # Apply the operator
-            elif thisInd["statistic"] == "mean":
-                res = datPeriodSeason.mean("time", keep_attrs=True)
-            else:
-                sys.exit('Unknown indicator statistic, "' + ind["statistic"] + '"')
-            # Tidy output
-            res["periodID"] = thisPeriod["id"]
-            slices.append(res)
-
-        # Convert list back into dataset
-        dout = xr.concat(slices, dim="periodID")
         dout.periodID.attrs["name"] = "periodID"
         dout.periodID.attrs["description"] = (
             f"For period definitions see {config['configurationTables']['periods']}"
         )
-
-    # Time binning by defined units
-    elif thisInd["time_binning"] in ["years", "months"]:
-        # Then group by time. Could consider using groupby as an alternative
-        if thisInd["time_binning"] == "years":
-            datGroupped = datSeason.resample(time="YE", label="right")
-        elif thisInd["time_binning"] == "months":
-            datGroupped = datSeason.resample(time="ME", label="right")
-        else:
-            sys.exit("Shouldn't be here")
-
-        # Apply the operator
-        if thisInd["statistic"] == "mean":
-            dout = datGroupped.mean(["time"], keep_attrs=True)
-        else:
-            sys.exit('Unknown indicator statistic, "' + thisInd["statistic"] + '"')
-
+    else:
         # Round time to the middle of the month. This ensures that everything
         # has an identical datetime, regardless of the calendar being used.
-        # Kudpos to ChatGPT for this little work around
         # Note that we need to ensure cftime representation, for runs that
         # go out paste 2262
-        dout["time"] = [cftime.DatetimeGregorian(x.dt.strftime("%Y"),x.dt.strftime("%m"),15)
-                                                for x in dout.time]
-
-    else:
-        sys.exit("Unknown time_binning method, '" + thisInd["time_binning"] + "'")
+        theseCodes = helpers.timeCodes(dout)
+        dout["time"] = helpers.midMonthTimes(theseCodes["year"], theseCodes["month"])
 
     # Polish final product
     dout.name = "indicator"
     dout.attrs = {}
     for thiskey in thisInd.keys():
-        if thiskey != "files":
+        if thiskey == "additionalArgs":
+            # Dicts cannot be stored as netCDF attributes, so write them out as strings
+            dout.attrs[thiskey] = str(thisInd[thiskey])
+        elif thiskey == "season":
+            dout.attrs[thiskey] = ",".join(thisInd[thiskey])
+        elif thiskey != "files":
             dout.attrs[thiskey] = thisInd[thiskey]
 
-    # Write out
-    dout.to_netcdf(outFile[0])
+    return dout
+
+
+def binIndicator(config, thisDat, thisInd, seasonCache=None):
+    """
+    Bin indicator
+
+    Selects the seasons from the original data and applies the statistic over the
+    time bins of an indicator. Multiple seasons are returned along a season dimension.
+    """
+    statArgs = kernels.statisticArgs(thisInd)
+
+    # Linear statistics (e.g. means) over periods can be calculated for all seasons
+    # and periods in a single pass, by folding the season masks into the period
+    # membership matrix
+    if thisInd["time_binning"] == "periods" and len(thisInd["season"]) > 1 and \
+       kernels.statisticKernels[thisInd["statistic"]]["linear"] is not None:
+        datStat = kernels.prepareStatistic(thisDat, thisInd["statistic"], statArgs)
+        periodMembers = helpers.periodMembership(datStat, config["periods"],
+                                                 {s: config["seasons"][s]["months"]
+                                                  for s in thisInd["season"]})
+        return kernels.periodStatistic(datStat, periodMembers, thisInd["statistic"], statArgs)
+
+    # Otherwise work through the seasons one by one. Statistics that depend on
+    # consecutive timesteps (e.g. spells) have the timesteps outside of the season
+    # masked out instead of dropped, so that e.g. the end of August and the start
+    # of the following June are not treated as consecutive days
+    consecutive = kernels.statisticKernels[thisInd["statistic"]]["consecutive"]
+    douts = []
+    for thisSeason in thisInd["season"]:
+        # Filter by season first (should always work)
+        theseMonths = config["seasons"][thisSeason]["months"]
+        cacheKey = (thisSeason, consecutive)
+        if seasonCache is not None and cacheKey in seasonCache:
+            datSeason = seasonCache[cacheKey]
+        else:
+            inSeason = helpers.seasonMask(thisDat, theseMonths)
+            if consecutive:
+                datSeason = thisDat.where(xr.DataArray(inSeason, dims="time"))
+            else:
+                datSeason = thisDat.isel(time=inSeason)
+            if seasonCache is not None:
+                seasonCache[cacheKey] = datSeason
+
+        # Prepare the data for the statistic e.g. convert to threshold exceedances.
+        # Statistics are defined in the kernels module
+        datStat = kernels.prepareStatistic(datSeason, thisInd["statistic"], statArgs)
+
+        # Time binning over periods
+        if thisInd["time_binning"] == "periods":
+            # Label each timestep with the periods that it belongs to. Periods may
+            # overlap, so this is a (time x periodID) membership matrix rather than a
+            # single label. Linear statistics (e.g. means) are then calculated for all
+            # periods in one pass over the data
+            periodMembers = helpers.periodMembership(datStat, config["periods"])
+
+            # Apply the statistic. Periods with no data give NaNs
+            dout = kernels.periodStatistic(datStat, periodMembers, thisInd["statistic"], statArgs)
+
+        # Rolling windows of years
+        elif thisInd["time_binning"] == "rolling":
+            dout = kernels.rollingStatistic(datStat, thisInd["statistic"], statArgs,
+                                            int(thisInd["additionalArgs"]["window"]),
+                                            int(thisInd["additionalArgs"].get("step", 1)))
+
+        # Time binning by defined units
+        else:
+            # Then group by time. Could consider using groupby as an alternative
+            if thisInd["time_binning"] == "years":
+                datGroupped = datStat.resample(time="YE", label="right")
+            elif thisInd["time_binning"] == "months":
+                datGroupped = datStat.resample(time="ME", label="right")
+
+            # Apply the statistic. Where the season has been masked rather than
+            # dropped, the months outside of it are dropped from the result
+            dout = kernels.reduceStatistic(datGroupped, thisInd["statistic"], statArgs)
+            if consecutive and thisInd["time_binning"] == "months":
+                dout = dout.isel(time=helpers.seasonMask(dout, theseMonths))
+        douts.append(dout)
+
+    return helpers.combineSeasons(douts, thisInd["season"])
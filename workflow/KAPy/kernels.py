@@ -0,0 +1,260 @@
+# Statistic kernels used in the calculation of indicators
+#
+# Each statistic is defined by an entry in the statisticKernels registry, consisting of
+#  * prepare: optional function applied to the (daily) data before it is binned in time,
+#    e.g. to convert values to threshold exceedances
+#  * reduce: function reducing the binned data along time. This receives either a
+#    DataArray or an xarray resample/groupby object, and should use the vectorised
+#    reductions that these provide
+#  * linear: "mean" or "sum" if the statistic is a mean or sum of the prepared values.
+#    These can be calculated for all periods in a single pass using a period
+#    membership matrix. None otherwise
+#  * contiguousTime: True if the reduction needs the whole time axis in one chunk
+#  * consecutive: True if the reduction depends on which timesteps follow each other
+#    (e.g. spells). Timesteps outside of the season are then masked out rather than
+#    dropped, so that they break runs
+#  * args: names of the arguments that must be given in the additionalArgs column
+# New statistics can be added with registerStatistic()
+
+import sys
+import numpy as np
+import xarray as xr
+import dask.array as dsa
+from numba import njit
+from . import helpers
+
+
+@njit(nogil=True, cache=True)
+def maxSpellLengthKernel(x):
+    # Length of the longest run of consecutive non-zero values in each row of a
+    # (cells x time) array, in a single pass over time. Missing values break a run.
+    # Rows where every value is missing give NaN
+    rtn = np.full(x.shape[0], np.nan)
+    for i in range(x.shape[0]):
+        run = 0
+        longest = 0
+        anyValid = False
+        for t in range(x.shape[1]):
+            thisVal = x[i, t]
+            if np.isnan(thisVal) or thisVal <= 0:
+                run = 0
+            else:
+                run += 1
+                longest = max(longest, run)
+            anyValid = anyValid or not np.isnan(thisVal)
+        if anyValid:
+            rtn[i] = longest
+    return rtn
+
+
+def maxSpellLengthNumpy(x, axis):
+    # Apply the spell-length kernel along an axis of a numpy array
+    x = np.moveaxis(np.asarray(x, dtype=float), axis, -1)
+    nCells = int(np.prod(x.shape[:-1]))
+    rtn = maxSpellLengthKernel(np.ascontiguousarray(x.reshape(nCells, x.shape[-1])))
+    return rtn.reshape(x.shape[:-1])
+
+
+def maxSpellLength(x, axis):
+    # Chunk-aware wrapper. Dask arrays are rechunked so that time is contiguous, and the
+    # kernel is then applied block-wise
+    if isinstance(x, dsa.Array):
+        return x.rechunk({axis: -1}).map_blocks(maxSpellLengthNumpy,
+                                                axis=axis,
+                                                drop_axis=axis,
+                                                dtype=float)
+    return maxSpellLengthNumpy(x, axis)
+
+
+def exceedances(da, threshold, above):
+    # Convert to 1 / 0 depending on whether the threshold is exceeded, keeping missing values
+    if above:
+        return (da > float(threshold)).where(da.notnull())
+    return (da < float(threshold)).where(da.notnull())
+
+
+statisticKernels = {}
+
+
+def registerStatistic(name, reduce, prepare=None, linear=None, contiguousTime=False,
+                      consecutive=False, args=()):
+    """
+    Register statistic
+
+    Adds a statistic to the registry of statistic kernels available to indicators.
+    See the top of this module for the meaning of the arguments.
+    """
+    statisticKernels[name] = {"reduce": reduce,
+                              "prepare": prepare,
+                              "linear": linear,
+                              "contiguousTime": contiguousTime,
+                              "consecutive": consecutive,
+                              "args": args}
+
+
+registerStatistic("mean",
+                  reduce=lambda g: g.mean("time"),
+                  linear="mean")
+registerStatistic("sum",
+                  reduce=lambda g: g.sum("time", min_count=1),
+                  linear="sum")
+registerStatistic("max",
+                  reduce=lambda g: g.max("time"))
+registerStatistic("min",
+                  reduce=lambda g: g.min("time"))
+registerStatistic("count_above",
+                  prepare=lambda da, threshold: exceedances(da, threshold, above=True),
+                  reduce=lambda g, threshold: g.sum("time", min_count=1),
+                  linear="sum",
+                  args=["threshold"])
+registerStatistic("count_below",
+                  prepare=lambda da, threshold: exceedances(da, threshold, above=False),
+                  reduce=lambda g, threshold: g.sum("time", min_count=1),
+                  linear="sum",
+                  args=["threshold"])
+registerStatistic("percentile",
+                  reduce=lambda g, percentile:
+                      g.quantile(float(percentile) / 100, dim="time").drop_vars("quantile"),
+                  contiguousTime=True,
+                  args=["percentile"])
+registerStatistic("spell_above",
+                  prepare=lambda da, threshold: exceedances(da, threshold, above=True),
+                  reduce=lambda g, threshold: g.reduce(maxSpellLength, dim="time"),
+                  contiguousTime=True,
+                  consecutive=True,
+                  args=["threshold"])
+registerStatistic("spell_below",
+                  prepare=lambda da, threshold: exceedances(da, threshold, above=False),
+                  reduce=lambda g, threshold: g.reduce(maxSpellLength, dim="time"),
+                  contiguousTime=True,
+                  consecutive=True,
+                  args=["threshold"])
+
+
+def statisticArgs(thisInd):
+    """
+    Get statistic arguments
+
+    Returns the arguments of the statistic of an indicator from its additionalArgs,
+    leaving out those that control the time binning (e.g. rolling windows).
+    """
+    kernel = statisticKernels[thisInd["statistic"]]
+    return {k: v for k, v in thisInd.get("additionalArgs", {}).items() if k in kernel["args"]}
+
+
+def prepareStatistic(thisDat, statistic, args):
+    """
+    Prepare data for statistic
+
+    Applies the preparation step of a statistic kernel to the data, before it is
+    binned in time.
+    """
+    kernel = statisticKernels[statistic]
+    if kernel["prepare"] is not None:
+        thisDat = kernel["prepare"](thisDat, **args)
+    if kernel["contiguousTime"] and thisDat.chunks is not None:
+        thisDat = thisDat.chunk({"time": -1})
+    return thisDat
+
+
+def reduceStatistic(grouped, statistic, args):
+    """
+    Reduce with statistic
+
+    Applies the reduction step of a statistic kernel to data that has been prepared
+    with prepareStatistic() and (optionally) binned in time.
+    """
+    kernel = statisticKernels[statistic]
+    return kernel["reduce"](grouped, **args)
+
+
+def periodStatistic(thisDat, periodMembers, statistic, args):
+    """
+    Calculate statistic over periods
+
+    Calculates a statistic for each of the periods in a (time x periodID) membership
+    matrix from data that has been prepared with prepareStatistic(). Linear statistics
+    are calculated for all periods in a single pass as dot products with the membership
+    matrix. Other statistics are reduced period-by-period.
+    """
+    kernel = statisticKernels[statistic]
+    if kernel["linear"] is not None:
+        periodSums = xr.dot(thisDat.fillna(0), periodMembers, dim="time")
+        periodCounts = xr.dot(thisDat.notnull().astype(periodMembers.dtype),
+                              periodMembers, dim="time")
+        # Convert sums to means where needed. Periods with no data give NaNs
+        dout = periodSums.where(periodCounts > 0)
+        if kernel["linear"] == "mean":
+            dout = dout / periodCounts
+    else:
+        slices = []
+        for thisPeriodID in periodMembers.periodID.values:
+            isMember = periodMembers.sel(periodID=thisPeriodID).values > 0
+            if isMember.any():
+                res = reduceStatistic(thisDat.isel(time=isMember), statistic, args)
+            else:
+                res = xr.full_like(thisDat.isel(time=0, drop=True), np.nan, dtype=float)
+            slices.append(res.expand_dims(periodID=[thisPeriodID]))
+        dout = xr.concat(slices, dim="periodID")
+    return dout.transpose("periodID", ...)
+
+
+def rollingWindows(annual, window, step, reduction):
+    """
+    Combine annual partials over rolling windows
+
+    Combines annual partial aggregates (a dataset with a year dimension) over rolling
+    windows of a given number of years, starting every step years. Sums are formed
+    from differences of cumulative sums, so the cost is independent of the window
+    length. Maxima and minima use sliding-window reductions. Windows are labelled by
+    their central year, and only windows that lie completely within the data are kept.
+    """
+    # Fill any missing years, so that windows are defined in years rather than steps
+    allYears = np.arange(int(annual.year.min()), int(annual.year.max()) + 1)
+    annual = annual.reindex(year=allYears, fill_value=0 if reduction == "sum" else np.nan)
+    nWindows = len(allYears) - window + 1
+    if nWindows < 1:
+        sys.exit(f"Rolling window of {window} years is longer than the data "
+                 + f"({len(allYears)} years).")
+    starts = np.arange(0, nWindows, step)
+    if reduction == "sum":
+        # Window sums are the differences of the cumulative sums at each end
+        cumSums = annual.cumsum("year")
+        cumSums = xr.concat([xr.zeros_like(cumSums.isel(year=[0])), cumSums], dim="year")
+        windows = cumSums.isel(year=starts + window) - \
+            cumSums.isel(year=starts).assign_coords(year=cumSums.year[starts + window])
+    else:
+        rolled = getattr(annual.rolling(year=window, min_periods=1), reduction)()
+        windows = rolled.isel(year=starts + window - 1)
+    # Label with the central year
+    windows = windows.assign_coords(year=allYears[starts] + window // 2)
+    windows = windows.rename(year="time")
+    return windows.assign_coords(time=helpers.midMonthTimes(windows.time.values, 7))
+
+
+def rollingStatistic(thisDat, statistic, args, window, step):
+    """
+    Calculate statistic over rolling windows
+
+    Calculates a statistic over rolling windows of years from data that has been
+    prepared with prepareStatistic(). The data is first reduced to annual partial
+    aggregates, which are then combined over the windows with rollingWindows().
+    """
+    kernel = statisticKernels[statistic]
+    years = xr.DataArray(helpers.timeCodes(thisDat)["year"], dims="time",
+                         coords={"time": thisDat.time}, name="year")
+    if kernel["linear"] is not None:
+        annual = xr.Dataset({
+            "sum": thisDat.fillna(0).groupby(years).sum("time"),
+            "count": thisDat.notnull().astype("float64").groupby(years).sum("time"),
+        })
+        windows = rollingWindows(annual, window, step, "sum")
+        dout = windows["sum"].where(windows["count"] > 0)
+        if kernel["linear"] == "mean":
+            dout = dout / windows["count"]
+    elif statistic in ["max", "min"]:
+        annual = xr.Dataset({statistic: getattr(thisDat.groupby(years), statistic)("time")})
+        dout = rollingWindows(annual, window, step, statistic)[statistic]
+    else:
+        sys.exit(f"The '{statistic}' statistic cannot be used with rolling windows.")
+    return dout
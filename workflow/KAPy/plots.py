@@ -12,10 +12,10 @@ wf=KAPy.getWorkflow(config)
 
 from plotnine import *
 import pandas as pd
-import os
 import xarray as xr
 import matplotlib
 from datetime import datetime
+from .filenames import parseFilenames
 
 # Set default backend to workaround problems caused by the
 # default not being uniform across systems - in particular, we 
@@ -35,13 +35,13 @@ def makeBoxplot(config, indID, srcFiles, outFile=None):
 
     # Load csv files as panadas dataframes
     # Note that we need to make sure that we read the ID's as strings
+    fnTbl = parseFilenames(srcFiles).set_index("path")
     dat = []
     for f in srcFiles:
         datIn = pd.read_csv(f)
-        datIn["fname"] = os.path.basename(f)
         datIn["periodID"] = [str(x) for x in datIn["periodID"]]
-        datIn["source"] = datIn["fname"].str.extract("^[^_]+_([^_]+)_[^_]+_[^_]+_.*$")
-        datIn["experiment"] = datIn["fname"].str.extract("^[^_]+_[^_]+_[^_]+_([^_]+)_.*$")
+        datIn["source"] = fnTbl.loc[f, "srcID"]
+        datIn["experiment"] = fnTbl.loc[f, "expt"]
         dat += [datIn]
     datdf = pd.concat(dat)
     datdf['lbl']=[ rw['source'] + "-" + rw['experiment'] if rw['experiment']!='no-expt' else rw['source']
@@ -64,8 +64,10 @@ def makeBoxplot(config, indID, srcFiles, outFile=None):
 
     # Now merge into dataframe and pivot for plotting
     pltLong = pd.merge(datdf, ptileTbl, on="percentiles", how="left")
+    # Indicators calculated for multiple seasons have a season column as well
+    idxCols = ["lbl", "periodID"] + (["season"] if "season" in pltLong.columns else [])
     pltDatWide = pltLong.pivot_table(
-        index=["lbl", "periodID"], columns="ptileLbl", values="mean"
+        index=idxCols, columns="ptileLbl", values="mean"
     ).reset_index()
 
     # Now plot
@@ -94,6 +96,8 @@ def makeBoxplot(config, indID, srcFiles, outFile=None):
         + theme_bw()
         + theme(legend_position="bottom", panel_grid_major_x=element_blank())
     )
+    if "season" in pltDatWide.columns:
+        p = p + facet_wrap("~season")
 
     # Output
     if outFile is not None:
@@ -112,6 +116,7 @@ def makeSpatialplot(config, indID, srcFiles, outFile=None):
     thisInd = config["indicators"][indID]
 
     # Read netcdf files using xarray and calculate difference
+    fnTbl = parseFilenames(srcFiles).set_index("path")
     datdf = []
     for d in srcFiles:
         # Import object
@@ -119,9 +124,8 @@ def makeSpatialplot(config, indID, srcFiles, outFile=None):
         # We want to plot a spatial map of the first and last indicators
         firstlast = thisdat.isel(periodID=[0,-1])
         firstlastdf = firstlast.indicator_mean.to_dataframe().reset_index()
-        firstlastdf["fname"] = os.path.basename(d)
-        firstlastdf["source"] = firstlastdf["fname"].str.extract("^[^_]+_([^_]+)_[^_]+_[^_]+_.*$")
-        firstlastdf["experiment"] = firstlastdf["fname"].str.extract("^[^_]+_[^_]+_[^_]+_([^_]+)_.*$")
+        firstlastdf["source"] = fnTbl.loc[d, "srcID"]
+        firstlastdf["experiment"] = fnTbl.loc[d, "expt"]
         datdf += [firstlastdf]
     pltDat = pd.concat(datdf)
     pltDat['lbl']=[ rw['source'] + "-" + rw['experiment'] if rw['experiment']!='no-expt' else rw['source']
@@ -141,11 +145,14 @@ def makeSpatialplot(config, indID, srcFiles, outFile=None):
     pltDat['x']=pltDat[spDimX]
     pltDat['y']=pltDat[spDimY]
 
+    # Indicators calculated for multiple seasons are faceted by season as well
+    facetRows = "periodLbl+season" if "season" in pltDat.columns else "periodLbl"
+
     # Make plot
     p = (
         ggplot(pltDat, aes(x="x", y="y", fill="indicator_mean"))
         + geom_raster()
-        + facet_grid("periodLbl~lbl")
+        + facet_grid(f"{facetRows}~lbl")
         + theme_bw()
         + labs(
             x="",
@@ -178,12 +185,12 @@ def makeLineplot(config, indID, srcFiles, outFile=None):
     thisInd = config["indicators"][indID]
 
     # Load csv files as panadas dataframes
+    fnTbl = parseFilenames(srcFiles).set_index("path")
     dat = []
     for f in srcFiles:
         datIn = pd.read_csv(f)
-        datIn["fname"] = os.path.basename(f)
-        datIn["source"] = datIn["fname"].str.extract("^[^_]+_([^_]+)_[^_]+_[^_]+_.*$")
-        datIn["experiment"] = datIn["fname"].str.extract("^[^_]+_[^_]+_[^_]+_([^_]+)_.*$")
+        datIn["source"] = fnTbl.loc[f, "srcID"]
+        datIn["experiment"] = fnTbl.loc[f, "expt"]
         dat += [datIn]
     datdf = pd.concat(dat)
     #Use datetime library to handle dates longer than 2262 and plotting in plotnine
@@ -209,6 +216,8 @@ def makeLineplot(config, indID, srcFiles, outFile=None):
         + scale_x_datetime(date_labels="%Y")
         + theme(legend_position="bottom")
     )
+    if "season" in pltDat.columns:
+        p = p + facet_wrap("~season")
     # Output
     if outFile is not None:
         p.save(outFile[0],
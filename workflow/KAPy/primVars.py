@@ -21,7 +21,11 @@ import xarray as xr
 import pickle
 import sys
 import importlib
-from cdo import Cdo
+import numpy as np
+import geopandas as gpd
+import regionmask
+from . import catalog
+from .grids import getLonLat
 
 
 def buildPrimVar(config, inFiles, outFile, inpID):
@@ -34,8 +38,12 @@ def buildPrimVar(config, inFiles, outFile, inpID):
     # Get input configuration
     thisInp = config["inputs"][inpID]
 
+    # Order the input files in time using the input catalog. This also checks
+    # for consistent calendars and overlapping files, so that the time axis is
+    # correct without having to sort the combined dataset afterwards
+    inFiles = catalog.orderFiles(config, inFiles, inpID)
+
     # Make dataset object using xarray lazy load approach.
-    # Apply a manual sort ensures that the time axis is correct
     # Use the join="override" argument to handle the case where
     # there are small numerical differences in the values of the
     # coordinates - in this case, we take the coordinates from the first file
@@ -44,7 +52,6 @@ def buildPrimVar(config, inFiles, outFile, inpID):
                             use_cftime=True, 
                             join="override", 
                             concat_dim='time')
-    dsIn=dsIn.sortby('time')
 
     # Select the desired variable and rename it
     ds = dsIn.rename({thisInp["internalVarName"]: thisInp["varID"]})
@@ -71,29 +78,19 @@ def buildPrimVar(config, inFiles, outFile, inpID):
 
     #Apply cutout functionality
     if config["cutouts"]["method"] == "lonlatbox":
-        # The processing chain here is to first take
-        # a slide, and then do a cdo cutoout on it. This
-        # can be used as a mask on the xarray object - this
-        # way we can maintain the lazy-loading and storage benefits
-        # associated with pickling
-        
-        # Extract first time step. This avoids having to work
-        # with the entire dataset
-        firstTS=da.isel(time=0)
-
-        # Do cutouts using cdo sellonlatbox. Make sure that we
-        # return a dataarray and not a dataset
-        cdo = Cdo()
-        cutoutMask = cdo.sellonlatbox(
-            config["cutouts"]["xmin"],
-            config["cutouts"]["xmax"],
-            config["cutouts"]["ymin"],
-            config["cutouts"]["ymax"],
-            input=firstTS,
-            returnXArray=thisInp["varID"])
-        
-        # Apply masking to data array object
-        da=da.where(cutoutMask.notnull(),drop=True)
+        # Find the index bounds of the box on the (1D or 2D) longitude-latitude
+        # coordinates and slice them out. This keeps everything lazy, and means that
+        # only the necessary hyperslab is read from disk subsequently
+        da = lonlatboxCutout(da,
+                             config["cutouts"]["xmin"],
+                             config["cutouts"]["xmax"],
+                             config["cutouts"]["ymin"],
+                             config["cutouts"]["ymax"])
+
+    elif config["cutouts"]["method"] == "shapefile":
+        # Slice out the bounding box of the polygons first, and then mask
+        # the points outside of the polygons
+        da = shapefileCutout(da, config["cutouts"]["shapefile"])
 
     elif config["cutouts"]["method"] != "none":
         #problem
@@ -110,8 +107,124 @@ def buildPrimVar(config, inFiles, outFile, inpID):
     #     da = ppFn(da)  # Assume no input arguments
 
     # Write the dataset object to disk, depending on the configuration
-    if config['processing']['picklePrimaryVariables']:
+    pvFormat = config['processing']['primaryVariableFormat']
+    if pvFormat == 'pickle':
         with open(outFile[0],'wb') as f:
             pickle.dump(da,f,protocol=-1)
+    elif pvFormat == 'zarr':
+        writeZarr(da, outFile[0], config['processing']['primaryVariableChunks'])
     else:
         da.to_netcdf(outFile[0])
+
+
+def writeZarr(da, outPath, chunkCfg):
+    """
+    Write primary variable as Zarr store
+
+    Rechunks the data array according to the configured chunk layout and
+    writes it out as a compressed Zarr store.
+    """
+    # Time is chunked according to the time setting, and all other (spatial)
+    # dimensions according to the space setting
+    chunks = {d: chunkCfg['time'] if d == 'time' else chunkCfg['space']
+              for d in da.dims}
+    ds = da.chunk(chunks).to_dataset()
+
+    # The encoding inherited from the input NetCDF files (chunksizes, compression
+    # settings etc) is incompatible with Zarr, so we clear it and let the
+    # defaults (including compression) apply
+    for thisVar in ds.variables.values():
+        thisVar.encoding = {}
+    ds.to_zarr(outPath, mode='w')
+
+
+def isPeriodic(lonVals, axis):
+    # A longitude axis is periodic (global) if stepping once past its last point
+    # brings it back to the first, as on a global grid
+    lonVals = np.moveaxis(lonVals, axis, -1)
+    if lonVals.shape[-1] < 2:
+        return False
+    step = np.median(np.mod(np.diff(lonVals, axis=-1), 360))
+    wrap = np.mod(lonVals[..., 0] - lonVals[..., -1], 360)
+    return bool(step > 0 and np.all(np.abs(wrap - step) <= step / 2))
+
+
+def lonlatboxCutout(da, xmin, xmax, ymin, ymax):
+    """
+    Cut out a longitude-latitude box
+
+    Selects the smallest index-space rectangle containing all grid points that
+    fall within the box, and applies it via isel(). Boxes with xmin > xmax cross
+    the dateline, as in CDO.
+    """
+    lon, lat = getLonLat(da)
+    if lon.ndim != 1 or lat.ndim != 1:
+        lon, lat = xr.broadcast(lon, lat)
+
+    # Longitudes are compared modulo 360, so that the box works regardless of
+    # whether the grid uses the -180-180 or 0-360 convention
+    lonVals = np.asarray(lon.values, dtype=float)
+    latVals = np.asarray(lat.values, dtype=float)
+    if xmax - xmin >= 360:
+        inLon = np.ones(lonVals.shape, dtype=bool)
+    else:
+        inLon = np.mod(lonVals - xmin, 360) <= np.mod(xmax - xmin, 360)
+    inLat = (latVals >= ymin) & (latVals <= ymax)
+
+    # Longitude and latitude are either 1D coordinates on separate dimensions,
+    # 1D coordinates on a shared dimension (unstructured grids and stations), or
+    # 2D coordinates sharing the same dimensions. Points on a shared dimension
+    # have no rectangle to cut, so exactly those inside the box are kept. In the
+    # 2D case, we keep every row and column that contains at least one point
+    # inside the box. Only longitude dimensions can wrap around
+    if lon.ndim == 1 and lon.dims != lat.dims:
+        sel = {lon.dims[0]: inLon,
+               lat.dims[0]: inLat}
+        periodic = {lon.dims[0]: isPeriodic(lonVals, 0)}
+    elif lon.ndim == 1:
+        inBox = inLon & inLat
+        if not inBox.any():
+            sys.exit(f"Cutout box does not contain any grid points along '{lon.dims[0]}'.")
+        return da.isel({lon.dims[0]: np.flatnonzero(inBox)})
+    else:
+        inBox = inLon & inLat
+        sel = {thisDim: inBox.any(axis=tuple(i for i in range(inBox.ndim) if i != axis))
+               for axis, thisDim in enumerate(lon.dims)}
+        periodic = {thisDim: isPeriodic(lonVals, axis) for axis, thisDim in enumerate(lon.dims)}
+
+    # Convert masks to indexers. Selections become slices spanning the first to the
+    # last selected index, except where the selection wraps around the edge of a
+    # periodic axis. These become the index range running from the largest gap in
+    # the selection across the edge
+    idxers = {}
+    for thisDim, thisSel in sel.items():
+        theseIdxs = np.flatnonzero(thisSel)
+        n = len(thisSel)
+        if len(theseIdxs) == 0:
+            sys.exit(f"Cutout box does not contain any grid points along '{thisDim}'.")
+        if periodic.get(thisDim, False) and theseIdxs[0] == 0 and theseIdxs[-1] == n - 1 \
+           and len(theseIdxs) < n:
+            gap = np.argmax(np.diff(theseIdxs)) + 1
+            idxers[thisDim] = np.arange(theseIdxs[gap], theseIdxs[gap - 1] + n + 1) % n
+        else:
+            idxers[thisDim] = slice(theseIdxs[0], theseIdxs[-1] + 1)
+    return da.isel(idxers)
+
+
+def shapefileCutout(da, shapefilePath):
+    """
+    Cut out polygons from a shapefile
+
+    Pre-slices the data to the bounding box of the polygons in the shapefile and
+    then masks out the points that lie outside the polygons.
+    """
+    shapefile = gpd.GeoDataFrame.from_file(shapefilePath)
+    if shapefile.crs is not None:
+        shapefile = shapefile.to_crs(4326)
+    xmin, ymin, xmax, ymax = shapefile.total_bounds
+    da = lonlatboxCutout(da, xmin, xmax, ymin, ymax)
+
+    # The mask only needs to be calculated on the (small) sliced grid
+    lon, lat = getLonLat(da)
+    polyMask = regionmask.from_geopandas(shapefile).mask(lon, lat)
+    return da.where(polyMask.notnull())
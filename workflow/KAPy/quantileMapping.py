@@ -0,0 +1,355 @@
+"""
+#Setup for debugging with VS code
+import os
+print(os.getcwd())
+os.chdir("..")
+import KAPy
+os.chdir("..")
+config=KAPy.getConfig("./config/config.yaml")
+"""
+
+# Native quantile mapping methods for calibration. These follow the empirical quantile
+# mapping (EQM) and quantile delta mapping (QDM) methods of xclim, with quantiles on
+# equally spaced nodes, nearest-node interpolation and constant extrapolation, but are
+# implemented as numba-compiled kernels operating on one grid cell at a time. This avoids
+# the per-group overhead of the generic xclim machinery, which dominates on daily data.
+#
+# When the data is grouped (by month, season or day of year), xclim interpolates in two
+# dimensions, taking the nearest node in the plane of value and group number. A value
+# that lies far from the nodes of its own group can therefore take the factor of a node
+# in a neighbouring group, and the first and last groups are neighbours. This is
+# reproduced here, so that the results are the same as with xclim.
+import sys
+import numpy as np
+import xarray as xr
+from numba import njit
+from . import helpers
+
+# Mapping of the months to the standard seasons (DJF, MAM, JJA, SON)
+seasonOfMonth = np.array([0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3, 0])
+
+
+def groupCodes(thisDat, grouping):
+    # Integer code of the time group of each timestep, and the number of groups
+    if grouping == "month":
+        return helpers.timeCodes(thisDat)["month"] - 1, 12
+    elif grouping == "season":
+        return seasonOfMonth[helpers.timeCodes(thisDat)["month"] - 1], 4
+    elif grouping == "dayofyear":
+        return thisDat.time.dt.dayofyear.values.astype(int) - 1, 366
+    elif grouping == "none":
+        return np.zeros(thisDat.sizes["time"], dtype=int), 1
+    else:
+        sys.exit(f'Unsupported calibration grouping "{grouping}".')
+
+
+def equallySpacedNodes(n):
+    # Quantiles at the centres of n equally sized bins, as used by xclim
+    dq = 1 / n / 2
+    return np.linspace(dq, 1 - dq, n)
+
+
+@njit(nogil=True, cache=True)
+def groupStarts(groups, nGroups):
+    # Order of the timesteps when sorted by group, and the start of each group in it
+    order = np.argsort(groups, kind="mergesort")
+    starts = np.zeros(nGroups + 1, dtype=np.int64)
+    for g in groups:
+        starts[g + 1] += 1
+    return order, np.cumsum(starts)
+
+
+@njit(nogil=True, cache=True)
+def sortedValid(x, idx):
+    # The non-missing values of x at idx, sorted
+    vals = x[idx]
+    return np.sort(vals[~np.isnan(vals)])
+
+
+@njit(nogil=True, cache=True)
+def quantilesOfSorted(vals, q):
+    # Quantiles of sorted values, interpolating linearly between order statistics
+    # (type 7, as numpy and xclim)
+    rtn = np.full(len(q), np.nan)
+    n = len(vals)
+    if n == 0:
+        return rtn
+    for i in range(len(q)):
+        pos = q[i] * (n - 1)
+        lo = int(np.floor(pos))
+        hi = min(lo + 1, n - 1)
+        rtn[i] = vals[lo] + (vals[hi] - vals[lo]) * (pos - lo)
+    return rtn
+
+
+@njit(nogil=True, cache=True)
+def nodeBounds(nodes):
+    # Bounds between the nodes of each group (rows), for nearest-node lookup
+    return (nodes[:, 1:] + nodes[:, :-1]) / 2
+
+
+@njit(nogil=True, cache=True)
+def nearestNode(bounds, g, x):
+    # Index of the node nearest to x, given the bounds between the nodes of group g.
+    # This is the number of bounds below x, so values outside of the range of the
+    # nodes take the end node (constant extrapolation) and values on a bound go to the
+    # lower node, as in scipy. The count is branch-free, which is faster than a binary
+    # search for the small number of nodes used, and lets the loop over the values be
+    # vectorised. Missing values propagate through the adjustment factors, so need no
+    # special handling
+    idx = 0
+    for i in range(bounds.shape[1]):
+        idx += bounds[g, i] < x
+    return idx
+
+
+@njit(nogil=True, cache=True)
+def applyFactor(x, af, multiplicative):
+    return x * af if multiplicative else x + af
+
+
+def groupNeighbours(present, crossGroup):
+    # For each group, the groups that are searched for the nearest node and their
+    # distance in group numbers, nearest first. Ungrouped data only searches its own
+    # group. Otherwise, as in xclim, the groups present in the training data are
+    # searched, with the last group repeated before the first and the first repeated
+    # after the last so that the year wraps around
+    nGroups = len(present)
+    if not crossGroup:
+        return np.arange(nGroups).reshape(-1, 1), np.zeros((nGroups, 1))
+    groups = np.flatnonzero(present)
+    coords = groups.astype(float)
+    if len(groups) > 1:
+        groups = np.concatenate([groups[-1:], groups, groups[:1]])
+        coords = np.concatenate([[2 * coords[0] - coords[1]], coords,
+                                 [2 * coords[-1] - coords[-2]]])
+    dists = np.abs(np.arange(nGroups)[:, None] - coords[None, :])
+    order = np.argsort(dists, axis=1, kind="stable")
+    return groups[order], np.take_along_axis(dists, order, axis=1)
+
+
+@njit(nogil=True, cache=True)
+def searchNeighbours(x, g, idx, nodes, neighbourDists):
+    # True if the nearest node in the plane of value and group number may lie in
+    # another group than the nearest node idx of group g itself. This is the case for
+    # groups that are missing from the training data, and for values within the range
+    # of the nodes of their own group that are further from the nearest of these than
+    # from the nearest other group. Values outside of the range of the nodes of their own
+    # group are extrapolated from it, as in xclim
+    missing = np.isnan(nodes[g, 0]) & ~np.isnan(x)
+    if neighbourDists.shape[1] < 2:
+        return missing
+    inside = (x > nodes[g, 0]) & (x < nodes[g, nodes.shape[1] - 1])
+    return missing | (inside & ((x - nodes[g, idx]) ** 2 > neighbourDists[g, 1] ** 2))
+
+
+@njit(nogil=True, cache=True)
+def neighbourFactor(x, g, nodes, bounds, af, neighbours, neighbourDists):
+    # Adjustment factor at the node nearest to x in the plane of value and group number,
+    # searching the groups in order of their distance from group g. Ties go to the
+    # nearer group and, within a group, to the lower node
+    best = np.inf
+    rtn = np.nan
+    for k in range(neighbours.shape[1]):
+        dg = neighbourDists[g, k]
+        if dg * dg >= best:
+            break
+        thisGroup = neighbours[g, k]
+        if np.isnan(nodes[thisGroup, 0]) or np.isnan(af[thisGroup, 0]):
+            continue
+        idx = nearestNode(bounds, thisGroup, x)
+        d = (x - nodes[thisGroup, idx]) ** 2 + dg * dg
+        if d < best:
+            best = d
+            rtn = af[thisGroup, idx]
+    return rtn
+
+
+@njit(nogil=True, cache=True)
+def trainKernel(ref, refGroups, hist, histGroups, nGroups, q, multiplicative):
+    """
+    Train quantile mapping
+
+    Calculates the quantiles of the historical simulation and the adjustment factors
+    between the reference and historical quantiles, for each grid cell (rows of ref
+    and hist) and each time group.
+    """
+    nCells = ref.shape[0]
+    histQ = np.full((nCells, nGroups, len(q)), np.nan)
+    af = np.full((nCells, nGroups, len(q)), np.nan)
+    refOrder, refStarts = groupStarts(refGroups, nGroups)
+    histOrder, histStarts = groupStarts(histGroups, nGroups)
+    for c in range(nCells):
+        for g in range(nGroups):
+            refQ = quantilesOfSorted(sortedValid(ref[c], refOrder[refStarts[g]:refStarts[g + 1]]), q)
+            hQ = quantilesOfSorted(sortedValid(hist[c], histOrder[histStarts[g]:histStarts[g + 1]]), q)
+            histQ[c, g, :] = hQ
+            af[c, g, :] = refQ / hQ if multiplicative else refQ - hQ
+    return histQ, af
+
+
+@njit(nogil=True, cache=True)
+def eqmAdjustKernel(sim, simGroups, histQ, af, multiplicative, neighbours, neighbourDists):
+    """
+    Empirical quantile mapping
+
+    Adjusts each value of the simulation by the factor at the nearest quantile of the
+    historical simulation, in the same time group. For grouped data, the few values
+    that may be nearer to the nodes of a neighbouring group (see searchNeighbours())
+    are then revisited. This is done in a second pass, so that the first can be
+    vectorised.
+    """
+    out = np.empty_like(sim)
+    search = np.empty(sim.shape[1], dtype=np.bool_)
+    for c in range(sim.shape[0]):
+        bounds = nodeBounds(histQ[c])
+        for t in range(sim.shape[1]):
+            g = simGroups[t]
+            idx = nearestNode(bounds, g, sim[c, t])
+            out[c, t] = applyFactor(sim[c, t], af[c, g, idx], multiplicative)
+            search[t] = searchNeighbours(sim[c, t], g, idx, histQ[c], neighbourDists)
+        for t in np.flatnonzero(search):
+            thisAf = neighbourFactor(sim[c, t], simGroups[t], histQ[c], bounds, af[c],
+                                     neighbours, neighbourDists)
+            out[c, t] = applyFactor(sim[c, t], thisAf, multiplicative)
+    return out
+
+
+@njit(nogil=True, cache=True)
+def qdmAdjustKernel(sim, simGroups, q, af, multiplicative, neighbours, neighbourDists):
+    """
+    Quantile delta mapping
+
+    Adjusts each value of the simulation by the factor at its own quantile within the
+    simulation, in the same time group. Tied values are given their average rank. As in
+    xclim, the ranks are rescaled so that the quantiles run from 0 for the lowest value
+    to the (average) rank of the highest value divided by the number of values. Groups
+    where all values are the same have undefined quantiles, and give missing values.
+    The factor is taken at the nearest node, as in eqmAdjustKernel().
+    """
+    out = np.full_like(sim, np.nan)
+    nGroups = af.shape[1]
+    order, starts = groupStarts(simGroups, nGroups)
+    nodes = np.empty((nGroups, len(q)))
+    for g in range(nGroups):
+        nodes[g] = q
+    bounds = nodeBounds(nodes)
+    for c in range(sim.shape[0]):
+        # Nodes of the groups that are missing from the training data are marked as
+        # missing, so that their neighbours are searched
+        for g in range(nGroups):
+            nodes[g, 0] = np.nan if np.isnan(af[c, g, 0]) else q[0]
+        for g in range(nGroups):
+            idx = order[starts[g]:starts[g + 1]]
+            vals = sim[c, idx]
+            valid = idx[~np.isnan(vals)]
+            n = len(valid)
+            if n == 0:
+                continue
+            ranked = valid[np.argsort(sim[c, valid], kind="mergesort")]
+            # Average ranks of the lowest and highest values, for the rescaling
+            lowest = sim[c, ranked[0]]
+            highest = sim[c, ranked[n - 1]]
+            nLowest = 0
+            while nLowest < n and sim[c, ranked[nLowest]] == lowest:
+                nLowest += 1
+            nHighest = 0
+            while nHighest < n and sim[c, ranked[n - 1 - nHighest]] == highest:
+                nHighest += 1
+            # The arithmetic follows xclim, so that quantiles falling exactly between two
+            # nodes are rounded in the same way
+            qMin = (nLowest + 1) / 2 / n
+            qMax = (n - (nHighest - 1) / 2) / n
+            if qMax == qMin:
+                continue
+            i = 0
+            while i < n:
+                # Find the run of tied values, which share the average rank
+                j = i
+                while j + 1 < n and sim[c, ranked[j + 1]] == sim[c, ranked[i]]:
+                    j += 1
+                thisQ = ((i + j) / 2 + 1) / n
+                thisQ = qMax * (thisQ - qMin) / (qMax - qMin)
+                node = nearestNode(bounds, g, thisQ)
+                thisAf = af[c, g, node]
+                if searchNeighbours(thisQ, g, node, nodes, neighbourDists):
+                    thisAf = neighbourFactor(thisQ, g, nodes, bounds, af[c],
+                                             neighbours, neighbourDists)
+                for k in range(i, j + 1):
+                    out[c, ranked[k]] = applyFactor(sim[c, ranked[k]], thisAf, multiplicative)
+                i = j + 1
+    return out
+
+
+def asRows(thisDat):
+    # Lay out a dataarray as a (cells x time) array, for the kernels, so that the time
+    # series of each cell is contiguous in memory
+    spatialDims = [d for d in thisDat.dims if d != "time"]
+    return np.ascontiguousarray(thisDat.transpose(*spatialDims, "time").values,
+                                dtype=np.float64).reshape(-1, thisDat.sizes["time"])
+
+
+def train(refDatCP, histNN, calCfg):
+    """
+    Train quantile mapping
+
+    Trains a quantile mapping between the historical simulation and the reference over
+    the calibration period. Returns a dataset with the historical quantiles and the
+    adjustment factors of each grid cell, time group and quantile.
+    """
+    nQuantiles = int(calCfg['additionalArgs'].get('nquantiles', 20))
+    multiplicative = calCfg['additionalArgs'].get('kind', '+') == '*'
+    q = equallySpacedNodes(nQuantiles)
+    refGroups, nGroups = groupCodes(refDatCP, calCfg['grouping'])
+    histGroups, _ = groupCodes(histNN, calCfg['grouping'])
+    histQ, af = trainKernel(asRows(refDatCP), refGroups,
+                            asRows(histNN), histGroups,
+                            nGroups, q, multiplicative)
+
+    # Build dataset, restoring the spatial dimensions
+    spatialDims = [d for d in refDatCP.dims if d != "time"]
+    spatialShape = [refDatCP.sizes[d] for d in spatialDims]
+    theseDims = spatialDims + ["group", "quantiles"]
+    trained = xr.Dataset({"hist_q": (theseDims, histQ.reshape(spatialShape + [nGroups, nQuantiles])),
+                          "af": (theseDims, af.reshape(spatialShape + [nGroups, nQuantiles]))},
+                         coords={"quantiles": q})
+    trained.attrs = {"kind": '*' if multiplicative else '+',
+                     "grouping": calCfg['grouping']}
+    return trained
+
+
+def adjust(histSimNN, trained, method):
+    """
+    Apply quantile mapping
+
+    Adjusts the simulation using a trained quantile mapping, with either empirical
+    quantile mapping ("kapy-eqm") or quantile delta mapping ("kapy-qdm").
+    """
+    multiplicative = trained.attrs["kind"] == '*'
+    simGroups, _ = groupCodes(histSimNN, trained.attrs["grouping"])
+    spatialDims = [d for d in histSimNN.dims if d != "time"]
+    nCells = int(np.prod([histSimNN.sizes[d] for d in spatialDims]))
+    af = trained["af"].transpose(*spatialDims, "group", "quantiles").values
+    af = np.ascontiguousarray(af, dtype=np.float64).reshape(nCells, trained.sizes["group"], -1)
+    sim = asRows(histSimNN)
+    histQ = trained["hist_q"].transpose(*spatialDims, "group", "quantiles").values
+    histQ = np.ascontiguousarray(histQ, dtype=np.float64).reshape(af.shape)
+
+    # Groups that are present in the training data, and their neighbours
+    crossGroup = trained.attrs["grouping"] != "none"
+    present = ~np.all(np.isnan(histQ[:, :, 0]), axis=0)
+    neighbours, neighbourDists = groupNeighbours(present, crossGroup)
+    if method == "kapy-eqm":
+        res = eqmAdjustKernel(sim, simGroups, histQ, af, multiplicative,
+                              neighbours, neighbourDists)
+    elif method == "kapy-qdm":
+        res = qdmAdjustKernel(sim, simGroups, trained["quantiles"].values, af, multiplicative,
+                              neighbours, neighbourDists)
+    else:
+        sys.exit(f'Unsupported quantile mapping method "{method}".')
+
+    # Restore the layout of the simulation
+    dout = histSimNN.transpose(*spatialDims, "time").copy(
+        data=res.reshape([histSimNN.sizes[d] for d in spatialDims] + [histSimNN.sizes["time"]])
+        .astype(histSimNN.dtype))
+    return dout
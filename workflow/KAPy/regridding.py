@@ -14,15 +14,34 @@ outFile=["~/foo.nc"]
 
 from cdo import Cdo
 import xarray as xr
+import pandas as pd
+import hashlib
+import numpy as np
+import os
+import shutil
 import sys
 from . import helpers
+from . import grids
 
 
 def regrid(config, inFile, outFile):
-    # Currently only works for 'cdo' regridding. Other engines such as xesmf could be supported in the future
-    if not config["outputGrid"]["regriddingEngine"] == "cdo":
-        sys.exit("Regridding options are currently limited to cdo. See documentation")
+    # Files that are already on the output grid don't need regridding, and are copied as is
+    tgtGrid = grids.outputGrid(config)
+    if tgtGrid is not None and grids.sameGrid(helpers.readFile(inFile[0]), tgtGrid):
+        shutil.copyfile(inFile[0], outFile[0])
+        return
+
+    # Dispatch to the regridding engine. Other engines such as xesmf could be supported
+    # in the future
+    if config["outputGrid"]["regriddingEngine"] == "cdo":
+        regridCdo(config, inFile, outFile)
+    elif config["outputGrid"]["regriddingEngine"] == "sparse":
+        regridSparse(config, inFile, outFile)
+    else:
+        sys.exit("Regridding options are currently limited to cdo and sparse. See documentation")
+
 
+def regridCdo(config, inFile, outFile):
     # Setup CDO object
     cdo = Cdo()
 
@@ -32,31 +51,20 @@ def regrid(config, inFile, outFile):
     # the file with xarray to figure out what we've got
     thisDat = helpers.readFile(inFile[0])
 
+    # Bilinear weights are only calculated once for each source grid, and are then
+    # applied with remap
+    remapArg = config["outputGrid"]["cdoGriddes"] + "," + getBilinearWeights(cdo, config, thisDat)
+
     # If we have time dimensions, then we can just do the regridding in one hit
-    if "time" in thisDat.dims:
+    if "time" in thisDat.dims and "season" not in thisDat.dims:
         # Apply regridding
-        cdo.remapbil(
-            config["outputGrid"]["cdoGriddes"], input=inFile[0], output=outFile[0]
-        )
-
-    # Otherwise if we have periodIDs dimensions, then we need to loop over the
-    # periods manually
-    elif "periodID" in thisDat.dims:
-        periodSlices = []
-        for thisPeriodID in thisDat.periodID.values:
-            # Extract period slide
-            thisPeriodDat = thisDat.sel(periodID=thisPeriodID)
-            # Apply regridding back to an xarray
-            regridded = cdo.remapbil(
-                config["outputGrid"]["cdoGriddes"],
-                input=thisPeriodDat,
-                returnXDataset=True,
-            )
-            periodSlices += [regridded]
-
-        # Concatenate results and (re)build output
-        dout = xr.concat(periodSlices, dim="periodID")
-        dout["periodID"] = thisDat.periodID
+        cdo.remap(remapArg, input=inFile[0], output=outFile[0])
+
+    # Otherwise if we have periodIDs and/or season dimensions, then we need to map
+    # these onto a time axis that CDO understands
+    elif any(d in thisDat.dims for d in ["periodID", "season"]):
+        stackDims = [d for d in ["season", "periodID", "time"] if d in thisDat.dims]
+        dout = regridStacked(cdo, remapArg, thisDat, stackDims)
 
         # Finally, we need to write out manually
         dout.to_netcdf(outFile[0])
@@ -64,3 +72,122 @@ def regrid(config, inFile, outFile):
     # Otherwise, shouldn't be here
     else:
         sys.exit(f"Can't identify structure of input file : {inFile[0]}.")
+
+
+def regridStacked(cdo, remapArg, thisDat, stackDims):
+    """
+    Regrid stacked slices
+
+    Regrids all slices along the dimensions in stackDims in a single CDO call. As CDO
+    only understands the time dimension, the slices are stacked onto a pseudo-time
+    axis, regridded, and then unstacked, restoring the original coordinates.
+    """
+    # Stack. Each slice is given a daily pseudo-timestep
+    stacked = thisDat.stack(slice=stackDims)
+    sliceIdx = stacked.indexes["slice"]
+    stacked = stacked.drop_vars(["slice"] + stackDims).rename(slice="time")
+    stacked = stacked.assign_coords(time=pd.date_range("2000-01-01",
+                                                       periods=stacked.sizes["time"],
+                                                       freq="D"))
+    stacked = stacked.transpose("time", ...)
+
+    # Regrid
+    regridded = cdo.remap(remapArg, input=stacked, returnXDataset=True)[thisDat.name]
+
+    # Unstack and restore coordinates
+    dout = regridded.drop_vars("time").rename(time="slice")
+    dout = dout.assign_coords(xr.Coordinates.from_pandas_multiindex(sliceIdx, "slice"))
+    dout = dout.unstack("slice").transpose(*stackDims, ...)
+    dout = dout.assign_coords({d: thisDat[d] for d in stackDims})
+    dout.attrs = thisDat.attrs
+    return dout
+
+
+def getBilinearWeights(cdo, config, thisDat):
+    """
+    Get bilinear regridding weights
+
+    Returns the path to a file of bilinear interpolation weights from the grid of thisDat
+    to the output grid. Weights are generated with CDO once for each pair of grids, and
+    are stored with the source grid, keyed on the output grid description. The latter
+    includes the contents of the grid descriptor file, so that the weights are
+    regenerated if it changes.
+    """
+    griddes = config["outputGrid"]["cdoGriddes"]
+    h = hashlib.sha1(griddes.encode())
+    if os.path.isfile(griddes):
+        with open(griddes, "rb") as f:
+            h.update(f.read())
+    cachePath = os.path.join(grids.gridStore(config, thisDat), f"bil_{h.hexdigest()}.nc")
+    if not os.path.exists(cachePath):
+        # Generate from a single field
+        helpers.atomicWrite(cachePath, lambda tmpPath: cdo.genbil(
+            griddes,
+            input=thisDat[{d: 0 for d in thisDat.dims if d in grids.nonSpatialDims}],
+            output=tmpPath))
+    return cachePath
+
+
+def regridSparse(config, inFile, outFile):
+    """
+    Regrid with sparse weights
+
+    Regrids a file in-process, by applying a sparse matrix of regridding weights to all
+    of the slices along the non-spatial dimensions (time, periods, seasons) at once. The
+    weights are calculated once for each pair of grids and cached. Dask-backed inputs
+    are regridded chunk by chunk along the non-spatial dimensions.
+    """
+    thisDat = helpers.readFile(inFile[0])
+    tgtGrid = grids.readGriddes(config["outputGrid"]["cdoGriddes"])
+    method = config["outputGrid"]["remapMethod"]
+    weights = grids.getRegriddingWeights(config, thisDat, tgtGrid, method)
+    srcDims = grids.spatialDims(thisDat)
+    tgtDims = grids.spatialDims(tgtGrid)
+
+    # The spatial dimensions are the core dimensions of the matrix product, so need to be
+    # held in a single chunk
+    if thisDat.chunks is not None:
+        thisDat = thisDat.chunk({d: -1 for d in srcDims})
+    srcNoGrid = thisDat.drop_vars([c for c in thisDat.coords
+                                   if any(d in srcDims for d in thisDat[c].dims)])
+    dout = xr.apply_ufunc(applyWeights, srcNoGrid,
+                          kwargs={"weights": weights,
+                                  "tgtShape": [tgtGrid.sizes[d] for d in tgtDims],
+                                  "renormalise": method == "conservative"},
+                          input_core_dims=[srcDims],
+                          output_core_dims=[tgtDims],
+                          dask="parallelized",
+                          output_dtypes=[thisDat.dtype],
+                          dask_gufunc_kwargs={"output_sizes": dict(tgtGrid.sizes)},
+                          keep_attrs=True)
+
+    # Add the target grid and write
+    dout = dout.assign_coords(tgtGrid.coords)
+    dout.to_netcdf(outFile[0])
+
+
+def applyWeights(srcArr, weights, tgtShape, renormalise):
+    """
+    Apply regridding weights
+
+    Applies sparse regridding weights to an array whose last dimensions are the source
+    grid. The leading dimensions are stacked, so that the regridding is a single sparse
+    matrix product. Missing values are excluded: with renormalisation (conservative
+    regridding) the remaining weights are rescaled to sum to one, otherwise (bilinear
+    regridding) a target cell is missing if any of its source cells are missing.
+    """
+    leadShape = srcArr.shape[:srcArr.ndim - 2]
+    stacked = srcArr.reshape(-1, weights.shape[1]).astype(np.float64)
+    isValid = ~np.isnan(stacked)
+
+    # Regrid the values and the weights of the valid cells
+    num = (weights @ np.where(isValid, stacked, 0).T).T
+    validWeight = (weights @ isValid.T.astype(np.float64)).T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        res = num / validWeight
+    if renormalise:
+        res[validWeight <= 0] = np.nan
+    else:
+        totalWeight = np.asarray(weights.sum(axis=1)).ravel()
+        res[(validWeight < totalWeight * (1 - 1e-6)) | (totalWeight <= 0)] = np.nan
+    return res.reshape(leadShape + tuple(tgtShape)).astype(srcArr.dtype)
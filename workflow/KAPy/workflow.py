@@ -15,6 +15,29 @@ import sys
 import os
 import pandas as pd
 import glob
+import json
+import hashlib
+import pickle
+from . import helpers
+from .config import validateConfig
+from .filenames import parseFilenames, formatFilenames
+
+
+def dirPrefix(*dirs):
+    # Directory prefix, including the trailing separator, so that paths can be built
+    # by vectorised string concatenation with a column of filenames
+    return os.path.join(*dirs, "")
+
+
+def groupToDict(tbl, keyCol, valCol):
+    # Collapse a table into a dict of lists, grouping the values by the key column.
+    # This is done in a single pass, as pandas groupby has a large per-group overhead
+    # when there are many small groups. Keys are sorted, as in groupby
+    rtn = {}
+    for thisKey, thisVal in zip(tbl[keyCol], tbl[valCol]):
+        rtn.setdefault(thisKey, []).append(thisVal)
+    return dict(sorted(rtn.items()))
+
 
 def getWorkflow(config):
     """
@@ -36,7 +59,7 @@ def getWorkflow(config):
     for thisKey, thisInp in inp.items():
         # Get file list
         inpTbl = pd.DataFrame(glob.glob(thisInp["path"]), columns=["inPath"])
-        inpTbl['inFname']=[os.path.basename(p) for p in inpTbl['inPath']]
+        inpTbl['inFname']=inpTbl['inPath'].map(os.path.basename)
 
         #First, handle case where we don't find any files. We could ignore it,
         # but it's best to throw an error
@@ -61,10 +84,11 @@ def getWorkflow(config):
                          f'but {len(inpTbl)} files were detected.')
 
             # Split filenames into columns and extract predefined elements
-            inpTbl['split']=inpTbl['inFname'].str.split(thisInp['fieldSeparator'])
-            inpTbl['experiment']=[f[int(thisInp['experimentField'])-1] for f in inpTbl['split']]
+            splitTbl=inpTbl['inFname'].str.split(thisInp['fieldSeparator'],expand=True)
+            inpTbl['experiment']=splitTbl[int(thisInp['experimentField'])-1]
             ensMemberFieldsIdxs = [int(i)-1 for i in thisInp['ensMemberFields']]
-            inpTbl['ensMemberID']=["_".join([f[i] for i in ensMemberFieldsIdxs]) for f in inpTbl['split']]
+            inpTbl['ensMemberID']=splitTbl[ensMemberFieldsIdxs[0]].str.cat(
+                [splitTbl[i] for i in ensMemberFieldsIdxs[1:]],sep="_")
 
             # Deal with the issue around the definition of a common experiment
             if thisInp["commonExperimentID"]=='':
@@ -82,81 +106,50 @@ def getWorkflow(config):
             # Else, handle the more complex case where we have defined a common experiment
             else:
                 #Split table into commonExperiment and other Experiments
-                commonExptTable=inpTbl[inpTbl['experiment'].isin([thisInp['commonExperimentID']])].copy()
+                commonExptTable=inpTbl[inpTbl['experiment'].isin([thisInp['commonExperimentID']])]
                 otherExptTable=inpTbl[~inpTbl['experiment'].isin([thisInp['commonExperimentID']])]
 
-                #Get list of other experiments
-                otherExptList=otherExptTable['experiment'].unique()
-
-                #Setup storage and  loop over the experiments
-                pvList = []
-                for thisExpt in otherExptList:
-                    # Get files that are either in the experiment of interest first
-                    theseExptFiles=inpTbl[inpTbl['experiment'].isin([thisExpt])].copy()
-
-                    #Forming the corresponding filename. Don't forget to add the .nc
-                    theseExptFiles['pvFname']= \
-                        f"{thisInp['varID']}_{thisInp['srcID']}_{thisInp['gridID']}_" + \
-                        thisExpt + "_" + \
-                        theseExptFiles['ensMemberID'] +".nc"
-                    
-                    #Now do the same for the commonExpt - using the experiment
-                    #naming from thisExpt (and not the native commonExperimentID)
-                    commonExptTable['pvFname']= \
-                        f"{thisInp['varID']}_{thisInp['srcID']}_{thisInp['gridID']}_" + \
-                        thisExpt + "_" + \
-                        commonExptTable['ensMemberID'] +".nc"
-                    
-                    #Now select the files from the commonExpt that are also in the
-                    #otherExperiment table. This makes sure that we only add
-                    #commonExpt ensemble members that have corresponding files
-                    #in the given experiment (thisExpt). Then concat.
-                    theseCommonExptFiles=commonExptTable[
-                        commonExptTable['pvFname'].isin(theseExptFiles['pvFname'])
-                    ]
-                    combinedFileTbl=pd.concat([theseExptFiles,theseCommonExptFiles])
-
-                    # Store results
-                    pvList += [combinedFileTbl[['pvFname','inPath']]]
-                
-                #Concatenate into the final table
-                pvTbl = pd.concat(pvList)
+                #Now pair the files from the commonExpt with the ensemble members
+                #of each of the other experiments. The inner merge ensures that we only
+                #add commonExpt ensemble members that have corresponding files
+                #in the given experiment. The commonExpt files then take the
+                #experiment naming from the other experiment (and not the native
+                #commonExperimentID)
+                otherMembers=otherExptTable[['experiment','ensMemberID']].drop_duplicates()
+                commonExptFiles=commonExptTable.drop(columns='experiment').merge(
+                    otherMembers,on='ensMemberID',how='inner')
+                combinedFileTbl=pd.concat([otherExptTable,commonExptFiles])
+
+                #Forming the corresponding filename. Don't forget to add the .nc
+                combinedFileTbl['pvFname']= \
+                    f"{thisInp['varID']}_{thisInp['srcID']}_{thisInp['gridID']}_" + \
+                    combinedFileTbl['experiment'] + "_" + \
+                    combinedFileTbl['ensMemberID'] +".nc"
+
+                # Store results
+                pvTbl = combinedFileTbl[['pvFname','inPath']]
 
         # Build the full filename and tidy up the output into a dict
-        pvTbl["pvPath"] = [
-            os.path.join(outDirs["variables"], thisInp["varID"], f)
-            for f in pvTbl["pvFname"]
-        ]
+        pvTbl = pvTbl.assign(pvPath=dirPrefix(outDirs["variables"], thisInp["varID"]) 
+                                    + pvTbl["pvFname"])
 
-        # If we're pickling, name the output files accordingly
-        if config['processing']['picklePrimaryVariables']:
+        # If we're pickling or writing Zarr stores, name the output files accordingly
+        if config['processing']['primaryVariableFormat'] == 'pickle':
             pvTbl["pvPath"] = pvTbl["pvPath"] + ".pkl"
+        elif config['processing']['primaryVariableFormat'] == 'zarr':
+            pvTbl["pvPath"] = pvTbl["pvPath"] + ".zarr"
         
         #Prior to adding to the pvDict, check that we have unique keys
         if any(pvTbl['pvPath'].isin(pvDict.keys())):
             sys.exit("Duplicate keys found in generating primary variables.")
 
         #Finally, make the dict
-        pvDict[thisKey] =(
-            pvTbl.groupby("pvPath")
-            .apply(lambda x: list(x["inPath"]), include_groups=False)
-            .to_dict()
-        )
+        pvDict[thisKey] = groupToDict(pvTbl, "pvPath", "inPath")
 
     # Secondary Variables---------------------------------------------
     # Setup the variable palette as a tabular list of files. As we add each
     # additional variable, we concatentate it onto the variable palette.
-    def parseFilelist(flist):
-        thisTbl = pd.DataFrame(flist,columns=["path"])
-        thisTbl["fname"] = [os.path.basename(p) for p in thisTbl["path"]]
-        thisTbl["varID"] = thisTbl["fname"].str.extract("^([^_]+)_.*$")
-        thisTbl["srcID"] = thisTbl["fname"].str.extract("^[^_]+_([^_]+)_.*$")
-        thisTbl["gridID"] = thisTbl["fname"].str.extract("^[^_]+_[^_]+_([^_]+)_.*$")
-        thisTbl["expt"] = thisTbl["fname"].str.extract("^[^_]+_[^_]+_[^_]+_([^_]+)_.*$")
-        thisTbl["stems"] = thisTbl["fname"].str.extract("^[^_]+_[^_]+_[^_]+_[^_]+_(.+).nc(?:.pkl)$")
-        return thisTbl
-
-    varPal = parseFilelist([k for v in pvDict.values() for k in v.keys()])
+    varPal = parseFilenames([k for v in pvDict.values() for k in v.keys()])
 
     # Iterate over secondary variables if they are request
     svDict = {}
@@ -198,6 +191,7 @@ def getWorkflow(config):
     # They only kick in if requested, draw upon the variable palette, and feed back
     # into when complete
     calDict = {}
+    calRefDict = {}
     # Iterate over secondary variables if they are request
     if "calibration" in config:
         for thisCal in config["calibration"].values():
@@ -223,65 +217,67 @@ def getWorkflow(config):
                                  + f'for calibration of "{thisCal['calibrationVariable']}_{thisCal['calibSource']}"')
             refDict = varPal[selThese].to_dict(orient="records")[0]
 
+            # The reference is sliced to the calibration period once, in a separate
+            # step, and shared by all of the files calibrated against it
+            refPrepPath = dirPrefix(outDirs["calibration"], "reference") + \
+                formatFilenames(varPal[selThese],
+                                stems=f"{refDict['stems']}_{thisCal['calPeriodStart']}-{thisCal['calPeriodEnd']}",
+                                ext=".nc.zarr").iloc[0]
+            calRefDict[refPrepPath] = {'ref': refDict['path'],
+                                       'calPeriodStart': thisCal['calPeriodStart'],
+                                       'calPeriodEnd': thisCal['calPeriodEnd']}
+
             # Now we have a list of valid files that can be made. Store the results
-            calTbl['outFile'] = [
-                os.path.join(outDirs["calibration"], thisCal["outVariable"], fName)
-                for fName in f"{thisCal["outVariable"]}_" + calTbl["srcID"] + "_" + refDict['gridID']+"_"+calTbl["expt"]+"_"+calTbl["stems"]+".nc"
-            ]
+            calTbl['outFile'] = dirPrefix(outDirs["calibration"], thisCal["outVariable"]) + \
+                formatFilenames(calTbl, 
+                                varID=thisCal["outVariable"],
+                                gridID=refDict['gridID'],
+                                ext=".nc")
 
             # Add to output dict
-            for idx, rw in calTbl.iterrows():
-                calDict[rw['outFile']] = {'histSim':rw['path'],'ref':refDict['path']}
+            calDict.update({outFile: {'histSim':histSim,'ref':refPrepPath} 
+                            for outFile, histSim in zip(calTbl['outFile'], calTbl['path'])})
 
             # Add to variable palette
             varPal = pd.concat([varPal,
-                               parseFilelist(calTbl['outFile'].to_list())])
+                               parseFilenames(calTbl['outFile'])])
 
 
     # Indicators -----------------------------------------------------
     # Loop over indicators and get required files
     # Currently only matching one variable. TODO: Allow multiple variables
+    # The indicator filename is the variable filename with the variable ID replaced by the
+    # indicator ID, and is always a NetCDF file
+    # When indicators are calculated in sets, all indicators using a variable file are
+    # calculated together. The files in a set share the part of the filename after the
+    # indicator ID, so we also store the mapping from this stem back to the variable file
     indDict = {}
+    indSetDict = {}
     for indKey, thisInd in ind.items():
-        #Build up the output filename first
-        varPal['indFname']=varPal['fname'].str.replace(r"^([^_]+)_(.+?)(\.pkl)?$",
-                                                       indKey+r"_\2",
-                                                       regex=True)
-        #Build the rest of the path
-        varPal["indPath"] = [
-            os.path.join(outDirs["indicators"],
-                         thisInd["id"],
-                         rw["indFname"])
-            for idx, rw in varPal.iterrows()
-        ]
-        #Only extract the dict for the part that we are actually
+        #Only build the paths for the part that we are actually
         #interested in
-        useThese = varPal["varID"] == thisInd["variables"]
-        indDict[indKey] = {rw["indPath"]: [rw["path"]] \
-                                    for idx, rw in varPal[useThese].iterrows()}
+        useThese = varPal[varPal["varID"] == thisInd["variables"]]
+        indFnames = formatFilenames(useThese, varID=indKey, ext=".nc")
+        indPaths = dirPrefix(outDirs["indicators"], thisInd["id"]) + indFnames
+        indDict[indKey] = {indPath: [srcPath] 
+                           for indPath, srcPath in zip(indPaths, useThese["path"])}
+        indSetDict[thisInd["variables"]] = dict(zip(indFnames.str[len(indKey)+1:],
+                                                    useThese["path"]))
 
     # Regridding-----------------------------------------------------------------------
     # We only regrid if it is requested in the configuration
     doRegridding = config["outputGrid"]["regriddingEngine"] != "none"
     if doRegridding:
         # Remap directory
-        rgTbl = pd.DataFrame([k for v in indDict.values() for k in v.keys()], 
-                          columns=["indPath"])
-        rgTbl["indID"] = [os.path.basename(os.path.dirname(f)) for f in rgTbl["indPath"]]
-        rgTbl["indFname"] = [os.path.basename(p) for p in rgTbl["indPath"]]
-        #Replace grid code in the filename with the appropriate one
-        rgTbl['rgFname'] = \
-            rgTbl["indFname"].str.replace(r'^([^_]+_[^_]+_)[^_]+(_.*$)',
-                                        r'\1'+config['outputGrid']['gridName']+r'\2',
-                                        regex=True)
-        #Build the rest of the paths
-        rgTbl["rgPath"] = [
-            os.path.join(outDirs["regridded"], rw["indID"], rw["rgFname"])
-            for idx, rw in rgTbl.iterrows()
-        ]
+        rgTbl = parseFilenames([k for v in indDict.values() for k in v.keys()])
+        #Replace grid code in the filename with the appropriate one and
+        #build the rest of the paths
+        rgTbl["rgPath"] = dirPrefix(outDirs["regridded"]) + \
+                            rgTbl["varID"].astype(str) + os.sep + \
+                            formatFilenames(rgTbl, gridID=config['outputGrid']['gridName'])
         
         # Extract the dict
-        rgDict = {rw["rgPath"]: [rw["indPath"]] for idx, rw in rgTbl.iterrows()}
+        rgDict = {rgPath: [indPath] for rgPath, indPath in zip(rgTbl["rgPath"], rgTbl["path"])}
     else:
         rgDict = {}
 
@@ -289,66 +285,38 @@ def getWorkflow(config):
     # Build ensemble membership - the exact source here depends on whether
     # we are doing regridding or not
     if doRegridding:
-        ensTbl = pd.DataFrame(rgDict.keys(), columns=["srcPath"])
+        ensTbl = parseFilenames(rgDict.keys())
     else:
-        ensTbl = pd.DataFrame(
-            [k for v in indDict.values() for k in v.keys()], columns=["srcPath"]
-        )
-    ensTbl["srcFname"] = [os.path.basename(p) for p in ensTbl["srcPath"]]
-    ensTbl["ensID"] = ensTbl["srcFname"].str.extract("^([^_]+_[^_]+_[^_]+_[^_]+)_.*$")
-    #Build path and extract dict
-    ensTbl["ensPath"] = [
-        os.path.join(outDirs["ensstats"], f + "_ensstats.nc") for f in ensTbl["ensID"]
-    ]
-    ensDict = (
-        ensTbl.groupby("ensPath")
-        .apply(lambda x: list(x["srcPath"]), include_groups=False)
-        .to_dict()
-    )
+        ensTbl = parseFilenames([k for v in indDict.values() for k in v.keys()])
+    #Build path and extract dict. The ensemble replaces the member stems
+    ensTbl["ensPath"] = dirPrefix(outDirs["ensstats"]) + \
+                            formatFilenames(ensTbl, stems="ensstats", ext=".nc")
+    ensDict = groupToDict(ensTbl, "ensPath", "path")
 
     # Arealstatistics----------------------------------------------
     # Start by building list of input files to calculate arealstatistics for
     # Note that we split into ensemble and member statistics
-    asEnsInps = pd.DataFrame(list(ensDict.keys()),columns=['srcPath'])
+    # The members have already been parsed when building the ensembles
+    asEnsInps = parseFilenames(ensDict.keys())
     asEnsInps['type']='ensstats'
-    asMemInps = pd.DataFrame([y for x in ensDict.values() for y in x],
-                             columns=['srcPath'])
+    asMemInps = ensTbl.drop(columns="ensPath")
     asMemInps['type']='members'
-    asTbl=pd.concat([asEnsInps,asMemInps])
+    asTbl=pd.concat([asEnsInps,asMemInps],ignore_index=True)
     # Now setup output structures
-    asTbl["srcFname"] = [os.path.basename(p) for p in asTbl["srcPath"]]
-    asTbl["asFname"] = asTbl["srcFname"].str.replace("nc", "csv")
-    asTbl["asPath"] = [os.path.join(outDirs["arealstats"], rw["type"], rw["asFname"]) \
-                       for idx, rw in asTbl.iterrows()]
+    asTbl["asPath"] = dirPrefix(outDirs["arealstats"]) + \
+                        asTbl["type"] + os.sep + formatFilenames(asTbl, ext=".csv")
     # Make the dict
-    asDict = (
-        asTbl.groupby("asPath")
-        .apply(lambda x: list(x["srcPath"]), include_groups=False)
-        .to_dict()
-    )
+    asDict = groupToDict(asTbl, "asPath", "path")
 
     # Plots----------------------------------------------------
     #Get list of areal statistics csv files (in the ensstats version)
-    csvList = pd.DataFrame(list(asDict.keys()), columns=["path"])
-    csvList["fname"] = [os.path.basename(f) for f in csvList["path"]]
-    csvList["indId"] = csvList["fname"].str.extract("^([^_]+)_.*$")
-    csvList["ensMemberID"] = csvList["fname"].str.extract("^[^_]+_[^_]+_[^_]+_[^_]+_(.+).*$")
-    csvList=csvList[csvList["ensMemberID"]=='ensstats.csv']
-    csvDict = (
-        csvList.groupby("indId")
-        .apply(lambda x: list(x["path"]), include_groups=False)
-        .to_dict()
-    )
+    csvList = parseFilenames(asDict.keys())
+    csvList=csvList[csvList["stems"]=='ensstats']
+    csvDict = groupToDict(csvList, "varID", "path")
     
     #And of the netcdf files
-    ncList = pd.DataFrame(list(ensDict.keys()), columns=["path"])
-    ncList["fname"] = [os.path.basename(f) for f in ncList["path"]]
-    ncList["indId"] = ncList["fname"].str.extract("^([^_]+)_.*$")
-    ncDict = (
-        ncList.groupby("indId")
-        .apply(lambda x: list(x["path"]), include_groups=False)
-        .to_dict()
-    )
+    ncList = parseFilenames(ensDict.keys())
+    ncDict = groupToDict(ncList, "varID", "path")
 
     # Loop over available indicators to make plots
     pltDict = {}
@@ -356,7 +324,8 @@ def getWorkflow(config):
         # But what should we plot? It depends on the nature of the indicator
         # * Period-based indicators should plot the spatial map and the plots, derived
         #   from the ensemble statistics
-        # * Yearly (or monthly) based indicators show a time series, also for ensemble statistcs
+        # * Yearly (or monthly, or rolling) based indicators show a time series, also for
+        #   ensemble statistcs
         if thisInd["time_binning"] == "periods":
             # Box plot - requires ensemble csv files
             bxpFname = os.path.join(outDirs["plots"], f"{thisInd['id']}_boxplot.png")
@@ -366,7 +335,7 @@ def getWorkflow(config):
             spFname = os.path.join(outDirs["plots"], f"{thisInd['id']}_spatial.png")
             pltDict[spFname] = ncDict[str(thisInd["id"])]
 
-        elif thisInd["time_binning"] in ["years", "months"]:
+        elif thisInd["time_binning"] in ["years", "months", "rolling"]:
             # Time series plot - requires ensemble csv files
             lpFname = os.path.join(outDirs["plots"], f"{thisInd['id']}_lineplot.png")
             pltDict[lpFname] = csvDict[str(thisInd["id"])]
@@ -375,8 +344,10 @@ def getWorkflow(config):
     rtn = {
         "primVars": pvDict,
         "secondaryVars": svDict,
+        "calibrationRefs":calRefDict,
         "calibratedVars":calDict,
         "indicators": indDict,
+        "indicatorSets": indSetDict,
         "regridded": rgDict,
         "ensstats": ensDict,
         "arealstats": asDict,
@@ -393,9 +364,73 @@ def getWorkflow(config):
         elif k in ["secondaryVars"]:  # Requires special handling, as these are nested lists
             for x in v.values():
                 allList += x["files"]
+        elif k in ["indicatorSets"]:  # Inputs, rather than targets
+            continue
         else:
             allList += v.keys()
     rtn["all"] = allList
 
     # Fin-----------------------------------
     return rtn
+
+
+def workflowFingerprint(config):
+    """
+    Fingerprint the workflow plan
+
+    Hashes everything that the workflow plan depends on: the (unvalidated) configuration,
+    the contents of the configuration tables, the validation schemas and KAPy code
+    used to build the plan, and the modification times of the directories matched
+    by the input paths. The latter change whenever files are added or removed.
+    """
+    h = hashlib.sha1()
+    h.update(json.dumps(config, sort_keys=True, default=str).encode())
+    for thisPath in sorted(config["configurationTables"].values()):
+        with open(thisPath, "rb") as f:
+            h.update(f.read())
+    # Validation pulls in other KAPy modules (e.g. the kernels), so all of them are
+    # included rather than trying to track the import graph
+    kapyDir = os.path.dirname(os.path.abspath(__file__))
+    depFiles = sorted(glob.glob(os.path.join(kapyDir, "*.py"))) + \
+        sorted(glob.glob(os.path.join(kapyDir, "..", "schemas", "*.json")))
+    for thisPath in depFiles:
+        h.update(f"{thisPath}:{os.stat(thisPath).st_mtime_ns}".encode())
+    # The input paths are read from the inputs table. This is a cheap read, compared to
+    # the full validation
+    inpTbl = pd.read_csv(config["configurationTables"]["inputs"], sep="\t",
+                         comment="#", dtype="str", keep_default_na=False)
+    for thisPattern in sorted(inpTbl["path"]):
+        for thisDir in sorted(glob.glob(os.path.dirname(thisPattern) or ".", recursive=True)):
+            h.update(f"{thisDir}:{os.stat(thisDir).st_mtime_ns}".encode())
+    return h.hexdigest()
+
+
+def getCachedWorkflow(config, cacheFile=os.path.join(".snakemake", "KAPy", "workflow.pkl")):
+    """
+    Get validated config and workflow, using a cache
+
+    Validates the configuration with validateConfig() and builds the workflow with
+    getWorkflow(). The results are cached on disk, keyed on the workflowFingerprint(),
+    so that subsequent calls with an unchanged configuration and input tree (e.g. from
+    every job spawned by snakemake) can load the results directly.
+    """
+    fingerprint = workflowFingerprint(config)
+    if os.path.exists(cacheFile):
+        try:
+            with open(cacheFile, "rb") as f:
+                cached = pickle.load(f)
+            if cached["fingerprint"] == fingerprint:
+                return cached["config"], cached["wf"]
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError):
+            pass  # Unreadable cache - rebuild it
+
+    # Rebuild and store
+    config = validateConfig(config)
+    wf = getWorkflow(config)
+    os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+
+    def writeCache(tmpFile):
+        with open(tmpFile, "wb") as f:
+            pickle.dump({"fingerprint": fingerprint, "config": config, "wf": wf}, f, protocol=-1)
+    helpers.atomicWrite(cacheFile, writeCache)
+    return config, wf
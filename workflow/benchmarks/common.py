@@ -0,0 +1,19 @@
+# Shared setup for the KAPy benchmarks. KAPy is imported from the workflow directory,
+# which is where the Snakefile finds it, so this is imported by each benchmark before
+# KAPy.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def timeIt(fn, repeats):
+    # Best of several repeats
+    rtn = []
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        rtn.append(time.perf_counter() - t0)
+    return min(rtn)
@@ -0,0 +1,74 @@
+# Benchmark of the ensemble statistics engines
+#
+# Times the streaming ensemble engine against the xclim engine on a synthetic ensemble
+# of annual indicator files, some of which cover shorter time axes than the others so
+# that the members have to be aligned.
+#
+# Usage, from the root of the repository:
+#   python workflow/benchmarks/ensembles.py --members 30 --cells 100 --years 100
+
+import argparse
+import os
+import shutil
+import tempfile
+import numpy as np
+import xarray as xr
+
+from common import timeIt  # Also puts KAPy on the path
+from KAPy import ensembles
+
+percentiles = {"upperPercentile": 90, "centralPercentile": 50, "lowerPercentile": 10}
+
+
+def makeEnsemble(ensDir, nMembers, nCells, nYears):
+    # Members are written as netCDF files, as produced by the indicator step. Every
+    # fifth member starts ten years later
+    rng = np.random.default_rng(1)
+    inFiles = []
+    for thisMember in range(nMembers):
+        start = 1981 + (10 if thisMember % 5 == 4 else 0)
+        time = xr.date_range(f"{start}-07-01", f"{1980 + nYears}-07-01", freq="YS-JUL",
+                             calendar="noleap", use_cftime=True)
+        dat = 290 + 5 * rng.normal(size=(len(time), nCells, nCells)).astype(np.float32)
+        ind = xr.DataArray(dat, dims=["time", "lat", "lon"], name="indicator",
+                           coords={"time": time, "lat": np.arange(nCells),
+                                   "lon": np.arange(nCells)})
+        inFiles.append(os.path.join(ensDir, f"member{thisMember}.nc"))
+        ind.to_dataset().to_netcdf(inFiles[-1])
+    return inFiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ensemble statistics engines")
+    parser.add_argument("--members", type=int, default=30)
+    parser.add_argument("--cells", type=int, default=100)
+    parser.add_argument("--years", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--memory-budget", default="")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    ensDir = tempfile.mkdtemp(prefix="KAPy-bench-")
+    try:
+        inFiles = makeEnsemble(ensDir, args.members, args.cells, args.years)
+        config = {"ensembles": percentiles,
+                  "processing": {"memoryBudget": args.memory_budget}}
+        outFile = [os.path.join(ensDir, "ensstats.nc")]
+
+        def runXclim():
+            ensembles.xclimEnsstats(config, inFiles, outFile)
+
+        def runStreaming():
+            ensembles.streamEnsstats(config, inFiles, outFile, args.threads)
+
+        print(f"{args.members} members x {args.years} years x {args.cells} x {args.cells} "
+              + f"cells, {args.threads} threads")
+        print(f"{'engine':<12}{'time (s)':>12}")
+        for thisEngine, fn in [("xclim", runXclim), ("streaming", runStreaming)]:
+            print(f"{thisEngine:<12}{timeIt(fn, args.repeats):>12.2f}")
+    finally:
+        shutil.rmtree(ensDir)
+
+
+if __name__ == "__main__":
+    main()
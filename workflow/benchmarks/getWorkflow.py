@@ -0,0 +1,74 @@
+# Benchmark of the workflow setup
+#
+# Times getWorkflow() on a synthetic input tree, to track the cost of resolving the
+# workflow that is paid by every snakemake invocation. The input tree consists of
+# empty files following the CORDEX naming convention used in the example
+# configuration, and the indicator table is padded out with copies of the
+# example indicator.
+#
+# Usage, from the root of the repository:
+#   python workflow/benchmarks/getWorkflow.py --files 10000 100000 --indicators 200
+
+import argparse
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+from common import timeIt  # Also puts KAPy on the path
+import KAPy
+
+repoDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+experiments = ["historical", "rcp26", "rcp45", "rcp85"]
+nPeriods = 10
+
+
+def makeProject(projDir, nFiles, nIndicators):
+    # Copy the example configuration and point it at a synthetic input tree
+    shutil.copytree(os.path.join(repoDir, "config"), os.path.join(projDir, "config"))
+    inpDir = os.path.join(projDir, "inputs")
+    os.makedirs(inpDir)
+    nMembers = max(1, nFiles // (len(experiments) * nPeriods))
+    for thisMember in range(nMembers):
+        for thisExpt in experiments:
+            for thisPeriod in range(nPeriods):
+                fname = f"tas_Ghana-44_GCM-{thisMember // 10}_{thisExpt}_r{thisMember % 10}i1p1_" + \
+                        f"RCM-X_v1_mon_{thisPeriod}.nc"
+                open(os.path.join(inpDir, fname), "w").close()
+    open(os.path.join(inpDir, "t2m_ERA5_monthly.nc"), "w").close()
+
+    # Pad out the indicator table
+    indPath = os.path.join(projDir, "config", "indicators.tsv")
+    indTbl = pd.read_csv(indPath, sep="\t")
+    indTbl = indTbl.loc[[0] * nIndicators].reset_index(drop=True)
+    indTbl["id"] = range(101, 101 + nIndicators)
+    indTbl.to_csv(indPath, sep="\t", index=False)
+    return nMembers * len(experiments) * nPeriods + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark getWorkflow()")
+    parser.add_argument("--files", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--indicators", type=int, default=200)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    startDir = os.getcwd()
+    for nFiles in args.files:
+        projDir = tempfile.mkdtemp(prefix="KAPy-bench-")
+        try:
+            nCreated = makeProject(projDir, nFiles, args.indicators)
+            os.chdir(projDir)
+            config = KAPy.getConfig("config/config.yaml")
+            wf = KAPy.getWorkflow(config)
+            nTargets = sum(len(v) for v in wf.values())
+            tWorkflow = timeIt(lambda: KAPy.getWorkflow(config), args.repeats)
+            print(f"{nCreated} files, {args.indicators} indicators: {nTargets} targets, "
+                  + f"getWorkflow {tWorkflow:.2f} s")
+        finally:
+            os.chdir(startDir)
+            shutil.rmtree(projDir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# Benchmark of the statistic kernels
+#
+# Times each statistic in the kernels.statisticKernels registry on synthetic daily
+# data, both binned by year (as used for the "years" time binning) and over the
+# periods (the "periods" time binning). The data are held in memory, so that the
+# timings reflect the kernels rather than I/O.
+#
+# Usage, from the root of the repository:
+#   python workflow/benchmarks/kernels.py --years 30 --cells 100
+
+import argparse
+import numpy as np
+import xarray as xr
+
+from common import timeIt  # Also puts KAPy on the path
+from KAPy import kernels, helpers
+
+# Arguments used for the statistics that require them
+statArgs = {"threshold": 300, "percentile": 90}
+periods = {"1": {"id": 1, "start": 1981, "end": 1990},
+           "2": {"id": 2, "start": 1991, "end": 2000},
+           "3": {"id": 3, "start": 2001, "end": 2010}}
+
+
+def makeData(nYears, nCells):
+    # Daily temperature-like field with a seasonal cycle, noise and some missing values
+    rng = np.random.default_rng(1)
+    time = xr.date_range("1981-01-01", periods=nYears * 365, freq="D",
+                         calendar="noleap", use_cftime=True)
+    season = 10 * np.sin(np.arange(len(time)) * 2 * np.pi / 365)
+    dat = 290 + season[:, None, None] + 5 * rng.normal(size=(len(time), nCells, nCells))
+    dat[rng.random(dat.shape) < 0.01] = np.nan
+    return xr.DataArray(dat, dims=["time", "lat", "lon"],
+                        coords={"time": time, "lat": np.arange(nCells), "lon": np.arange(nCells)},
+                        name="tas")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the statistic kernels")
+    parser.add_argument("--years", type=int, default=30)
+    parser.add_argument("--cells", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    dat = makeData(args.years, args.cells)
+    print(f"{dat.sizes['time']} days x {args.cells} x {args.cells} cells")
+    print(f"{'statistic':<14}{'years (s)':>12}{'periods (s)':>14}")
+    for thisStat, thisKernel in kernels.statisticKernels.items():
+        theseArgs = {k: statArgs[k] for k in thisKernel["args"]}
+
+        def byYears():
+            prepared = kernels.prepareStatistic(dat, thisStat, theseArgs)
+            grouped = prepared.resample(time="YE", label="right")
+            return kernels.reduceStatistic(grouped, thisStat, theseArgs).values
+
+        def byPeriods():
+            prepared = kernels.prepareStatistic(dat, thisStat, theseArgs)
+            periodMembers = helpers.periodMembership(prepared, periods)
+            return kernels.periodStatistic(prepared, periodMembers, thisStat, theseArgs).values
+
+        # Run once first, so that compilation is not included in the timings
+        byYears()
+        byPeriods()
+        print(f"{thisStat:<14}{timeIt(byYears, args.repeats):>12.3f}"
+              + f"{timeIt(byPeriods, args.repeats):>14.3f}")
+
+
+if __name__ == "__main__":
+    main()
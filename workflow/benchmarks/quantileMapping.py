@@ -0,0 +1,87 @@
+# Benchmark of the quantile mapping calibration methods
+#
+# Times the training and adjustment steps of the native quantile mapping methods
+# (kapy-eqm and kapy-qdm) on synthetic daily data, together with the xclim methods
+# that they follow when xclim.sdba (or xsdba, which it has been split out into) is
+# available.
+#
+# Usage, from the root of the repository:
+#   python workflow/benchmarks/quantileMapping.py --cells 20 --years 80
+
+import argparse
+import numpy as np
+import xarray as xr
+
+from common import timeIt  # Also puts KAPy on the path
+from KAPy import quantileMapping
+
+methods = {"kapy-eqm": "EmpiricalQuantileMapping",
+           "kapy-qdm": "QuantileDeltaMapping"}
+
+
+def makeData(nCells, nYears):
+    # Reference and simulation over a 30 year calibration period, and the simulation
+    # over the full period
+    rng = np.random.default_rng(1)
+    time = xr.date_range("1981-01-01", periods=nYears * 365, freq="D",
+                         calendar="noleap", use_cftime=True)
+    season = 8 * np.sin(np.arange(len(time)) * 2 * np.pi / 365)
+    shape = (len(time), nCells, nCells)
+    coords = {"time": time, "lat": np.arange(nCells), "lon": np.arange(nCells)}
+    ref = xr.DataArray(295 + season[:, None, None] + 3 * rng.normal(size=shape),
+                       dims=["time", "lat", "lon"], coords=coords, attrs={"units": "K"})
+    sim = xr.DataArray(293 + 1.2 * season[:, None, None] + 4 * rng.normal(size=shape),
+                       dims=["time", "lat", "lon"], coords=coords, attrs={"units": "K"})
+    calPeriod = slice(0, 30 * 365)
+    return ref.isel(time=calPeriod), sim.isel(time=calPeriod), sim
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the quantile mapping methods")
+    parser.add_argument("--cells", type=int, default=20)
+    parser.add_argument("--years", type=int, default=80)
+    parser.add_argument("--grouping", default="month")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    refDatCP, histNN, histSimNN = makeData(args.cells, args.years)
+    calCfg = {"grouping": args.grouping,
+              "additionalArgs": {"kind": "+", "nquantiles": 20}}
+    try:
+        from xclim import sdba
+    except ImportError:
+        try:
+            import xsdba as sdba
+        except ImportError:
+            sdba = None
+            print("Neither xclim.sdba nor xsdba is available - only timing the native methods")
+
+    print(f"{args.cells * args.cells} cells, {histSimNN.sizes['time']} days, "
+          + f"grouping by {args.grouping}")
+    print(f"{'method':<12}{'train (s)':>12}{'adjust (s)':>12}")
+    for thisMethod, xclimClass in methods.items():
+        # Native method. Run once first, so that compilation is not included
+        trained = quantileMapping.train(refDatCP, histNN, calCfg)
+        quantileMapping.adjust(histSimNN, trained, thisMethod)
+        tTrain = timeIt(lambda: quantileMapping.train(refDatCP, histNN, calCfg), args.repeats)
+        tAdjust = timeIt(lambda: quantileMapping.adjust(histSimNN, trained, thisMethod),
+                         args.repeats)
+        print(f"{thisMethod:<12}{tTrain:>12.2f}{tAdjust:>12.2f}")
+
+        # xclim equivalent, with the settings used in calibration.py
+        if sdba is not None:
+            adjClass = getattr(sdba.adjustment, xclimClass)
+
+            def xclimTrain():
+                return adjClass.train(refDatCP, histNN, group="time." + args.grouping,
+                                      **calCfg["additionalArgs"])
+            adjObj = xclimTrain()
+            tTrain = timeIt(lambda: xclimTrain().ds.load(), args.repeats)
+            tAdjust = timeIt(lambda: adjObj.adjust(histSimNN, extrapolation="constant",
+                                                   interp="nearest").load(),
+                             args.repeats)
+            print(f"{thisMethod.replace('kapy', 'xclim'):<12}{tTrain:>12.2f}{tAdjust:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
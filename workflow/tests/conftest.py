@@ -0,0 +1,10 @@
+# Shared setup for the KAPy tests. KAPy is imported from the workflow directory,
+# which is where the Snakefile finds it.
+#
+# Run from the root of the repository with
+#   python -m pytest workflow/tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
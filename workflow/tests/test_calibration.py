@@ -0,0 +1,42 @@
+# Checks of the calibration step, and of the cache of trained adjustments
+
+import os
+import numpy as np
+import xarray as xr
+from KAPy import calibration
+
+
+def writeField(path, offset, seed):
+    # Daily field on a small grid
+    rng = np.random.default_rng(seed)
+    time = xr.date_range("1981-01-01", "2020-12-31", freq="D",
+                         calendar="noleap", use_cftime=True)
+    dat = xr.DataArray(offset + 5 * rng.normal(size=(len(time), 6, 7)),
+                       dims=["time", "lat", "lon"], name="tas", attrs={"units": "K"},
+                       coords={"time": time,
+                               "lat": ("lat", np.arange(6.0), {"standard_name": "latitude"}),
+                               "lon": ("lon", np.arange(7.0), {"standard_name": "longitude"})})
+    dat.to_netcdf(path)
+    return str(path)
+
+
+def test_trainingReusedAcrossTiles(tmp_path):
+    # The trained adjustment is reused when the calibration is split into tiles
+    # differently, and gives the same result
+    histSimFile = writeField(tmp_path / "sim.nc", 290, 0)
+    refFile = writeField(tmp_path / "ref.nc", 292, 1)
+    results = []
+    for memoryBudget, threads in [("", 1), ("", 3), ("1MB", 2)]:
+        config = {"processing": {"memoryBudget": memoryBudget,
+                                 "trainingCache": str(tmp_path / "cache"),
+                                 "gridCache": str(tmp_path / "grids")},
+                  "calibration": {"tas-eqm": {"method": "kapy-eqm", "grouping": "month",
+                                              "calPeriodStart": 1981, "calPeriodEnd": 2010,
+                                              "outVariable": "tas", "additionalArgs": {}}}}
+        outFile = str(tmp_path / f"out{threads}.nc")
+        calibration.calibrate(config, histSimFile, refFile, [outFile], "tas-eqm", threads)
+        assert len(os.listdir(tmp_path / "cache")) == 1
+        with xr.open_dataarray(outFile) as res:
+            results.append(res.transpose("time", "lat", "lon").values)
+    for res in results[1:]:
+        np.testing.assert_array_equal(res, results[0])
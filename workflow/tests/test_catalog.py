@@ -0,0 +1,36 @@
+# Checks of the ordering of input files with the catalog
+
+import numpy as np
+import pytest
+import xarray as xr
+from KAPy import catalog
+
+
+def writeFiles(tmp_path, starts, nTime):
+    # Daily files of nTime timesteps starting on the given days of 2000, written in
+    # reverse order so that they have to be sorted
+    paths = []
+    for thisStart in reversed(starts):
+        time = xr.date_range("2000-01-01", periods=thisStart + nTime, freq="D",
+                             calendar="noleap", use_cftime=True)[thisStart:]
+        dat = xr.DataArray(np.zeros((nTime, 2, 2)), dims=["time", "lat", "lon"], name="tas",
+                           coords={"time": time, "lat": [0.0, 1.0], "lon": [0.0, 1.0]})
+        paths.append(str(tmp_path / f"tas_{thisStart:03d}.nc"))
+        dat.to_netcdf(paths[-1])
+    return paths
+
+
+@pytest.mark.parametrize("nTime", [1, 5])
+def test_orderFilesGaps(tmp_path, capsys, nTime):
+    # Contiguous files are ordered without warnings, whether they hold one timestep or
+    # several, and a missing file is reported as a single gap
+    config = {"processing": {"inputCatalog": str(tmp_path / "catalog.sqlite")}}
+    starts = list(range(0, 10 * nTime, nTime))
+    paths = writeFiles(tmp_path, starts, nTime)
+    assert catalog.orderFiles(config, paths, "tas") == paths[::-1]
+    assert "gap" not in capsys.readouterr().out
+
+    del paths[3]
+    catalog.orderFiles(config, paths, "tas")
+    warnings = capsys.readouterr().out.splitlines()
+    assert len(warnings) == 1 and f"tas_{starts[7]:03d}.nc" in warnings[0]
@@ -0,0 +1,138 @@
+# Checks of the ensemble statistics engines against the xclim engine
+
+import os
+import numpy as np
+import pytest
+import xarray as xr
+import zarr
+from KAPy import ensembles
+
+percentiles = {"upperPercentile": 90, "centralPercentile": 50, "lowerPercentile": 10}
+
+
+def ensembleConfig(engine, memoryBudget=""):
+    return {"ensembles": percentiles,
+            "processing": {"ensembleEngine": engine, "memoryBudget": memoryBudget}}
+
+
+def writeMember(path, seed, years=range(2000, 2010), mean=290, spread=5):
+    # Annual indicator of an ensemble member on a small grid, with some missing values
+    rng = np.random.default_rng(seed)
+    time = xr.date_range(f"{years[0]}-07-01", periods=len(years), freq="YS-JUL",
+                         calendar="noleap", use_cftime=True)
+    dat = mean + spread * rng.normal(size=(len(time), 4, 5))
+    dat[rng.random(dat.shape) < 0.05] = np.nan
+    ind = xr.DataArray(dat, dims=["time", "lat", "lon"], name="indicator",
+                       coords={"time": time, "lat": np.arange(4.0), "lon": np.arange(5.0)},
+                       attrs={"units": "K"})
+    ind.to_dataset().to_netcdf(path)
+    return str(path)
+
+
+def replaceMember(path, *args, **kwargs):
+    # Rewrite a member, making sure that it is seen to have changed even where the
+    # file system has coarse timestamps
+    mtime = os.stat(path).st_mtime_ns + 10**9
+    writeMember(path, *args, **kwargs)
+    os.utime(path, ns=(mtime, mtime))
+
+
+def sampleEnsemble(tmp_path):
+    # Five members, two of which cover different (shorter) time axes
+    return [writeMember(tmp_path / "m0.nc", 0),
+            writeMember(tmp_path / "m1.nc", 1, range(2003, 2010)),
+            writeMember(tmp_path / "m2.nc", 2),
+            writeMember(tmp_path / "m3.nc", 3, range(2000, 2006)),
+            writeMember(tmp_path / "m4.nc", 4)]
+
+
+def assertSameStatistics(outFile, refFile):
+    with xr.open_dataset(outFile, use_cftime=True) as out, \
+         xr.open_dataset(refFile, use_cftime=True) as ref:
+        assert set(out.data_vars) == set(ref.data_vars)
+        for thisVar in ref.data_vars:
+            np.testing.assert_array_equal(out[thisVar].dims, ref[thisVar].dims)
+            np.testing.assert_allclose(out[thisVar].values, ref[thisVar].values,
+                                       rtol=1e-6, equal_nan=True)
+        np.testing.assert_array_equal(out.time.values, ref.time.values)
+
+
+@pytest.mark.parametrize("memoryBudget,threads", [("", 1), ("", 3), ("4KB", 1), ("4KB", 3)])
+def test_streamMatchesXclim(tmp_path, memoryBudget, threads):
+    # The streaming engine gives the same statistics as the xclim engine, whether the
+    # ensemble is processed in one tile or many
+    inFiles = sampleEnsemble(tmp_path)
+    ensembles.xclimEnsstats(ensembleConfig("xclim"), inFiles, [str(tmp_path / "xclim.nc")])
+    ensembles.streamEnsstats(ensembleConfig("streaming", memoryBudget), inFiles,
+                             [str(tmp_path / "stream.nc")], threads)
+    assertSameStatistics(tmp_path / "stream.nc", tmp_path / "xclim.nc")
+
+
+def updateIncremental(tmp_path, inFiles, memoryBudget):
+    # Update the incremental engine to the given members, and check that the result is
+    # the same as calculating the statistics from scratch with the streaming engine
+    outFile = str(tmp_path / "incremental.nc")
+    if os.path.exists(outFile):
+        os.remove(outFile)
+    ensembles.incrementalEnsstats(ensembleConfig("incremental", memoryBudget), inFiles,
+                                  [outFile], 2)
+    ensembles.streamEnsstats(ensembleConfig("streaming", memoryBudget), inFiles,
+                             [str(tmp_path / "stream.nc")])
+    assertSameStatistics(outFile, tmp_path / "stream.nc")
+
+
+@pytest.mark.parametrize("memoryBudget", ["", "4KB"])
+def test_incrementalAdd(tmp_path, memoryBudget):
+    inFiles = sampleEnsemble(tmp_path)
+    updateIncremental(tmp_path, inFiles[:3], memoryBudget)
+    updateIncremental(tmp_path, inFiles, memoryBudget)
+
+
+@pytest.mark.parametrize("memoryBudget", ["", "4KB"])
+def test_incrementalReplace(tmp_path, memoryBudget):
+    inFiles = sampleEnsemble(tmp_path)
+    updateIncremental(tmp_path, inFiles, memoryBudget)
+    replaceMember(tmp_path / "m2.nc", 12)
+    replaceMember(tmp_path / "m3.nc", 13, range(2001, 2007))
+    updateIncremental(tmp_path, inFiles, memoryBudget)
+
+
+@pytest.mark.parametrize("memoryBudget", ["", "4KB"])
+def test_incrementalRemove(tmp_path, memoryBudget):
+    inFiles = sampleEnsemble(tmp_path)
+    updateIncremental(tmp_path, inFiles, memoryBudget)
+    updateIncremental(tmp_path, inFiles[:2] + inFiles[3:], memoryBudget)
+
+
+@pytest.mark.parametrize("memoryBudget", ["", "4KB"])
+def test_incrementalLayoutChange(tmp_path, memoryBudget):
+    # A new member that extends the time axis, and a replacing member that shortens it
+    # again, both change the layout of the ensemble
+    inFiles = sampleEnsemble(tmp_path)
+    updateIncremental(tmp_path, inFiles, memoryBudget)
+    inFiles.append(writeMember(tmp_path / "m5.nc", 5, range(2000, 2013)))
+    updateIncremental(tmp_path, inFiles, memoryBudget)
+    replaceMember(tmp_path / "m5.nc", 15, range(2001, 2008))
+    updateIncremental(tmp_path, inFiles, memoryBudget)
+
+
+@pytest.mark.parametrize("memoryBudget", ["", "4KB"])
+def test_incrementalInterrupted(tmp_path, memoryBudget):
+    # A state that was left incomplete is not used, even if its contents are wrong
+    inFiles = sampleEnsemble(tmp_path)
+    updateIncremental(tmp_path, inFiles[:3], memoryBudget)
+    statePath = ensembles.getEnsembleStatePath(str(tmp_path / "incremental.nc"))
+    ensembles.setStateAttrs(statePath, {"complete": False})
+    state = zarr.open_group(statePath, mode="a")
+    state["stack"][:] = 0
+    state["count"][:] = 0
+    updateIncremental(tmp_path, inFiles, memoryBudget)
+
+
+def test_incrementalPrecision(tmp_path):
+    # The standard deviation keeps its precision when the spread of the members is
+    # small compared with their mean, also after members are replaced
+    inFiles = [writeMember(tmp_path / f"m{i}.nc", i, mean=1e5, spread=1e-2) for i in range(5)]
+    updateIncremental(tmp_path, inFiles, "")
+    replaceMember(tmp_path / "m1.nc", 11, mean=1e5, spread=1e-2)
+    updateIncremental(tmp_path, inFiles, "")
@@ -0,0 +1,115 @@
+# Checks of the regridding weights of the sparse regridding engine
+
+import numpy as np
+import pytest
+import xarray as xr
+from KAPy import grids, regridding
+
+
+def sampleField(dimOrder):
+    # A field on a small rectilinear grid, with different numbers of latitudes and
+    # longitudes so that the two layouts cannot be confused, and a missing value
+    lat = np.arange(40.5, 46.5, 1.0)
+    lon = np.arange(0.5, 10.5, 1.0)
+    dat = xr.DataArray(lat[:, None] * 100 + lon[None, :], dims=["lat", "lon"],
+                       coords={"lat": ("lat", lat, {"standard_name": "latitude"}),
+                               "lon": ("lon", lon, {"standard_name": "longitude"})})
+    dat[2, 3] = np.nan
+    return dat.transpose(*dimOrder)
+
+
+@pytest.mark.parametrize("method", ["conservative", "bilinear"])
+@pytest.mark.parametrize("srcOrder", [("lat", "lon"), ("lon", "lat")])
+@pytest.mark.parametrize("tgtOrder", [("lat", "lon"), ("lon", "lat")])
+def test_regridOntoOwnGrid(method, srcOrder, tgtOrder):
+    # Regridding a field onto its own grid should return it unchanged, whatever the
+    # order of the dimensions of the source and target
+    srcDat = sampleField(srcOrder)
+    tgtDat = sampleField(tgtOrder)
+    if method == "conservative":
+        weights = grids.conservativeWeights(srcDat, tgtDat)
+    else:
+        weights = grids.bilinearWeights(srcDat, tgtDat)
+    res = regridding.applyWeights(srcDat.values, weights,
+                                  tgtShape=tgtDat.shape,
+                                  renormalise=method == "conservative")
+    np.testing.assert_allclose(res, tgtDat.values, rtol=1e-10)
+
+
+def regularField(lat, lon, values):
+    # A field on a regular grid, with the values given as a function of the
+    # longitude and latitude of the cell centres
+    return xr.DataArray(values(lon[None, :], lat[:, None]), dims=["lat", "lon"],
+                        coords={"lat": ("lat", lat, {"standard_name": "latitude"}),
+                                "lon": ("lon", lon, {"standard_name": "longitude"})})
+
+
+def cellAreas(dat):
+    # Areas of the cells of a regular grid on the unit sphere
+    latEdges = np.deg2rad(grids.cellEdges(dat.lat.values))
+    lonEdges = np.deg2rad(grids.cellEdges(dat.lon.values))
+    return np.diff(np.sin(latEdges))[:, None] * np.diff(lonEdges)[None, :]
+
+
+def regrid(srcDat, tgtDat, method):
+    if method == "conservative":
+        weights = grids.conservativeWeights(srcDat, tgtDat)
+    else:
+        weights = grids.bilinearWeights(srcDat, tgtDat)
+    return regridding.applyWeights(srcDat.values, weights, tgtShape=tgtDat.shape,
+                                   renormalise=method == "conservative")
+
+
+def test_bilinearExactOnLinearField():
+    # Bilinear interpolation reproduces a field that is linear in longitude and
+    # latitude exactly, at target points between the source cell centres
+    def linear(lon, lat):
+        return 3.0 * lon - 2.0 * lat + 7.0
+    srcDat = regularField(np.arange(40.5, 50.5, 1.0), np.arange(0.5, 12.5, 1.0), linear)
+    tgtDat = regularField(np.arange(41.3, 49.0, 0.7), np.arange(1.2, 11.0, 0.45), linear)
+    np.testing.assert_allclose(regrid(srcDat, tgtDat, "bilinear"), tgtDat.values, rtol=1e-10)
+
+
+@pytest.mark.parametrize("srcRes,tgtRes", [(1.0, 2.0), (2.0, 1.0)])
+def test_conservativePreservesMean(srcRes, tgtRes):
+    # Conservative regridding between grids covering the same area preserves the
+    # area-weighted mean of the field
+    def wavy(lon, lat):
+        return np.sin(np.deg2rad(4 * lon)) * np.cos(np.deg2rad(3 * lat)) + lat / 10
+    srcDat = regularField(np.arange(30 + srcRes / 2, 60, srcRes),
+                          np.arange(srcRes / 2, 40, srcRes), wavy)
+    tgtDat = regularField(np.arange(30 + tgtRes / 2, 60, tgtRes),
+                          np.arange(tgtRes / 2, 40, tgtRes), wavy)
+    res = regrid(srcDat, tgtDat, "conservative")
+    srcMean = np.sum(srcDat.values * cellAreas(srcDat)) / np.sum(cellAreas(srcDat))
+    tgtMean = np.sum(res * cellAreas(tgtDat)) / np.sum(cellAreas(tgtDat))
+    np.testing.assert_allclose(tgtMean, srcMean, rtol=1e-10)
+    if tgtRes > srcRes:
+        # Each coarse cell is the area-weighted mean of the four fine cells within it
+        srcArea = cellAreas(srcDat)
+        blockSum = (srcDat.values * srcArea).reshape(res.shape[0], 2, res.shape[1], 2)
+        blockArea = srcArea.reshape(res.shape[0], 2, res.shape[1], 2)
+        np.testing.assert_allclose(res, blockSum.sum(axis=(1, 3)) / blockArea.sum(axis=(1, 3)),
+                                   rtol=1e-10)
+
+
+def test_targetPartlyOutsideSource():
+    # Target cells outside the source grid are missing. Conservative regridding
+    # renormalises cells that are partly covered to the mean of the covered part,
+    # while bilinear interpolation leaves points beyond the outer cell centres missing
+    def eastward(lon, lat):
+        return lon + 0 * lat
+    srcDat = regularField(np.arange(40.5, 46.5, 1.0), np.arange(0.5, 10.5, 1.0), eastward)
+    tgtDat = regularField(np.arange(40.0, 50.0, 2.0), np.arange(-2.0, 14.0, 2.0), eastward)
+
+    # The source covers 0E-10E and 40N-46N. The target cells centred on 0E and 10E are
+    # half covered, and take the mean of the covered half
+    res = regrid(srcDat, tgtDat, "conservative")
+    covered = [np.nan, 0.5, 2, 4, 6, 8, 9.5, np.nan]
+    np.testing.assert_allclose(res, [covered] * 4 + [[np.nan] * 8], rtol=1e-10)
+
+    # The source cell centres span 0.5E-9.5E and 40.5N-45.5N
+    res = regrid(srcDat, tgtDat, "bilinear")
+    inside = [np.nan, np.nan, 2, 4, 6, 8, np.nan, np.nan]
+    np.testing.assert_allclose(res, [[np.nan] * 8] + [inside] * 2 + [[np.nan] * 8] * 2,
+                               rtol=1e-10)
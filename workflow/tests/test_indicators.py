@@ -0,0 +1,49 @@
+# Checks of the calculation of indicators from the original data
+
+import numpy as np
+import xarray as xr
+from KAPy import indicators
+
+config = {"seasons": {"JJA": {"months": [6, 7, 8]},
+                      "DJF": {"months": [12, 1, 2]}},
+          "periods": {"1": {"id": 1, "start": 2000, "end": 2001}}}
+
+
+def hotDays(dates):
+    # Daily series at a single point that is hot on the given dates only
+    time = xr.date_range("2000-01-01", "2001-12-31", freq="D",
+                         calendar="noleap", use_cftime=True)
+    isHot = np.isin([t.strftime("%Y-%m-%d") for t in time.values], dates)
+    return xr.DataArray(np.where(isHot, 40.0, 20.0)[:, None], dims=["time", "x"],
+                        coords={"time": time, "x": [0]})
+
+
+def spellIndicator(season, timeBinning):
+    return {"statistic": "spell_above", "season": [season], "time_binning": timeBinning,
+            "additionalArgs": {"threshold": 30}}
+
+
+def test_spellsBrokenBetweenSeasons():
+    # Five hot days at the end of one August and five at the start of the next June
+    # are separate spells
+    thisDat = hotDays([f"2000-08-{d}" for d in range(27, 32)]
+                      + [f"2001-06-0{d}" for d in range(1, 6)])
+    dout = indicators.binIndicator(config, thisDat, spellIndicator("JJA", "periods"))
+    assert dout.values.ravel().tolist() == [5]
+
+
+def test_spellsBrokenWithinYear():
+    # The end of February and the start of December of the same year fall in the
+    # same year bin, but are separate spells
+    thisDat = hotDays([f"2001-02-{d}" for d in range(24, 29)]
+                      + [f"2001-12-0{d}" for d in range(1, 6)])
+    dout = indicators.binIndicator(config, thisDat, spellIndicator("DJF", "years"))
+    assert dout.sel(time=dout.time.dt.year == 2001).values.ravel().tolist() == [5]
+
+
+def test_spellsByMonthKeepSeasonOnly():
+    # Monthly spells are only reported for the months of the season
+    thisDat = hotDays(["2000-06-01", "2000-06-02"])
+    dout = indicators.binIndicator(config, thisDat, spellIndicator("JJA", "months"))
+    assert dout.time.dt.month.values.tolist() == [6, 7, 8] * 2
+    assert dout.values.ravel().tolist() == [2, 0, 0, 0, 0, 0]